@@ -0,0 +1,149 @@
+import hashlib
+import json
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Status codes worth retrying: the request may succeed if sent again
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def idempotency_key(payload):
+    """
+    Key identifying a payload, sent as the Idempotency-Key header so a backend that supports it
+    can ignore a retry of a request it already applied.
+
+    Args:
+    - payload: JSON-serializable payload.
+
+    Returns:
+    - key: Hexadecimal digest of the payload.
+    """
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class BackendClient:
+    """
+    Client of the backend REST API over one pooled keep-alive session.
+
+    Requests are retried with exponential backoff (and jitter) on timeouts, connection errors
+    and 429/5xx responses; other 4xx responses fail at once. Every retry of a request carries
+    the same Idempotency-Key header.
+
+    Args:
+    - session: Optional requests.Session to use.
+    - max_workers: Maximum number of requests in flight in `post_many`, and pooled connections.
+    - max_retries: Number of retries after the first attempt.
+    - backoff: Delay in seconds before the first retry, doubled on each following retry.
+    - timeout: Timeout in seconds of each request.
+    """
+
+    def __init__(self, session=None, max_workers=8, max_retries=4, backoff=0.5, timeout=30):
+        self.session = session if session is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='backend')
+
+    def post_json(self, url, payload, key=None):
+        """
+        POST a JSON payload, retrying transient failures.
+
+        Args:
+        - url: Endpoint URL.
+        - payload: JSON-serializable payload.
+        - key: Idempotency key of the request (default is derived from the payload).
+
+        Returns:
+        - result: Dictionary with 'ok', 'status' (HTTP status or None), 'attempts', 'data'
+                  (decoded JSON response, or None) and 'error' (message, or None).
+        """
+        headers = {'Idempotency-Key': key or idempotency_key(payload)}
+        result = {'ok': False, 'status': None, 'attempts': 0, 'data': None, 'error': None}
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            result['attempts'] = attempt + 1
+            try:
+                res = self.session.post(url, json=payload, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                result['error'] = f"{type(e).__name__}: {e}"
+                continue
+            except requests.exceptions.RequestException as e:
+                result['error'] = f"{type(e).__name__}: {e}"
+                return result
+
+            result['status'] = res.status_code
+            if res.status_code in RETRY_STATUS_CODES:
+                result['error'] = f"HTTP {res.status_code}: {res.text[:200]}"
+                continue
+            if res.status_code >= 400:
+                result['error'] = f"HTTP {res.status_code}: {res.text[:200]}"
+                return result
+
+            try:
+                result['data'] = res.json() if res.content else None
+            except ValueError as e:
+                result['error'] = f"Invalid JSON response: {e}"
+                return result
+            result['ok'] = True
+            result['error'] = None
+            return result
+        return result
+
+    def post_many(self, url, payloads, keys=None):
+        """
+        POST many JSON payloads concurrently, with at most `max_workers` requests in flight.
+
+        Args:
+        - url: Endpoint URL.
+        - payloads: Iterable of JSON-serializable payloads.
+        - keys: Optional iterable with the idempotency key of each payload.
+
+        Yields:
+        - result: The `post_json` result of each payload, in order.
+        """
+        keys = iter(keys) if keys is not None else None
+        pending = deque()
+        for payload in payloads:
+            key = next(keys) if keys is not None else None
+            pending.append(self.executor.submit(self.post_json, url, payload, key))
+            if len(pending) >= self.max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        """
+        Stops the worker threads and closes the pooled session.
+        """
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def summarize_report(report):
+    """
+    Count the successes and failures of an upload report.
+
+    Args:
+    - report: List of per-row results, each with an 'ok' key.
+
+    Returns:
+    - summary: Dictionary with the 'sent', 'succeeded' and 'failed' counts.
+    """
+    succeeded = sum(1 for row in report if row['ok'])
+    return {'sent': len(report), 'succeeded': succeeded, 'failed': len(report) - succeeded}
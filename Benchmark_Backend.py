@@ -0,0 +1,99 @@
+import argparse
+import json
+import time
+import requests
+from Backend_Client import BackendClient, summarize_report
+from Endpoint_data import upload_records
+from Mask_Encoding import to_python_value
+from Local_Standins import BackendServer
+
+"""
+Throughput of the `create_image` uploads against a local stand-in of the backend.
+
+Compares the original upload (one unpooled `requests.post` per record, one after the other)
+with `upload_records` over a BackendClient, for several in-flight limits.
+
+    python Benchmark_Backend.py [--records 200] [--latency 0.02] [--failure-rate 0.05] [--workers 1 8 16]
+"""
+
+COLUMNS = ['Image_Path', 'PeriodOfDiseaesId', 'Classification', 'Confidence', 'bbox', 'Image_Class', 'Resized_Path', 'Annotated_Path']
+
+
+def synthetic_records(count):
+    """
+    Records shaped like the ones the pipeline uploads.
+    """
+    return [{
+        'Image_Path': f"https://drive.google.com/uc?id=image{index}",
+        'PeriodOfDiseaesId': f"period-Zone {index % 5}",
+        'Classification': [index % 3, (index + 1) % 3],
+        'Confidence': [0.9, 0.8],
+        'bbox': [10, 20, 100, 80, 200, 30, 90, 70],
+        'Image_Class': index % 3,
+        'Resized_Path': f"https://drive.google.com/uc?id=resized{index}",
+        'Annotated_Path': '',
+    } for index in range(count)]
+
+
+def upload_sequential(records, columns, url):
+    """
+    The original upload: one `requests.post` per record, without a session, errors only printed.
+    """
+    succeeded = 0
+    for record in records:
+        row_data = {col: to_python_value(record[col]) for col in columns}
+        try:
+            res = requests.post(url, json=row_data, headers={'Content-Type': 'application/json'})
+            res.raise_for_status()
+            succeeded += 1
+        except requests.exceptions.RequestException as e:
+            print("Error:", e)
+    return succeeded
+
+
+def run_benchmark(records=200, latency=0.02, failure_rate=0.0, workers=(1, 8, 16)):
+    """
+    Time the original upload and the BackendClient uploads against fresh stand-in servers.
+
+    Returns:
+    - results: Dictionary with, per variant, the seconds, records per second, successes,
+               requests received by the server and duplicates it ignored.
+    """
+    rows = synthetic_records(records)
+    results = {}
+
+    with BackendServer(latency=latency, failure_rate=failure_rate) as server:
+        start = time.perf_counter()
+        succeeded = upload_sequential(rows, COLUMNS, server.create_image_url)
+        seconds = time.perf_counter() - start
+        results['sequential'] = {'seconds': seconds, 'records_per_second': records / seconds, 'succeeded': succeeded,
+                                 'requests': server.requests_count, 'duplicates': server.duplicates}
+
+    for max_workers in workers:
+        with BackendServer(latency=latency, failure_rate=failure_rate) as server, \
+                BackendClient(max_workers=max_workers, backoff=0.05) as client:
+            start = time.perf_counter()
+            report = upload_records(rows, COLUMNS, server.create_image_url, client)
+            seconds = time.perf_counter() - start
+            summary = summarize_report(report)
+            results[f'client_{max_workers}'] = {'seconds': seconds, 'records_per_second': records / seconds,
+                                                'succeeded': summary['succeeded'], 'requests': server.requests_count,
+                                                'duplicates': server.duplicates}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds the stand-in takes per request')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 16])
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.records, args.latency, args.failure_rate, args.workers)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,96 @@
+import argparse
+import json
+import time
+import cv2
+import numpy as np
+from Benchmark_SAM_Profiles import synthetic_field
+from Database_Data import add_features, scale_bboxes
+from Image_Downloader import decode_image, decode_reduced_image
+from Masks_Generation import upscale_masks
+
+"""
+Decode time and memory of full-resolution vs reduced-resolution JPEG decoding.
+
+For each image size and working resolution it records the decode time per image, the decoded
+image size in MB, and how far the leaf boxes found on the reduced image land from the boxes of
+the original image once mapped back with `scale_bboxes` (in original pixels).
+
+    python Benchmark_Decode.py [--sizes 4000x3000 1600x1200] [--max-sides 2048 1024 512] [--repeats 5]
+"""
+
+
+def time_decode(decode, jpeg_bytes, repeats):
+    """
+    Median seconds of `decode(jpeg_bytes)` over `repeats` runs, and its last result.
+    """
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = decode(jpeg_bytes)
+        seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds)), result
+
+
+def bbox_error(masks, shape, scale):
+    """
+    Largest difference, in original pixels, between the leaf boxes and the boxes of the same
+    leaves on an image reduced by `scale`, mapped back to the original.
+    """
+    if scale == 1.0 or not masks:
+        return 0.0
+    reduced = upscale_masks(masks, shape, 1 / scale)
+    original = np.array(add_features(masks)[0], dtype=np.float64)
+    mapped = np.array(scale_bboxes(add_features(reduced)[0], scale), dtype=np.float64)
+    return float(np.max(np.abs(original - mapped)))
+
+
+def run_benchmark(sizes=((3000, 4000), (1200, 1600)), max_sides=(2048, 1024, 512), repeats=5, quality=90):
+    """
+    Time the decoding of a synthetic field JPEG of each size, in full and at each working resolution.
+
+    Returns:
+    - results: Dictionary with, per '<width>x<height>' size, the 'full' decode and each
+               'max_side_<n>' decode: seconds, MB, decoded shape, scale, speedup, memory ratio
+               and bbox error.
+    """
+    results = {}
+    for size in sizes:
+        image, masks = synthetic_field(0, size)
+        jpeg_bytes = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+        full_seconds, full = time_decode(decode_image, jpeg_bytes, repeats)
+        run = {'full': {'seconds': full_seconds, 'mb': full.nbytes / 2 ** 20, 'shape': list(full.shape)}}
+        for max_side in max_sides:
+            seconds, (reduced, scale) = time_decode(lambda data: decode_reduced_image(data, max_side), jpeg_bytes, repeats)
+            run[f'max_side_{max_side}'] = {
+                'seconds': seconds,
+                'mb': reduced.nbytes / 2 ** 20,
+                'shape': list(reduced.shape),
+                'scale': scale,
+                'speedup': full_seconds / seconds if seconds else None,
+                'memory_ratio': full.nbytes / reduced.nbytes,
+                'max_bbox_error_pixels': bbox_error(masks, reduced.shape, scale),
+            }
+        results[f"{size[1]}x{size[0]}"] = run
+    return results
+
+
+def parse_size(value):
+    width, height = (int(part) for part in value.lower().split('x'))
+    return height, width
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[(3000, 4000), (1200, 1600)], help='Image sizes, as <width>x<height>')
+    parser.add_argument('--max-sides', type=int, nargs='+', default=[2048, 1024, 512])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.sizes, args.max_sides, args.repeats)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
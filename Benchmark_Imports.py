@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+Cold-start benchmark of the scheduler's imports.
+
+Each scenario imports a set of modules in a fresh interpreter and records the import time,
+the whole process time and the peak RSS, plus which heavy ML stacks ended up imported.
+The "nothing_new" scenario is what main.py imports before it knows whether there is data.
+
+    python Benchmark_Imports.py [--repeats 5] [--output results.json] [--baseline previous.json]
+"""
+
+SCENARIOS = {
+    # Polling the unchecked folder, when no new folder is found
+    'nothing_new': ['Paths', 'Drive_listing', 'Drive_authentication', 'Scheduler'],
+    # Every processing stage, with the ML stacks still deferred
+    'pipeline': ['Paths', 'Drive_listing', 'Drive_authentication', 'Local_Cache', 'Image_Downloader',
+                 'Masks_Generation', 'Model', 'Database_Data', 'Endpoint_data', 'Pipeline'],
+    # The deferred ML stacks themselves, for reference
+    'ml_stacks': ['tensorflow', 'segment_anything'],
+}
+
+HEAVY_MODULES = ('tensorflow', 'torch', 'segment_anything', 'matplotlib', 'bs4', 'pydrive')
+
+CHILD_CODE = """
+import json, resource, sys, time
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+seconds = time.perf_counter() - start
+print(json.dumps({
+    'import_seconds': seconds,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'heavy_modules': sorted(name for name in %r if name in sys.modules),
+}))
+""" % (HEAVY_MODULES,)
+
+
+def measure_scenario(modules, repeats=5):
+    """
+    Import the modules in `repeats` fresh interpreters.
+
+    Args:
+    - modules: List of module names to import.
+    - repeats: Number of fresh interpreters to run.
+
+    Returns:
+    - result: Dictionary with the median import time, process time and peak RSS, and the heavy
+              modules imported, or with an 'error' if the imports failed.
+    """
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', CHILD_CODE] + modules, capture_output=True, text=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        process_seconds = time.perf_counter() - start
+        if completed.returncode != 0:
+            return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'}
+        run = json.loads(completed.stdout.strip().splitlines()[-1])
+        run['process_seconds'] = process_seconds
+        runs.append(run)
+
+    return {
+        'import_seconds': statistics.median(run['import_seconds'] for run in runs),
+        'process_seconds': statistics.median(run['process_seconds'] for run in runs),
+        'max_rss_mb': statistics.median(run['max_rss_mb'] for run in runs),
+        'heavy_modules': runs[-1]['heavy_modules'],
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    """
+    List the metrics that got worse than the baseline by more than `tolerance` (relative).
+
+    Returns:
+    - regressions: List of human-readable regression descriptions.
+    """
+    regressions = []
+    for scenario, result in results.items():
+        previous = baseline.get(scenario)
+        if not previous or 'error' in result or 'error' in previous:
+            continue
+        for metric in ('import_seconds', 'max_rss_mb'):
+            if result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{scenario}.{metric}: {previous[metric]:.3f} -> {result[metric]:.3f}")
+        added = set(result['heavy_modules']) - set(previous['heavy_modules'])
+        if added:
+            regressions.append(f"{scenario}.heavy_modules: now imports {sorted(added)}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS))
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Results JSON of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {name: measure_scenario(SCENARIOS[name], args.repeats) for name in (args.scenario or SCENARIOS)}
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression)
+        raise SystemExit(1 if regressions else 0)
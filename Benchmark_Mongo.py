@@ -0,0 +1,126 @@
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+import pymongo
+from Database_Data import MongoSink, dataframe_to_documents
+from Local_Standins import MockMongoClient
+
+"""
+Throughput of the MongoDB writes of the pipeline results.
+
+Compares the original write (documents built with `iterrows`, one `insert_many`) with MongoSink
+(column-wise conversion, unordered chunks, inserted or upserted on 'Image_Path'). Runs against an
+in-memory mongomock by default, or a real server with --uri.
+
+    python Benchmark_Mongo.py [--rows 2000] [--chunk-size 500 1000 5000] [--uri mongodb://localhost:27017]
+"""
+
+COLUMNS = ['Image_Path', 'PeriodOfDiseaesId', 'Classification', 'Confidence', 'bbox', 'Image_Class', 'Resized_Path', 'Annotated_Path']
+
+
+def synthetic_dataframe(count, seed=0):
+    """
+    DataFrame shaped like the pipeline results: arrays of predictions, confidences and boxes per image.
+    """
+    rng = np.random.default_rng(seed)
+    leaves = rng.integers(1, 8, size=count)
+    return pd.DataFrame({
+        'Image_Path': [f"https://drive.google.com/uc?id=image{index}" for index in range(count)],
+        'PeriodOfDiseaesId': [f"period-Zone {index % 5}" for index in range(count)],
+        'Classification': [rng.integers(0, 3, size=n) for n in leaves],
+        'Confidence': [rng.random(n).astype(np.float32) for n in leaves],
+        'bbox': [rng.integers(0, 1600, size=4 * n) for n in leaves],
+        'Image_Class': rng.integers(0, 3, size=count),
+        'Resized_Path': [f"https://drive.google.com/uc?id=resized{index}" for index in range(count)],
+        'Annotated_Path': [''] * count,
+    })
+
+
+def iterrows_documents(df, columns):
+    """
+    The original conversion: documents built row by row with `iterrows`.
+    """
+    documents = []
+    for _, row in df.iterrows():
+        document = {}
+        for col in columns:
+            value = row[col]
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif isinstance(value, np.generic):
+                value = value.item()
+            document[col] = value
+        documents.append(document)
+    return documents
+
+
+def make_client(uri):
+    if uri:
+        return pymongo.MongoClient(uri)
+    return MockMongoClient()
+
+
+def run_benchmark(rows=2000, chunk_sizes=(500, 1000, 5000), uri=None, db_name='benchmark'):
+    """
+    Time the original write and MongoSink writes of the same DataFrame into fresh collections.
+
+    Conversion and write are timed apart: mongomock has no real indexes, so each upsert scans the
+    collection and its write times only mean something against a real server. Each upserting
+    variant writes the DataFrame twice; the second write is a rerun, which must leave the
+    collection with one document per image.
+
+    Returns:
+    - results: Dictionary with, per variant, the conversion and write seconds, rows per second
+               and the documents in the collection.
+    """
+    df = synthetic_dataframe(rows)
+    client = make_client(uri)
+    database = client[db_name]
+    results = {}
+
+    def timed(function, *args):
+        start = time.perf_counter()
+        value = function(*args)
+        return value, time.perf_counter() - start
+
+    documents, convert_seconds = timed(iterrows_documents, df, COLUMNS)
+    database.drop_collection('iterrows')
+    _, write_seconds = timed(database['iterrows'].insert_many, documents)
+    results['iterrows'] = {'convert_seconds': convert_seconds, 'write_seconds': write_seconds,
+                           'rows_per_second': rows / (convert_seconds + write_seconds),
+                           'documents': database['iterrows'].count_documents({})}
+
+    variants = [(f'insert_{chunk_size}', chunk_size, None) for chunk_size in chunk_sizes]
+    variants += [(f'upsert_{chunk_size}', chunk_size, 'Image_Path') for chunk_size in chunk_sizes]
+    for name, chunk_size, upsert_key in variants:
+        database.drop_collection(name)
+        sink = MongoSink(None, db_name, name, chunk_size=chunk_size, upsert_key=upsert_key, client=client)
+        documents, convert_seconds = timed(dataframe_to_documents, df, COLUMNS)
+        _, write_seconds = timed(sink.write, documents)
+        results[name] = {'convert_seconds': convert_seconds, 'write_seconds': write_seconds,
+                         'rows_per_second': rows / (convert_seconds + write_seconds)}
+        if upsert_key is not None:
+            results[name]['rerun_seconds'] = timed(sink.write_dataframe, df, COLUMNS)[1]
+        results[name]['documents'] = database[name].count_documents({})
+
+    for name in list(results):
+        database.drop_collection(name)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--chunk-size', type=int, nargs='+', default=[500, 1000, 5000])
+    parser.add_argument('--uri', help='Connection string of a MongoDB server (default is an in-memory mongomock)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.rows, args.chunk_size, args.uri)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,313 @@
+import argparse
+import json
+import os
+import platform
+import time
+import cv2
+import numpy as np
+import requests
+from Backend_Client import BackendClient
+from Benchmark_SAM_Profiles import synthetic_field
+from Database_Data import MongoSink, add_features, scale_bboxes
+from Drive_authentication import list_folder_images, parse_image_name
+from Drive_publishing import DrivePublisher, render_thumbnail
+from Mask_Encoding import to_python_value
+from Image_Downloader import ImageDownloader
+from Local_Standins import BackendServer, FakeDriveService, ImageServer, MockMongoClient
+from Masks_Generation import SAM_PROFILES, MaskEngine, get_sam_profile, filter_masks, deduplicate_masks, get_masked_leaves, upscale_masks
+from Paths import get_sam_checkpoint_path
+from Scheduler import Mongo_Cols
+
+"""
+End-to-end benchmark of the processing stages on synthetic field images, offline.
+
+A folder of synthetic field pictures named Zone_<n>_<time>.jpg is served by local stand-ins of
+Drive (listing, media downloads, uploads), the backend and MongoDB (see Local_Standins.py), and
+each stage runs over the whole folder on its own so it can be timed separately:
+
+    download -> generate_masks -> filter_masks -> deduplicate_masks -> get_masked_leaves -> predict_labels -> upload
+
+The upload stage is the thumbnail uploads, the create_image calls and the Mongo write, also
+reported one by one. Without the SAM checkpoint of the profile, SAM runs with untrained
+weights (same cost, no usable masks); --truth-masks skips SAM and feeds the drawn leaves
+to the later stages instead. Without --model, an untrained EfficientNetB3 stands in for the
+classifier, which has the same cost as the trained one.
+
+    python Benchmark_Pipeline.py [--folder-sizes 4 16] [--resolutions 800x600 1600x1200] [--output results.json]
+    python Benchmark_Pipeline.py --truth-masks --baseline previous.json
+"""
+
+# Metrics compared with a baseline, per stage
+COMPARED_METRICS = ('seconds_per_item',)
+
+
+def synthetic_folder(count, size, folder_id='benchmark-folder', zones=5, seed=0):
+    """
+    Build a Drive folder of synthetic field pictures.
+
+    Args:
+    - count: Number of images.
+    - size: (height, width) of the images.
+    - folder_id: Id of the folder the images are in.
+    - zones: Number of zones the images are spread over.
+    - seed: Random seed of the first image.
+
+    Returns:
+    - files: List of file metadata dictionaries, named Zone_<n>_<time>.jpg.
+    - contents: Dictionary mapping file ids to JPEG bytes.
+    - leaf_masks: Dictionary mapping file ids to the masks of the drawn leaves.
+    """
+    files, contents, leaf_masks = [], {}, {}
+    for index in range(count):
+        image, masks = synthetic_field(seed + index, size)
+        file_id = f"image{index}"
+        name = f"Zone_{index % zones + 1}_{8 + index // 60:02d}-{index % 60:02d}-00.jpg"
+        contents[file_id] = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes()
+        files.append({'id': file_id, 'name': name, 'mimeType': 'image/jpeg', 'parents': [folder_id],
+                      'modifiedTime': '2024-01-01T00:00:00.000Z', 'md5Checksum': f"{seed}-{index}"})
+        leaf_masks[file_id] = masks
+    return files, contents, leaf_masks
+
+
+def stage_result(seconds, items):
+    """
+    Timing of a stage: total seconds, items processed, and the derived rates.
+    """
+    return {
+        'seconds': seconds,
+        'items': items,
+        'items_per_second': items / seconds if seconds else None,
+        'seconds_per_item': seconds / items if items else None,
+    }
+
+
+def load_mask_engine(profile, checkpoint=None, points_per_batch=None):
+    """
+    Mask engine of a SAM profile, with untrained weights if the checkpoint is missing.
+
+    SAM holds the full-resolution logits of `points_per_batch` x 3 masks at once, so lowering
+    it bounds its peak memory (e.g. to fit next to TensorFlow on a small machine).
+    """
+    model_type, max_side, generator_kwargs = get_sam_profile(profile)
+    if points_per_batch is not None:
+        generator_kwargs['points_per_batch'] = points_per_batch
+    checkpoint = checkpoint or get_sam_checkpoint_path(model_type)
+    if not os.path.exists(checkpoint):
+        print(f"{checkpoint} not found: SAM runs with untrained weights.")
+        checkpoint = None
+    return MaskEngine(checkpoint, model_type, max_side=max_side, compact=True, **generator_kwargs).load()
+
+
+def load_classifier(model_path=None, batch_size=64):
+    """
+    ClassificationEngine of the trained model, or of an untrained EfficientNetB3 stand-in.
+    """
+    from Model import ClassificationEngine, load_classifier_model
+    if model_path:
+        model = load_classifier_model(model_path)
+    else:
+        import tensorflow as tf
+        model = tf.keras.applications.EfficientNetB3(weights=None, classes=3, input_shape=(224, 224, 3))
+    engine = ClassificationEngine(model, batch_size)
+    # Trace the compiled call once per padded batch size (8, 16, ... batch_size), outside the timings
+    size = 8
+    while True:
+        engine.predict(np.zeros((min(size, batch_size), 224, 224, 3), dtype=np.float32))
+        if size >= batch_size:
+            break
+        size *= 2
+    return engine
+
+
+def run_folder(files, contents, leaf_masks, mask_engine, classifier, workers=8, decode_max_side=None, deduplicate=True):
+    """
+    Run every stage over a folder, one stage after the other, against fresh stand-ins.
+
+    Args:
+    - files: File metadata of the folder, from `synthetic_folder`.
+    - contents: JPEG bytes of the files.
+    - leaf_masks: Masks of the drawn leaves, used instead of SAM if `mask_engine` is None.
+    - mask_engine: MaskEngine, or None to skip SAM.
+    - classifier: ClassificationEngine.
+    - workers: Download and upload concurrency.
+    - decode_max_side: Optional working resolution the images are decoded at.
+    - deduplicate: Drop the duplicate masks of the same leaf before cropping.
+
+    Returns:
+    - stages: Dictionary with the `stage_result` of each stage.
+    """
+    stages = {}
+    folder_url = f"https://drive.google.com/drive/folders/{files[0]['parents'][0]}?usp=drive_link"
+    drive = FakeDriveService(files, contents)
+
+    with ImageServer(contents) as image_server, \
+            ImageDownloader(session=requests.Session(), max_workers=workers, prefetch=workers, media_url=image_server.media_url,
+                            max_side=decode_max_side) as downloader:
+        start = time.perf_counter()
+        listed = list_folder_images(folder_url, None, service=drive)
+        downloaded = [(file, image, scale) for file, image, scale in downloader.iterate(listed) if image is not None]
+        stages['download'] = stage_result(time.perf_counter() - start, len(downloaded))
+    images = [(file, image) for file, image, _ in downloaded]
+    scales = [scale for _, _, scale in downloaded]
+    del downloaded
+
+    if mask_engine is None:
+        # The drawn leaves are in original-image pixels
+        masks_list = [leaf_masks[file['id']] if scale == 1.0 else upscale_masks(leaf_masks[file['id']], image.shape, 1 / scale)
+                      for (file, image), scale in zip(images, scales)]
+        stages['generate_masks'] = {'skipped': True}
+    else:
+        start = time.perf_counter()
+        masks_list = [mask_engine.generate(image) for _, image in images]
+        stages['generate_masks'] = stage_result(time.perf_counter() - start, len(images))
+
+    start = time.perf_counter()
+    filtered = [filter_masks(masks) for masks in masks_list]
+    stages['filter_masks'] = stage_result(time.perf_counter() - start, sum(len(masks) for masks in masks_list))
+    del masks_list
+
+    if deduplicate:
+        start = time.perf_counter()
+        keeps = [deduplicate_masks(masks_b) for _, masks_b in filtered]
+        stages['deduplicate_masks'] = stage_result(time.perf_counter() - start, sum(len(keep) for keep in keeps))
+        stages['deduplicate_masks']['kept'] = int(sum(keep.sum() for keep in keeps))
+        filtered = [([mask for mask, kept in zip(filtered_masks, keep) if kept], [mask_info for mask_info, kept in zip(masks_b, keep) if kept])
+                    for (filtered_masks, masks_b), keep in zip(filtered, keeps)]
+
+    start = time.perf_counter()
+    test_gens = [get_masked_leaves(filtered_masks, image, [mask_info['bbox'] for mask_info in masks_b])
+                 for (_, image), (filtered_masks, masks_b) in zip(images, filtered)]
+    leaves = sum(len(test_gen) for test_gen in test_gens)
+    stages['get_masked_leaves'] = stage_result(time.perf_counter() - start, leaves)
+
+    start = time.perf_counter()
+    results = classifier.classify_many(test_gens)
+    stages['predict_labels'] = stage_result(time.perf_counter() - start, leaves)
+    del test_gens
+
+    records = []
+    for (file, image), scale, (_, masks_b), (confidences, predictions, detected_disease) in zip(images, scales, filtered, results):
+        location, _ = parse_image_name(file['name'])
+        bbox = scale_bboxes(add_features(masks_b)[0], scale)
+        records.append({
+            'Image_Path': f"https://drive.google.com/file/d/{file['id']}/view?usp=drive_link",
+            'PeriodOfDiseaesId': f"period-{location}", 'Classification': predictions, 'Confidence': confidences,
+            'bbox': bbox, 'Image_Class': detected_disease, 'Resized_Jpeg': render_thumbnail(image), 'Annotated_Path': '',
+        })
+    del images, filtered
+
+    upload_seconds = 0.0
+    with DrivePublisher(service_factory=lambda: drive, max_workers=workers) as publisher:
+        start = time.perf_counter()
+        uploads = ((record.pop('Resized_Jpeg'), 'resized-folder', f"resized_image_{index}.jpg") for index, record in enumerate(records))
+        for record, (ok, link, error) in zip(records, publisher.upload_many(uploads)):
+            record['Resized_Path'] = link if ok else ''
+        stages['upload_drive'] = stage_result(time.perf_counter() - start, len(records))
+        upload_seconds += stages['upload_drive']['seconds']
+
+    with BackendServer() as backend_server, BackendClient(max_workers=workers) as client:
+        start = time.perf_counter()
+        payloads = [{col: to_python_value(record[col]) for col in Mongo_Cols} for record in records]
+        succeeded = sum(result['ok'] for result in client.post_many(backend_server.create_image_url, payloads))
+        stages['upload_backend'] = stage_result(time.perf_counter() - start, len(records))
+        stages['upload_backend']['succeeded'] = succeeded
+        upload_seconds += stages['upload_backend']['seconds']
+
+    sink = MongoSink(None, 'benchmark', 'images', client=MockMongoClient())
+    start = time.perf_counter()
+    sink.write_records(records, Mongo_Cols)
+    stages['upload_mongo'] = stage_result(time.perf_counter() - start, len(records))
+    upload_seconds += stages['upload_mongo']['seconds']
+
+    stages['upload'] = stage_result(upload_seconds, len(records))
+    return stages
+
+
+def run_benchmark(folder_sizes=(4, 16), resolutions=((600, 800), (1200, 1600)), truth_masks=False, profile='fast',
+                  checkpoint=None, model_path=None, workers=8, points_per_batch=None, decode_max_side=None, deduplicate=True):
+    """
+    Run the stages for every folder size and image resolution.
+
+    Returns:
+    - results: Dictionary with the 'environment' and configuration of the run, and under 'runs'
+               the stage timings of each '<images>x<width>x<height>' run.
+    """
+    mask_engine = None if truth_masks else load_mask_engine(profile, checkpoint, points_per_batch)
+    classifier = load_classifier(model_path)
+
+    results = {
+        'environment': {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'config': {'sam': 'truth' if truth_masks else profile, 'classifier': model_path or 'untrained EfficientNetB3',
+                   'workers': workers, 'decode_max_side': decode_max_side, 'deduplicate': deduplicate},
+        'runs': {},
+    }
+    for size in resolutions:
+        for count in folder_sizes:
+            files, contents, leaf_masks = synthetic_folder(count, size)
+            name = f"{count}x{size[1]}x{size[0]}"
+            results['runs'][name] = run_folder(files, contents, leaf_masks, mask_engine, classifier, workers, decode_max_side, deduplicate)
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance=0.2, min_seconds=0.05):
+    """
+    List the stages that got slower than in the baseline by more than `tolerance` (relative).
+    Stages that took less than `min_seconds` in both runs are too noisy to compare.
+
+    Returns:
+    - regressions: List of human-readable regression descriptions.
+    """
+    regressions = []
+    for run, stages in results['runs'].items():
+        previous_stages = baseline.get('runs', {}).get(run, {})
+        for stage, result in stages.items():
+            previous = previous_stages.get(stage)
+            if not previous or max(result.get('seconds', 0), previous.get('seconds', 0)) < min_seconds:
+                continue
+            for metric in COMPARED_METRICS:
+                if result.get(metric) is None or previous.get(metric) is None:
+                    continue
+                if result[metric] > previous[metric] * (1 + tolerance):
+                    regressions.append(f"{run}.{stage}.{metric}: {previous[metric]:.4f} -> {result[metric]:.4f}")
+    return regressions
+
+
+def parse_resolution(value):
+    width, height = (int(part) for part in value.lower().split('x'))
+    return height, width
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--folder-sizes', type=int, nargs='+', default=[4, 16], help='Number of images per folder')
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+', default=[(600, 800), (1200, 1600)],
+                        help='Image resolutions, as <width>x<height>')
+    parser.add_argument('--truth-masks', action='store_true', help='Skip SAM and use the masks of the drawn leaves')
+    parser.add_argument('--sam-profile', choices=sorted(SAM_PROFILES), default='fast')
+    parser.add_argument('--checkpoint', help='SAM checkpoint (default is the one of the profile backbone)')
+    parser.add_argument('--points-per-batch', type=int, help='Override the SAM points per batch of the profile (bounds its memory)')
+    parser.add_argument('--model', help='Trained Keras classifier (default is an untrained EfficientNetB3)')
+    parser.add_argument('--workers', type=int, default=8, help='Download and upload concurrency')
+    parser.add_argument('--decode-max-side', type=int, help='Decode the images at this working resolution (longest side)')
+    parser.add_argument('--keep-duplicate-masks', action='store_true', help='Skip the deduplication of the leaf masks')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Results JSON of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='Ignore stages faster than this in both runs')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.folder_sizes, args.resolutions, args.truth_masks, args.sam_profile,
+                            args.checkpoint, args.model, args.workers, args.points_per_batch, args.decode_max_side,
+                            not args.keep_duplicate_masks)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance, args.min_seconds)
+        for regression in regressions:
+            print("Regression:", regression)
+        raise SystemExit(1 if regressions else 0)
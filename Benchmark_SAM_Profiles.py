@@ -0,0 +1,209 @@
+import argparse
+import glob
+import json
+import time
+import cv2
+import numpy as np
+from Mask_Encoding import CompactMask
+from Masks_Generation import SAM_PROFILES, MaskEngine, get_sam_profile, filter_masks
+from Paths import get_sam_checkpoint_path
+
+"""
+Benchmark of the SAM speed profiles against the original configuration ('accurate').
+
+For each profile it records the segmentation time per image, and the recall of the reference
+masks: the fraction of the masks produced by the reference profile that are matched by a mask
+of the profile with an IoU of at least --iou. Recall is reported for all masks and for the leaf
+masks kept by `filter_masks`, which are the ones the classifier sees.
+
+    python Benchmark_SAM_Profiles.py --images "samples/*.jpg" [--profile fast] [--output results.json]
+    python Benchmark_SAM_Profiles.py --synthetic 4
+"""
+
+
+def synthetic_field(seed=0, size=(1200, 1600), leaves=12):
+    """
+    Draw a synthetic field picture: green leaf-shaped ellipses on a textured soil background,
+    along with the masks of the visible part of each leaf.
+
+    Args:
+    - seed: Random seed.
+    - size: (height, width) of the image.
+    - leaves: Number of leaves drawn.
+
+    Returns:
+    - image: RGB uint8 image.
+    - leaf_masks: List of CompactMask, one per leaf still visible, with SAM-like metadata.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = size
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[...] = (110, 80, 55)
+    image = cv2.add(image, rng.integers(0, 30, size=image.shape, dtype=np.uint8))
+    # Later leaves cover earlier ones; the label map keeps the leaf visible at each pixel
+    labels = np.zeros((height, width), dtype=np.uint8)
+    for index in range(leaves):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(width // 20, width // 8)), int(rng.integers(height // 30, height // 12)))
+        color = (int(rng.integers(20, 80)), int(rng.integers(120, 200)), int(rng.integers(20, 80)))
+        angle = float(rng.uniform(0, 180))
+        cv2.ellipse(image, center, axes, angle, 0, 360, color, -1)
+        cv2.ellipse(labels, center, axes, angle, 0, 360, index % 255 + 1, -1)
+
+    leaf_masks = []
+    for index in range(1, min(leaves, 255) + 1):
+        segmentation = labels == index
+        if segmentation.any():
+            leaf_masks.append(CompactMask.from_dense(segmentation, metadata={'predicted_iou': 0.95, 'stability_score': 0.97}))
+    return image, leaf_masks
+
+
+def synthetic_field_image(seed=0, size=(1200, 1600), leaves=12):
+    """
+    Draw a synthetic field picture, see `synthetic_field`.
+
+    Returns:
+    - image: RGB uint8 image.
+    """
+    return synthetic_field(seed, size, leaves)[0]
+
+
+def load_images(patterns):
+    """
+    Read the images matching the glob patterns, in RGB.
+    """
+    images = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            image = cv2.imread(path)
+            if image is not None:
+                images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return images
+
+
+def mask_iou(mask_a, bbox_a, mask_b, bbox_b):
+    """
+    IoU of two boolean masks, only comparing the union of their bounding boxes.
+    """
+    x0 = int(min(bbox_a[0], bbox_b[0]))
+    y0 = int(min(bbox_a[1], bbox_b[1]))
+    x1 = int(max(bbox_a[0] + bbox_a[2], bbox_b[0] + bbox_b[2])) + 1
+    y1 = int(max(bbox_a[1] + bbox_a[3], bbox_b[1] + bbox_b[3])) + 1
+    window_a = mask_a[y0:y1, x0:x1]
+    window_b = mask_b[y0:y1, x0:x1]
+    union = np.count_nonzero(window_a | window_b)
+    return np.count_nonzero(window_a & window_b) / union if union else 0.0
+
+
+def boxes_overlap(bbox_a, bbox_b):
+    return (bbox_a[0] <= bbox_b[0] + bbox_b[2] and bbox_b[0] <= bbox_a[0] + bbox_a[2] and
+            bbox_a[1] <= bbox_b[1] + bbox_b[3] and bbox_b[1] <= bbox_a[1] + bbox_a[3])
+
+
+def mask_recall(reference_masks, masks, iou_threshold=0.5):
+    """
+    Count the reference masks matched by at least one mask with an IoU above the threshold.
+
+    Args:
+    - reference_masks: List of SAM masks of the reference configuration.
+    - masks: List of SAM masks to evaluate.
+    - iou_threshold: Minimum IoU for a match.
+
+    Returns:
+    - matched: Number of reference masks matched.
+    - total: Number of reference masks.
+    """
+    matched = 0
+    for reference in reference_masks:
+        for mask_info in masks:
+            if not boxes_overlap(reference['bbox'], mask_info['bbox']):
+                continue
+            if mask_iou(reference['segmentation'], reference['bbox'], mask_info['segmentation'], mask_info['bbox']) >= iou_threshold:
+                matched += 1
+                break
+    return matched, len(reference_masks)
+
+
+def run_profile(profile, images):
+    """
+    Segment the images with a profile, timing each image (the model load is not timed).
+
+    Returns:
+    - masks_list: List with the masks of each image.
+    - seconds: List with the segmentation time of each image.
+    """
+    model_type, max_side, generator_kwargs = get_sam_profile(profile)
+    engine = MaskEngine(get_sam_checkpoint_path(model_type), model_type, max_side=max_side, **generator_kwargs).load()
+    masks_list, seconds = [], []
+    for image in images:
+        start = time.perf_counter()
+        masks_list.append(engine.generate(image))
+        seconds.append(time.perf_counter() - start)
+    return masks_list, seconds
+
+
+def benchmark_profiles(images, profiles, reference='accurate', iou_threshold=0.5):
+    """
+    Benchmark each profile against the reference profile.
+
+    Args:
+    - images: List of RGB images.
+    - profiles: List of profile names to benchmark.
+    - reference: Name of the profile whose masks are the ground truth.
+    - iou_threshold: Minimum IoU for a mask to count as recalled.
+
+    Returns:
+    - results: Dictionary with, per profile, the mean / total seconds per image, the mean mask
+               count, and the recall of all reference masks and of the reference leaf masks.
+    """
+    reference_masks, reference_seconds = run_profile(reference, images)
+    reference_leaves = [filter_masks(masks)[1] for masks in reference_masks]
+
+    results = {}
+    for profile in profiles:
+        if profile == reference:
+            masks_list, seconds = reference_masks, reference_seconds
+        else:
+            masks_list, seconds = run_profile(profile, images)
+
+        all_matched = all_total = leaf_matched = leaf_total = 0
+        for masks, expected, expected_leaves in zip(masks_list, reference_masks, reference_leaves):
+            matched, total = mask_recall(expected, masks, iou_threshold)
+            all_matched += matched
+            all_total += total
+            # Leaves are matched against the leaves the profile itself keeps
+            matched, total = mask_recall(expected_leaves, filter_masks(masks)[1], iou_threshold)
+            leaf_matched += matched
+            leaf_total += total
+
+        results[profile] = {
+            'seconds_per_image': float(np.mean(seconds)) if seconds else 0.0,
+            'total_seconds': float(np.sum(seconds)),
+            'speedup': float(np.sum(reference_seconds) / np.sum(seconds)) if np.sum(seconds) else 0.0,
+            'masks_per_image': float(np.mean([len(masks) for masks in masks_list])) if masks_list else 0.0,
+            'mask_recall': all_matched / all_total if all_total else None,
+            'leaf_recall': leaf_matched / leaf_total if leaf_total else None,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', action='append', default=[], help='Glob pattern of the images to segment')
+    parser.add_argument('--synthetic', type=int, default=0, help='Number of synthetic field images to add')
+    parser.add_argument('--profile', action='append', choices=sorted(SAM_PROFILES))
+    parser.add_argument('--reference', choices=sorted(SAM_PROFILES), default='accurate')
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    images = load_images(args.images) + [synthetic_field_image(seed) for seed in range(args.synthetic)]
+    if not images:
+        parser.error("No images: give --images and/or --synthetic")
+
+    results = benchmark_profiles(images, args.profile or sorted(SAM_PROFILES), args.reference, args.iou)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from Benchmark_SAM_Profiles import load_images, mask_recall, synthetic_field
+from Masks_Generation import MaskEngine, filter_masks, get_sam_profile
+from Paths import get_sam_checkpoint_path
+from Vegetation_Prompts import PromptedMaskEngine, vegetation_mask, vegetation_prompts
+
+"""
+SAM automatic mask generation vs SAM prompted inside the vegetation only.
+
+For each engine it records the seconds per image, the masks and leaves (masks kept by
+`filter_masks`) per image, the prompts decoded per image, and the recall of the leaves of the
+automatic generator. On synthetic field images it also records the recall of the true leaves.
+The vegetation prefilter itself (color index, components, prompt points) is timed apart.
+
+Both engines share one SAM model. Without the SAM checkpoint of the profile, SAM runs with
+untrained weights: the timings and prompt counts still hold, the masks and recalls don't.
+
+    python Benchmark_Vegetation.py [--synthetic 2] [--images 'field/*.jpg'] [--profile fast] [--method exg hsv]
+"""
+
+
+def load_engines(profile, checkpoint=None, points_per_batch=None, methods=('exg',), prompts=('points', 'boxes')):
+    """
+    Automatic and prompted engines of a SAM profile, sharing the same SAM model.
+
+    Returns:
+    - engines: Dictionary mapping 'automatic' and '<method>-<prompt>' to the engines.
+    """
+    model_type, max_side, generator_kwargs = get_sam_profile(profile)
+    if points_per_batch is not None:
+        generator_kwargs['points_per_batch'] = points_per_batch
+    checkpoint = checkpoint or get_sam_checkpoint_path(model_type)
+    if not os.path.exists(checkpoint):
+        print(f"{checkpoint} not found: SAM runs with untrained weights.")
+        checkpoint = None
+
+    from segment_anything import SamPredictor
+    automatic = MaskEngine(checkpoint, model_type, max_side=max_side, compact=True, **generator_kwargs).load()
+    engines = {'automatic': automatic}
+    for method in methods:
+        for prompt in prompts:
+            engine = PromptedMaskEngine(checkpoint, model_type, max_side=max_side, compact=True, method=method, prompt=prompt, **generator_kwargs)
+            engine.predictor = SamPredictor(automatic.mask_generator.predictor.model)
+            engines[f"{method}-{prompt}"] = engine
+    return engines
+
+
+def automatic_prompts(engine):
+    """
+    Prompts decoded per image by SamAutomaticMaskGenerator: its point grid, on every crop of every layer.
+    """
+    return sum(len(grid) * 4 ** layer for layer, grid in enumerate(engine.mask_generator.point_grids))
+
+
+def prefilter_statistics(images, methods, points_per_side):
+    """
+    Time the vegetation prefilter alone, and count the prompts it gives.
+    """
+    statistics = {}
+    for method in methods:
+        seconds, fractions, points, boxes = [], [], [], []
+        for image in images:
+            start = time.perf_counter()
+            mask = vegetation_mask(image, method)
+            image_points, image_boxes = vegetation_prompts(mask, points_per_side)
+            seconds.append(time.perf_counter() - start)
+            fractions.append(float(mask.mean()))
+            points.append(len(image_points))
+            boxes.append(len(image_boxes))
+        statistics[method] = {'seconds_per_image': float(np.mean(seconds)), 'vegetation_fraction': float(np.mean(fractions)),
+                              'points_per_image': float(np.mean(points)), 'boxes_per_image': float(np.mean(boxes))}
+    return statistics
+
+
+def run_benchmark(images, truth=None, profile='fast', checkpoint=None, points_per_batch=None, methods=('exg',),
+                  prompts=('points', 'boxes'), iou_threshold=0.5):
+    """
+    Segment the images with the automatic generator and each prompted engine.
+
+    Args:
+    - images: List of RGB images.
+    - truth: Optional list with the true leaf masks of each image (synthetic images).
+    - profile: SAM profile giving the backbone, point grid, thresholds and input size.
+    - checkpoint: SAM checkpoint (default is the one of the profile backbone).
+    - points_per_batch: Optional override of the profile points per batch.
+    - methods: Vegetation indices to try.
+    - prompts: Prompt kinds to try, 'points' and / or 'boxes'.
+    - iou_threshold: Minimum IoU for a leaf to count as recalled.
+
+    Returns:
+    - results: Dictionary with the prefilter statistics, and per engine the seconds, masks, leaves
+               and prompts per image, the recall of the automatic leaves and of the true leaves.
+    """
+    engines = load_engines(profile, checkpoint, points_per_batch, methods, prompts)
+    points_per_side = engines['automatic'].generator_kwargs.get('points_per_side', 32)
+    results = {'images': len(images), 'profile': profile, 'prefilter': prefilter_statistics(images, methods, points_per_side)}
+
+    leaves = {}
+    for name, engine in engines.items():
+        seconds, mask_counts, leaves[name], decoded = [], [], [], []
+        for image in images:
+            decoded_before = getattr(engine, 'decoder_prompts', 0)
+            start = time.perf_counter()
+            masks = engine.generate(image)
+            seconds.append(time.perf_counter() - start)
+            mask_counts.append(len(masks))
+            leaves[name].append(filter_masks(masks)[1])
+            decoded.append(engine.decoder_prompts - decoded_before if name != 'automatic' else automatic_prompts(engine))
+        results[name] = {
+            'seconds_per_image': float(np.mean(seconds)),
+            'masks_per_image': float(np.mean(mask_counts)),
+            'leaves_per_image': float(np.mean([len(image_leaves) for image_leaves in leaves[name]])),
+            'prompts_per_image': float(np.mean(decoded)),
+        }
+
+    for name in engines:
+        results[name]['speedup'] = results['automatic']['seconds_per_image'] / results[name]['seconds_per_image']
+        matched, total = np.sum([mask_recall(reference, image_leaves, iou_threshold)
+                                 for reference, image_leaves in zip(leaves['automatic'], leaves[name])], axis=0)
+        results[name]['automatic_leaf_recall'] = float(matched / total) if total else None
+        if truth is not None:
+            matched, total = np.sum([mask_recall(reference, image_leaves, iou_threshold)
+                                     for reference, image_leaves in zip(truth, leaves[name])], axis=0)
+            results[name]['true_leaf_recall'] = float(matched / total) if total else None
+    return results
+
+
+def parse_size(value):
+    width, height = (int(part) for part in value.lower().split('x'))
+    return height, width
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', action='append', default=[], help='Glob pattern of the images to segment')
+    parser.add_argument('--synthetic', type=int, default=0, help='Number of synthetic field images (used if no --images)')
+    parser.add_argument('--size', type=parse_size, default=(600, 800), help='Size of the synthetic images, as <width>x<height>')
+    parser.add_argument('--profile', choices=['accurate', 'balanced', 'fast'], default='fast')
+    parser.add_argument('--checkpoint', help='SAM checkpoint (default is the one of the profile backbone)')
+    parser.add_argument('--points-per-batch', type=int, help='Override the SAM points per batch of the profile (bounds its memory)')
+    parser.add_argument('--method', nargs='+', choices=['exg', 'hsv'], default=['exg'])
+    parser.add_argument('--prompt', nargs='+', choices=['points', 'boxes'], default=['points', 'boxes'])
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    images, truth = load_images(args.images), None
+    if not images:
+        fields = [synthetic_field(seed, args.size) for seed in range(args.synthetic or 2)]
+        images, truth = [image for image, _ in fields], [leaf_masks for _, leaf_masks in fields]
+
+    results = run_benchmark(images, truth, args.profile, args.checkpoint, args.points_per_batch, args.method, args.prompt, args.iou)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
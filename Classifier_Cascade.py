@@ -0,0 +1,320 @@
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+from Paths import get_paths
+from Model import CLASS_NAMES, split_predictions, load_classifier_model
+from Model_Export import TFLiteClassifier, load_sample_set, time_per_leaf
+
+"""
+Two-stage leaf classifier: a cheap color / texture model first, EfficientNet-B3 only where needed.
+
+Most leaves of a field are healthy. The first stage, a softmax regression on color and texture
+features of the prepared leaf images, classifies every leaf; the leaves it finds Healthy with
+enough confidence stop there, and only the others (disease suspects and unsure leaves) go
+through the B3 model. The probabilities of both stages are merged back in leaf order, so the
+output is the same as the B3 model's.
+
+    python Classifier_Cascade.py train --samples samples.npz [--output first_stage.npz]
+    python Classifier_Cascade.py evaluate --samples samples.npz [--thresholds 0.8 0.9 0.95]
+
+Sample sets are prepared leaf images with their true classes, see `Model_Export.save_sample_set`.
+"""
+
+HUE_BINS = 12
+HEALTHY_CLASS = next(number for number, name in CLASS_NAMES.items() if name == 'Healthy')
+
+
+def get_first_stage_path(model_path):
+    """
+    Path of the first-stage model trained for a Keras model file.
+
+    Args:
+    - model_path: Path to the Keras (.h5) model file.
+
+    Returns:
+    - first_stage_path: Path next to the Keras model.
+    """
+    return f"{os.path.splitext(model_path)[0]}-first-stage.npz"
+
+
+def leaf_features(test_gen):
+    """
+    Color and texture features of prepared leaf images, measured on the leaf pixels only (the
+    leaves are drawn on a black background), on every other row and column, for a whole batch at once.
+
+    Args:
+    - test_gen: Array of prepared leaf images (N, height, width, 3), pixels in [0, 255].
+
+    Returns:
+    - features: Array (N, HUE_BINS + 7): the hue histogram of the leaf, the mean and spread of
+                its saturation and value, the fractions of yellow-brown and of dark pixels,
+                and the mean edge strength (lesion texture).
+    """
+    images = np.asarray(test_gen)[:, ::2, ::2]
+    count, height, width = images.shape[:3]
+    if count == 0:
+        return np.zeros((0, HUE_BINS + 7))
+
+    # The batch as one tall image, so OpenCV converts it in one call
+    pixels = np.clip(images, 0, 255).astype(np.uint8).reshape(count * height, width, 3)
+    hsv = cv2.cvtColor(pixels, cv2.COLOR_RGB2HSV).reshape(count, height * width, 3)
+    edges = np.abs(cv2.Laplacian(cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY), cv2.CV_32F)).reshape(count, height * width) / 255
+    leaf = pixels.reshape(count, height * width, 3).max(axis=2) > 0
+    leaf_pixels = np.maximum(leaf.sum(axis=1), 1)
+
+    def leaf_mean(values):
+        return (values * leaf).sum(axis=1) / leaf_pixels
+
+    hue = hsv[..., 0]
+    saturation = hsv[..., 1] / np.float32(255)
+    value = hsv[..., 2] / np.float32(255)
+    hue_bin = np.minimum(hue.astype(np.int64) * HUE_BINS // 180, HUE_BINS - 1)
+    histogram = np.bincount((np.arange(count)[:, None] * HUE_BINS + hue_bin)[leaf], minlength=count * HUE_BINS)
+    histogram = histogram.reshape(count, HUE_BINS) / leaf_pixels[:, None]
+
+    saturation_mean = leaf_mean(saturation)
+    value_mean = leaf_mean(value)
+    return np.column_stack([
+        histogram,
+        saturation_mean,
+        np.sqrt(np.maximum(leaf_mean(saturation ** 2) - saturation_mean ** 2, 0)),
+        value_mean,
+        np.sqrt(np.maximum(leaf_mean(value ** 2) - value_mean ** 2, 0)),
+        leaf_mean((hue < 20) & (saturation > 0.25)),  # Yellow to brown (hue below 40 degrees)
+        leaf_mean(value < 0.3),
+        leaf_mean(edges),
+    ])
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class LeafFeatureClassifier:
+    """
+    Softmax regression on `leaf_features`, the cheap first stage of the cascade.
+
+    It has the same `predict` as a Keras model (class probabilities, one row per leaf).
+
+    Args:
+    - weights: Array (features, classes).
+    - bias: Array (classes,).
+    - mean: Feature means, used to standardize the features.
+    - scale: Feature standard deviations, used to standardize the features.
+    - batch_size: Number of leaves whose features are computed at once.
+    """
+
+    def __init__(self, weights, bias, mean, scale, batch_size=64):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = np.asarray(bias, dtype=np.float64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.batch_size = batch_size
+
+    def features(self, test_gen):
+        chunks = [leaf_features(test_gen[start : start + self.batch_size]) for start in range(0, len(test_gen), self.batch_size)]
+        features = np.concatenate(chunks) if chunks else np.zeros((0, len(self.mean)))
+        return (features - self.mean) / self.scale
+
+    def predict(self, test_gen):
+        """
+        Class probabilities of a batch of prepared leaf images.
+
+        Args:
+        - test_gen: Array of prepared leaf images (N, height, width, 3).
+
+        Returns:
+        - preds: Array of class probabilities, one row per leaf.
+        """
+        return _softmax(self.features(test_gen) @ self.weights + self.bias).astype(np.float32)
+
+    @classmethod
+    def fit(cls, images, labels, classes=len(CLASS_NAMES), epochs=1000, learning_rate=0.5, l2=1e-3, batch_size=64):
+        """
+        Train the first stage on prepared leaf images, with full-batch gradient descent. Classes
+        are weighted by their inverse frequency, so the rare disease classes are not drowned by
+        the healthy leaves.
+
+        Args:
+        - images: Array of prepared leaf images.
+        - labels: Array with the true class of each image.
+        - classes: Number of classes.
+        - epochs: Number of gradient steps.
+        - learning_rate: Step size.
+        - l2: Weight decay.
+
+        Returns:
+        - classifier: Trained LeafFeatureClassifier.
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        untrained = cls(np.zeros((HUE_BINS + 7, classes)), np.zeros(classes), np.zeros(HUE_BINS + 7), np.ones(HUE_BINS + 7), batch_size)
+        features = untrained.features(images)
+        mean = features.mean(axis=0)
+        scale = np.where(features.std(axis=0) > 1e-6, features.std(axis=0), 1.0)
+        features = (features - mean) / scale
+
+        targets = np.eye(classes)[labels]
+        class_counts = np.maximum(np.bincount(labels, minlength=classes), 1)
+        sample_weights = (len(labels) / (classes * class_counts))[labels][:, None]
+        weights = np.zeros((features.shape[1], classes))
+        bias = np.zeros(classes)
+        for _ in range(epochs):
+            error = (_softmax(features @ weights + bias) - targets) * sample_weights / len(labels)
+            weights -= learning_rate * (features.T @ error + l2 * weights)
+            bias -= learning_rate * error.sum(axis=0)
+        return cls(weights, bias, mean, scale, batch_size)
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=self.bias, mean=self.mean, scale=self.scale)
+
+    @classmethod
+    def load(cls, path, batch_size=64):
+        with np.load(path) as data:
+            return cls(data['weights'], data['bias'], data['mean'], data['scale'], batch_size)
+
+
+class CascadeClassifier:
+    """
+    Leaf classifier running a cheap first stage on every leaf and the second stage (B3) only on
+    the leaves the first stage does not confidently find Healthy.
+
+    It has the same `predict` and `classify_many` as ClassificationEngine, so it can be used by
+    the pipeline; the confidences of early-exited leaves are the first stage's.
+
+    Args:
+    - first_stage: Classifier with a `predict`, e.g. LeafFeatureClassifier.
+    - second_stage: ClassificationEngine or TFLiteClassifier of the B3 model.
+    - threshold: Minimum first-stage Healthy probability for a leaf to skip the second stage.
+
+    `leaves` and `escalated` count the leaves classified so far, and those sent to the second stage.
+    """
+
+    def __init__(self, first_stage, second_stage, threshold=0.9):
+        self.first_stage = first_stage
+        self.second_stage = second_stage
+        self.threshold = threshold
+        self.batch_size = getattr(second_stage, 'batch_size', 64)
+        self.leaves = 0
+        self.escalated = 0
+
+    def predict(self, test_gen):
+        """
+        Class probabilities of a batch of prepared leaf images, with the same output as `model.predict`.
+
+        Args:
+        - test_gen: Array of prepared leaf images (N, height, width, 3).
+
+        Returns:
+        - preds: Array of class probabilities, one row per leaf.
+        """
+        preds = self.first_stage.predict(test_gen)
+        escalate = ~((np.argmax(preds, axis=1) == HEALTHY_CLASS) & (preds[:, HEALTHY_CLASS] >= self.threshold))
+        if escalate.any():
+            preds[escalate] = self.second_stage.predict(test_gen[escalate])
+        self.leaves += len(preds)
+        self.escalated += int(escalate.sum())
+        return preds
+
+    def classify_many(self, test_gens):
+        """
+        Classify the leaves of several images together and scatter the results back per image.
+
+        Args:
+        - test_gens: List with the prepared leaf images of each image.
+
+        Returns:
+        - results: List with the (confidences, predictions, detected_disease) of each image,
+                   as returned by `predict_labels`.
+        """
+        return split_predictions(self.predict(np.concatenate(test_gens)), test_gens)
+
+    def statistics(self):
+        """
+        Returns:
+        - statistics: Dictionary with the leaves classified, the leaves sent to the second
+                      stage, and the fraction of leaves passed through to it.
+        """
+        return {'leaves': self.leaves, 'escalated': self.escalated,
+                'pass_through_rate': self.escalated / self.leaves if self.leaves else None}
+
+
+def evaluate_cascade(first_stage, second_stage, images, labels=None, thresholds=(0.8, 0.9, 0.95), repeats=1):
+    """
+    Pass-through rate, latency and accuracy of the cascade against the second stage alone.
+
+    Args:
+    - first_stage: Trained first stage (e.g. LeafFeatureClassifier).
+    - second_stage: ClassificationEngine or TFLiteClassifier of the B3 model.
+    - images: Array of prepared leaf images.
+    - labels: Optional array of true classes.
+    - thresholds: First-stage Healthy probabilities to evaluate.
+    - repeats: Number of timed passes, see `Model_Export.time_per_leaf`.
+
+    Returns:
+    - report: Dictionary with the B3-only latency (and accuracy), and per threshold the fraction
+              of leaves passed to B3, the latency per leaf, the class agreement with B3 alone,
+              and with labels the accuracy, its change against B3 alone, and the diseased
+              leaves wrongly let out as healthy by the first stage.
+    """
+    b3_preds, b3_ms = time_per_leaf(second_stage.predict, images, repeats)
+    b3_classes = np.argmax(b3_preds, axis=1)
+    report = {'samples': int(len(images)), 'b3_ms_per_leaf': b3_ms}
+    if labels is not None:
+        report['b3_accuracy'] = float(np.mean(b3_classes == labels))
+
+    first_preds = first_stage.predict(images)
+    for threshold in thresholds:
+        cascade = CascadeClassifier(first_stage, second_stage, threshold)
+        preds, ms = time_per_leaf(cascade.predict, images, repeats)
+        classes = np.argmax(preds, axis=1)
+        result = {
+            'pass_through_rate': cascade.statistics()['pass_through_rate'],
+            'ms_per_leaf': ms,
+            'speedup': b3_ms / ms if ms else None,
+            'agreement_with_b3': float(np.mean(classes == b3_classes)),
+        }
+        if labels is not None:
+            result['accuracy'] = float(np.mean(classes == labels))
+            result['accuracy_change'] = result['accuracy'] - report['b3_accuracy']
+            exited = (np.argmax(first_preds, axis=1) == HEALTHY_CLASS) & (first_preds[:, HEALTHY_CLASS] >= threshold)
+            result['missed_diseased'] = int(np.sum(exited & (labels != HEALTHY_CLASS)))
+        report[f"threshold_{threshold}"] = result
+    return report
+
+
+if __name__ == '__main__':
+    _, _, Model_path, *_ = get_paths()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='Train the first stage on a labelled sample set')
+    train_parser.add_argument('--model', default=Model_path, help='Keras model the first stage is stored next to')
+    train_parser.add_argument('--samples', required=True)
+    train_parser.add_argument('--output')
+
+    evaluate_parser = subparsers.add_parser('evaluate', help='Pass-through rate, latency and accuracy against B3 alone')
+    evaluate_parser.add_argument('--model', default=Model_path)
+    evaluate_parser.add_argument('--tflite', help='Use this TFLite export as the second stage instead of the Keras model')
+    evaluate_parser.add_argument('--first-stage')
+    evaluate_parser.add_argument('--samples', required=True)
+    evaluate_parser.add_argument('--thresholds', type=float, nargs='+', default=[0.8, 0.9, 0.95])
+    evaluate_parser.add_argument('--repeats', type=int, default=1, help='Timed passes over the samples')
+
+    args = parser.parse_args()
+    images, labels = load_sample_set(args.samples)
+    if args.command == 'train':
+        if labels is None:
+            parser.error("The sample set has no labels")
+        output = args.output or get_first_stage_path(args.model)
+        LeafFeatureClassifier.fit(images, labels).save(output)
+        print(output)
+    else:
+        from Model import ClassificationEngine
+        first_stage = LeafFeatureClassifier.load(args.first_stage or get_first_stage_path(args.model))
+        second_stage = TFLiteClassifier(args.tflite) if args.tflite else ClassificationEngine(load_classifier_model(args.model))
+        print(json.dumps(evaluate_cascade(first_stage, second_stage, images, labels, args.thresholds, args.repeats), indent=2))
@@ -1,11 +1,12 @@
-from Libraries import * 
+import pymongo
+from Mask_Encoding import to_python_value
 
 def add_features(annotations):
     """
     Extract bounding box information from annotations.
 
     Args:
-    - annotations: List of dictionaries containing annotation information.
+    - annotations: List of dictionaries (or CompactMask) containing annotation information.
 
     Returns:
     - bbox_list: List of bounding box information [x1, y1, w, h, x2, y2, w, h, ...] for each detected region.
@@ -21,44 +22,182 @@ def add_features(annotations):
     return bbox_list, edited, treated
 
 
+def scale_bboxes(bbox_list, scale):
+    """
+    Map a flat bounding box list from a reduced-resolution image back to the original image.
+
+    Args:
+    - bbox_list: Bounding box list [x1, y1, w, h, x2, y2, w, h, ...], as returned by `add_features`.
+    - scale: Size of the reduced image relative to the original (e.g. 0.25).
+
+    Returns:
+    - bbox_list: Bounding box list in original-image pixels.
+    """
+    if scale == 1.0:
+        return bbox_list
+    return [int(round(value / scale)) for value in bbox_list]
+
+
+
+# Clients shared by every caller in this process, keyed by connection string
+_mongo_clients = {}
+
+
+def get_mongo_client(connection_string):
+    """
+    Return the process-wide MongoClient of a connection string, creating it if needed.
+
+    MongoClient keeps its own connection pool and is thread-safe, so one per process is enough.
+
+    Args:
+    - connection_string: Connection string for MongoDB.
+
+    Returns:
+    - client: pymongo.MongoClient instance.
+    """
+    if connection_string not in _mongo_clients:
+        _mongo_clients[connection_string] = pymongo.MongoClient(connection_string)
+    return _mongo_clients[connection_string]
+
+
+def column_to_bson(column):
+    """
+    Converts a DataFrame column (or any sequence) to a list of BSON-ready values.
+
+    Numeric columns are converted in one `tolist` call; only object columns (lists, arrays,
+    strings) are looked at value by value.
+
+    Args:
+    - column: pandas Series, numpy array or list.
+
+    Returns:
+    - values: List of plain Python values.
+    """
+    dtype = getattr(column, 'dtype', None)
+    if dtype is not None and dtype != object:
+        return column.tolist()
+    return [to_python_value(value) for value in column]
 
-def send_to_mongodb(df, columns_to_send, db_name, collection_name, connection_string):
+
+def dataframe_to_documents(df, columns):
+    """
+    Builds the MongoDB documents of the selected columns of a DataFrame, column by column.
+
+    Args:
+    - df: DataFrame containing the data.
+    - columns: List of column names to put in the documents.
+
+    Returns:
+    - documents: List of dictionaries, one per row.
+    """
+    values = [column_to_bson(df[column]) for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def records_to_documents(records, columns):
+    """
+    Builds the MongoDB documents of the selected keys of per-image records.
+
+    Args:
+    - records: Iterable of per-image dictionaries.
+    - columns: List of keys to put in the documents.
+
+    Returns:
+    - documents: List of dictionaries.
+    """
+    return [{column: to_python_value(record[column]) for column in columns} for record in records]
+
+
+class MongoSink:
+    """
+    Bulk writer of documents to a MongoDB collection.
+
+    Documents are written in unordered chunks of `chunk_size`. With an `upsert_key`, each
+    document replaces the one with the same key (inserted if there is none), so writing the
+    same results again leaves a single copy.
+
+    Args:
+    - connection_string: Connection string for MongoDB. Ignored if `client` is given.
+    - db_name: Name of the MongoDB database.
+    - collection_name: Name of the MongoDB collection.
+    - chunk_size: Number of documents per bulk request.
+    - upsert_key: Field identifying a document (default is 'Image_Path'), or None to only insert.
+    - client: Optional MongoClient to use (e.g. a mongomock client).
+    """
+
+    def __init__(self, connection_string, db_name, collection_name, chunk_size=1000, upsert_key='Image_Path', client=None):
+        if client is None:
+            client = get_mongo_client(connection_string)
+        self.collection = client[db_name][collection_name]
+        self.chunk_size = chunk_size
+        self.upsert_key = upsert_key
+        if upsert_key is not None:
+            # Without an index each upsert scans the collection
+            try:
+                self.collection.create_index(upsert_key)
+            except Exception as e:
+                print("Error:", e)
+
+    def write(self, documents):
+        """
+        Write documents to the collection.
+
+        Args:
+        - documents: List of BSON-ready dictionaries.
+
+        Returns:
+        - counts: Dictionary with the number of documents 'inserted', 'upserted' and 'modified'.
+        """
+        counts = {'inserted': 0, 'upserted': 0, 'modified': 0}
+        for start in range(0, len(documents), self.chunk_size):
+            chunk = documents[start:start + self.chunk_size]
+            if self.upsert_key is None:
+                result = self.collection.insert_many(chunk, ordered=False)
+                counts['inserted'] += len(result.inserted_ids)
+                continue
+
+            requests = [pymongo.ReplaceOne({self.upsert_key: document[self.upsert_key]}, document, upsert=True)
+                        if self.upsert_key in document else pymongo.InsertOne(document)
+                        for document in chunk]
+            result = self.collection.bulk_write(requests, ordered=False)
+            counts['inserted'] += result.inserted_count
+            counts['upserted'] += result.upserted_count
+            counts['modified'] += result.modified_count
+        return counts
+
+    def write_dataframe(self, df, columns):
+        """
+        Write the selected columns of a DataFrame, one document per row.
+        """
+        return self.write(dataframe_to_documents(df, columns))
+
+    def write_records(self, records, columns):
+        """
+        Write the selected keys of per-image records, one document per record.
+        """
+        return self.write(records_to_documents(records, columns))
+
+
+def send_to_mongodb(df, columns_to_send, db_name, collection_name, connection_string, chunk_size=1000):
     """
     Sends selected columns from a DataFrame to a MongoDB database.
 
+    The documents are upserted on 'Image_Path' in unordered bulk chunks, over the process-wide client.
+
     Args:
     - df: DataFrame containing the data.
     - columns_to_send: List of column names to send to MongoDB.
     - db_name: Name of the MongoDB database.
     - collection_name: Name of the MongoDB collection.
     - connection_string: Connection string for MongoDB.
+    - chunk_size: Number of documents per bulk request.
 
     Returns:
-    - None
-    """
-    # Establish a connection to the MongoDB server using the connection string
-    client = pymongo.MongoClient(connection_string)
-
-    # Select the database
-    db = client[db_name]
-
-    # Select the collection
-    collection = db[collection_name]
-
-    # Convert DataFrame to dictionary with selected columns
-    data_to_send = []
-    for index, row in df.iterrows():
-        record = {}
-        for column in columns_to_send:
-            value = row[column]
-            # Convert NumPy arrays to lists
-            if isinstance(value, np.ndarray):
-                value = value.tolist()
-            record[column] = value
-        data_to_send.append(record)
-
-    # Insert data into the collection
-    collection.insert_many(data_to_send)
+    - counts: Number of documents inserted, upserted and modified, see `MongoSink.write`.
+    """
+    upsert_key = 'Image_Path' if 'Image_Path' in columns_to_send else None
+    sink = MongoSink(connection_string, db_name, collection_name, chunk_size, upsert_key)
+    return sink.write_dataframe(df, columns_to_send)
 
 
 # def send_to_mongodb(df, columns_to_send, db_name, collection_name):
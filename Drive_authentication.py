@@ -1,5 +1,12 @@
-from Libraries import * 
-from Model import annotate_image
+import datetime
+import re
+from io import BytesIO
+import cv2
+from googleapiclient.discovery import build
+from googleapiclient.http import MediaIoBaseUpload
+from google.oauth2.service_account import Credentials as ServiceAccountCredentials
+from Image_Downloader import ImageDownloader
+from Drive_listing import list_children
 
 def authenticate_with_google(credentials_file):
     """
@@ -41,13 +48,15 @@ def extract_folder_id(drive_url):
         return None
 
 
-def get_recent_folder_link(drive_url, credentials):
+def get_recent_folder_link(drive_url, credentials, cursor=None, service=None):
     """
     Extracts the most recently updated Google Drive folder's name, download link, and modified date.
 
     Args:
     - drive_url: URL of the Google Drive folder.
     - credentials: Credentials object obtained from the OAuth 2.0 authorization flow.
+    - cursor: Optional ListingCursor; only subfolders modified after its position are considered.
+    - service: Drive API service object, built from the credentials if not given.
 
     Returns:
     - recent_folder_info: A tuple containing the most recently updated folder's name, download link, and modified date.
@@ -55,16 +64,15 @@ def get_recent_folder_link(drive_url, credentials):
     """
     try:
         # Build the service using the credentials
-        service = build('drive', 'v3', credentials=credentials)
+        if service is None:
+            service = build('drive', 'v3', credentials=credentials)
 
         # Extract folder ID from the drive URL
         folder_id = extract_folder_id(drive_url)
 
-        # List subfolders in the folder
-        results = service.files().list(q=f"'{folder_id}' in parents and mimeType='application/vnd.google-apps.folder'", 
-                                       fields='files(id, name, modifiedTime, webViewLink)', 
-                                       orderBy='name desc').execute()
-        subfolders = results.get('files', [])
+        # List subfolders in the folder, across all result pages
+        subfolders = list_children(service, folder_id, fields='id, name, modifiedTime, webViewLink',
+                                   folders_only=True, order_by='name desc', cursor=cursor)
 
         # Check if any subfolders were found
         if subfolders:
@@ -82,6 +90,97 @@ def get_recent_folder_link(drive_url, credentials):
         return None
 
 
+def parse_image_name(image_name):
+    """
+    Split an image name of the form Zone_<n>_<time>.jpg into its location and time.
+
+    Args:
+    - image_name: Name of the image file in Google Drive.
+
+    Returns:
+    - location: Zone name, e.g. "Zone 3".
+    - time: Time the image was taken, without the file extension.
+    """
+    name_parts = image_name.split('_')
+    location = "Zone " + name_parts[1]
+    time = name_parts[2].split('.')[0]  # Removing the file extension
+    return location, time
+
+
+def list_folder_images(folder_url, credentials, service=None):
+    """
+    Lists the image files of the given Google Drive folder, across all result pages.
+
+    Args:
+    - folder_url: URL of the Google Drive folder containing images.
+    - credentials: Credentials object obtained from the OAuth 2.0 authorization flow.
+    - service: Drive API service object, built from the credentials if not given.
+
+    Returns:
+    - files: List of file metadata dictionaries (id, name, modifiedTime, md5Checksum).
+    """
+    # Build the service using the credentials
+    if service is None:
+        service = build('drive', 'v3', credentials=credentials)
+
+    # Extract folder ID from the folder URL
+    folder_id = extract_folder_id(folder_url)
+
+    # List files in the folder
+    return list_children(service, folder_id, fields='id, name, modifiedTime, md5Checksum')
+
+
+def iterate_folder_images(folder_url, date, credentials, downloader=None, service=None):
+    """
+    Yields the images of the given Google Drive folder one at a time, so only a bounded
+    number of full-resolution images needs to be held in memory.
+
+    Args:
+    - folder_url: URL of the Google Drive folder containing images.
+    - date: Date for taking images
+    - credentials: Credentials object obtained from the OAuth 2.0 authorization flow.
+    - downloader: ImageDownloader used to fetch the images concurrently. A new one sharing
+                  the credentials is created (and closed at the end) if not given.
+    - service: Drive API service object used to list the folder, built from the credentials if not given.
+
+    Yields:
+    - record: Dictionary with the 'Image_Path', 'Image', 'Location', 'Date', 'Time', 'Cache_Key' and
+              'Scale' (size of 'Image' relative to the original, see `ImageDownloader`) of one image.
+    """
+    try:
+        files = list_folder_images(folder_url, credentials, service)
+    except Exception as e:
+        print("Error:", e)
+        return
+
+    owns_downloader = downloader is None
+    if owns_downloader:
+        downloader = ImageDownloader(credentials)
+
+    try:
+        for file, img, scale in downloader.iterate(files):
+            if img is None:
+                continue
+            try:
+                location, time = parse_image_name(file['name'])
+            except Exception as e:
+                print("Error:", e)
+                continue
+
+            yield {
+                'Image_Path': f"https://drive.google.com/file/d/{file['id']}/view?usp=drive_link",
+                'Image': img,
+                'Location': location,
+                'Date': date,
+                'Time': time,
+                'Cache_Key': downloader.cache_key(file),
+                'Scale': scale,
+            }
+    finally:
+        if owns_downloader:
+            downloader.close()
+
+
 def Getting_Images_DataFrame(folder_url, date, credentials):
     """
     Extracts image data from the given Google Drive folder URL and returns a DataFrame.
@@ -94,44 +193,13 @@ def Getting_Images_DataFrame(folder_url, date, credentials):
     Returns:
     - df: DataFrame containing image paths, images, location, date, and time.
     """
+    # pandas is only needed here, so it is not imported on the polling path
+    import pandas as pd
+
     try:
-        # Build the service using the credentials
-        service = build('drive', 'v3', credentials=credentials)
+        images_data = list(iterate_folder_images(folder_url, date, credentials))
 
-        # Extract folder ID from the folder URL
-        folder_id = extract_folder_id(folder_url)
-
-        # List files in the folder
-        results = service.files().list(q=f"'{folder_id}' in parents", fields='files(id, name, modifiedTime)').execute()
-        files = results.get('files', [])
-
-        # Create a list to store image data
-        images_data = []
-        for file in files:
-            image_name = file['name']
-            download_link = f"https://drive.google.com/uc?id={file['id']}&export=download"
-            path_link = f"https://drive.google.com/file/d/{file['id']}/view?usp=drive_link"
-            modified_time = file['modifiedTime']
-
-            # Download the image
-            image_response = requests.get(download_link)
-            # Check if the image download was successful
-            if image_response.status_code == 200:
-                # Read the image bytes
-                image_bytes = BytesIO(image_response.content)
-                
-                # Open the image using PIL
-                img = Image.open(image_bytes)
-                img = np.array(img)
-                # Split image name into location and date
-                name_parts = image_name.split('_')
-                location = "Zone " + name_parts[1]
-                time = name_parts[2].split('.')[0]  # Removing the file extension
-
-                # Append image path and image itself to the list
-                images_data.append((path_link, img, location, date, time))
-
-        # Create a DataFrame from the list of tuples
+        # Create a DataFrame from the list of records
         df = pd.DataFrame(images_data, columns=['Image_Path', 'Image', 'Location', 'Date', 'Time'])
 
         return df
@@ -151,53 +219,83 @@ def upload_to_drive(service, image, folder_id, filename):
     - folder_id: ID of the folder in Google Drive to upload the image to.
     - filename: Name of the file in Google Drive.
 
+    Returns:
+    - Shareable link to the uploaded image.
+    """
+    img_byte_arr = cv2.imencode('.jpg', image)[1].tobytes()
+    return upload_jpeg_to_drive(service, img_byte_arr, folder_id, filename)
+
+
+def upload_jpeg_to_drive(service, jpeg_bytes, folder_id, filename):
+    """
+    Uploads an already encoded JPEG to Google Drive and returns its shareable link.
+    Appends the current date to the filename, as `upload_to_drive` does.
+
+    Args:
+    - service: Drive API service object.
+    - jpeg_bytes: JPEG file contents.
+    - folder_id: ID of the folder in Google Drive to upload the image to.
+    - filename: Name of the file in Google Drive.
+
     Returns:
     - Shareable link to the uploaded image.
     """
     current_date = datetime.datetime.now().strftime("%Y-%m-%d")
     unique_filename = f"{filename}_{current_date}.jpg"
-    img_byte_arr = cv2.imencode('.jpg', image)[1].tostring()
-    media_body = MediaIoBaseUpload(BytesIO(img_byte_arr), mimetype='image/jpeg', resumable=True)
+    # Thumbnails are a few KB: a simple multipart upload is one request, a resumable one two
+    media_body = MediaIoBaseUpload(BytesIO(jpeg_bytes), mimetype='image/jpeg', resumable=False)
     file_metadata = {'name': unique_filename, 'parents': [folder_id]}
     file = service.files().create(body=file_metadata, media_body=media_body, fields='id').execute()
     file_id = file['id']
     #return f'https://drive.google.com/uc?id={file_id}&export=download'
     return f"https://drive.google.com/file/d/{file_id}/view?usp=drive_link"
-    
 
-def upload_resized_images_to_drive(df, credentials, Resized_folder_id, Annotated_folder_id):
+
+def upload_resized_images_to_drive(df, credentials, Resized_folder_id, Annotated_folder_id, upload_annotated=False, max_workers=8):
     """
     Uploads resized images to Google Drive and returns their shareable links.
 
+    The uploads run concurrently (see Drive_publishing.DrivePublisher). Annotated images are
+    only rendered and uploaded when `upload_annotated` is set.
+
     Args:
     - df: DataFrame containing the images and their paths.
     - credentials: Credentials object obtained from the OAuth 2.0 authorization flow.
-    - folder_id: ID of the folder in Google Drive to upload the images to.
+    - Resized_folder_id: ID of the folder in Google Drive to upload the resized images to.
+    - Annotated_folder_id: ID of the folder in Google Drive to upload the annotated images to.
+    - upload_annotated: Also upload the images annotated with their detected leaves.
+    - max_workers: Maximum number of uploads in flight.
 
     Returns:
     - DataFrame with the shareable links to the uploaded images.
     """
-    # Build the Drive API service
-    service = build('drive', 'v3', credentials=credentials)
-    
-    # Resize images using lambda function
-    df['Resized_Image'] = df['Image'].apply(lambda image: cv2.resize(image, (80, 60)))
-
-    # Upload resized images and store their Drive links
-    df['Resized_Path'] = df.apply(lambda row: upload_to_drive(service, row['Resized_Image'], Resized_folder_id, f"resized_image_{row.name}.jpg"), axis=1)
-    
-    # Use apply along with a lambda function to apply annotate_image to each row
-    df['annotated_image'] = df.apply(lambda row: annotate_image(row['Image'], row['bbox'], row['Confidence'], row['Classification']), axis=1)
-
-    
-    # In case we want to save the images with their bounding boxes in the drive
-    # Upload annotated images and store their Drive links
-    #df['Annotated_Path'] = df.apply(lambda row: upload_to_drive(service, row['annotated_image'], Annotated_folder_id, f"annotated_image{row.name}.jpg"), axis=1)
-    
+    from Drive_publishing import DrivePublisher, render_thumbnail, render_annotated
+
+    with DrivePublisher(credentials, max_workers=max_workers) as publisher:
+        # Resize and upload the images, several at a time
+        thumbnails = ((render_thumbnail(image), Resized_folder_id, f"resized_image_{index}.jpg") for index, image in zip(df.index, df['Image']))
+        df['Resized_Path'] = _upload_links(publisher.upload_many(thumbnails))
+
+        # Annotated images are only drawn if they are uploaded
+        if upload_annotated:
+            annotated = ((render_annotated(row['Image'], row['bbox'], row['Confidence'], row['Classification']), Annotated_folder_id, f"annotated_image{index}.jpg")
+                         for index, row in df.iterrows())
+            df['Annotated_Path'] = _upload_links(publisher.upload_many(annotated))
+
     return df
 
 
-def move_folder(credentials, source_folder_link, target_folder_link):
+def _upload_links(outcomes):
+    # Link of each upload, None (and the error printed) for the failed ones
+    links = []
+    for ok, link, error in outcomes:
+        if not ok:
+            print("Error:", error)
+        links.append(link)
+    return links
+
+
+def move_folder(credentials, source_folder_link, target_folder_link, service=None):
     """
     Moves a folder from one location to another in Google Drive.
 
@@ -205,13 +303,15 @@ def move_folder(credentials, source_folder_link, target_folder_link):
     - credentials: Credentials object obtained from the OAuth 2.0 authorization flow.
     - source_folder_link: URL of the folder to be moved.
     - target_folder_link: URL of the target folder where the folder will be moved.
+    - service: Optional Drive API service object to use instead of building one.
 
     Returns:
     - True if the folder is successfully moved, False otherwise.
     """
     try:
         # Build the service using the credentials
-        service = build('drive', 'v3', credentials=credentials)
+        if service is None:
+            service = build('drive', 'v3', credentials=credentials)
         
         # Extract folder IDs from the source and target folder links
         source_folder_id = extract_folder_id(source_folder_link)
@@ -0,0 +1,126 @@
+import json
+import os
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+def iterate_files(service, q, fields='id, name, modifiedTime', order_by=None, page_size=1000):
+    """
+    Yields every file matching a Drive query, following `nextPageToken` through all result pages.
+
+    Args:
+    - service: Drive API service object (or any object with the same `files().list(...).execute()` interface).
+    - q: Drive search query.
+    - fields: Comma separated file fields to request; only these are returned.
+    - order_by: Optional Drive `orderBy` clause.
+    - page_size: Number of files requested per page.
+
+    Yields:
+    - file: File metadata dictionary.
+    """
+    page_token = None
+    while True:
+        kwargs = {'q': q, 'fields': f'nextPageToken, files({fields})', 'pageSize': page_size}
+        if order_by:
+            kwargs['orderBy'] = order_by
+        if page_token:
+            kwargs['pageToken'] = page_token
+
+        results = service.files().list(**kwargs).execute()
+        yield from results.get('files', [])
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return
+
+
+def list_all_files(service, q, fields='id, name, modifiedTime', order_by=None, page_size=1000):
+    """
+    Lists every file matching a Drive query, across all result pages.
+
+    Args:
+    - service: Drive API service object.
+    - q: Drive search query.
+    - fields: Comma separated file fields to request.
+    - order_by: Optional Drive `orderBy` clause.
+    - page_size: Number of files requested per page.
+
+    Returns:
+    - files: List of file metadata dictionaries.
+    """
+    return list(iterate_files(service, q, fields, order_by, page_size))
+
+
+class ListingCursor:
+    """
+    Local, persisted listing cursor: the last `modifiedTime` already handled in each Drive folder.
+
+    Listing with the cursor only enumerates files modified after that time, so periodic runs
+    don't re-list everything. The cursor is only moved forward by `advance`, which callers
+    should do once the files are fully processed.
+
+    Args:
+    - path: Path of the JSON file where the cursor is stored. Nothing is persisted if None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.positions = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.positions = json.load(f)
+            except (OSError, ValueError) as e:
+                print("Failed to read listing cursor:", e)
+
+    def get(self, folder_id):
+        """
+        Returns the last handled modifiedTime of the folder, or None if it was never listed.
+        """
+        return self.positions.get(folder_id)
+
+    def advance(self, folder_id, modified_time):
+        """
+        Moves the cursor of the folder forward to `modified_time` (never backwards) and saves it.
+
+        Args:
+        - folder_id: ID of the Google Drive folder.
+        - modified_time: RFC 3339 modifiedTime of the last handled file.
+        """
+        current = self.positions.get(folder_id)
+        # RFC 3339 timestamps returned by Drive are all UTC, so they compare as strings
+        if current is None or modified_time > current:
+            self.positions[folder_id] = modified_time
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.positions, f)
+        os.replace(tmp_path, self.path)
+
+
+def list_children(service, folder_id, fields='id, name, modifiedTime', folders_only=False, order_by=None, cursor=None):
+    """
+    Lists the children of a Drive folder across all pages, optionally only those changed since the cursor.
+
+    Args:
+    - service: Drive API service object.
+    - folder_id: ID of the Google Drive folder.
+    - fields: Comma separated file fields to request.
+    - folders_only: Only list subfolders.
+    - order_by: Optional Drive `orderBy` clause.
+    - cursor: Optional ListingCursor; only files modified after its position for this folder are listed.
+
+    Returns:
+    - files: List of file metadata dictionaries.
+    """
+    q = f"'{folder_id}' in parents"
+    if folders_only:
+        q += f" and mimeType='{FOLDER_MIME_TYPE}'"
+    since = cursor.get(folder_id) if cursor is not None else None
+    if since:
+        q += f" and modifiedTime > '{since}'"
+    return list_all_files(service, q, fields, order_by)
@@ -0,0 +1,114 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from Drive_authentication import upload_jpeg_to_drive
+from Model import annotate_image
+
+# Size (width, height) of the thumbnails uploaded for the backend
+THUMBNAIL_SIZE = (80, 60)
+
+
+def encode_jpeg(image):
+    """
+    Encode an image as JPEG bytes.
+
+    Args:
+    - image: Image array.
+
+    Returns:
+    - jpeg_bytes: The JPEG file contents.
+    """
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def render_thumbnail(image):
+    """
+    Resize an image to the thumbnail size and encode it as JPEG.
+    """
+    return encode_jpeg(cv2.resize(image, THUMBNAIL_SIZE))
+
+
+def render_annotated(image, bbox_list, confidences, predictions):
+    """
+    Draw the detected leaves on the image (see `annotate_image`) and encode it as JPEG.
+    """
+    return encode_jpeg(annotate_image(image, bbox_list, confidences, predictions))
+
+
+class DrivePublisher:
+    """
+    Concurrent uploader of small JPEG files (thumbnails, annotated images) to Google Drive.
+
+    Uploads are simple multipart uploads (one request each, no resumable session) run by a
+    bounded pool of threads, each with its own Drive service since the underlying HTTP
+    client is not thread-safe. Drive batch requests don't accept media uploads, so the
+    files are created one request each, but several at a time.
+
+    Args:
+    - credentials: Credentials object used to build the Drive services. Ignored if `service_factory` is given.
+    - service_factory: Optional function returning a new Drive service (e.g. a local stand-in).
+    - max_workers: Number of upload threads, and maximum number of uploads in flight.
+    """
+
+    def __init__(self, credentials=None, service_factory=None, max_workers=8):
+        if service_factory is None:
+            from googleapiclient.discovery import build
+            service_factory = lambda: build('drive', 'v3', credentials=credentials)
+        self.service_factory = service_factory
+        self.max_workers = max_workers
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='drive-upload')
+
+    def get_service(self):
+        """
+        Returns the Drive service of the calling thread, building it on first use.
+        """
+        if getattr(self.local, 'service', None) is None:
+            self.local.service = self.service_factory()
+        return self.local.service
+
+    def upload(self, jpeg_bytes, folder_id, filename):
+        """
+        Upload one JPEG file, in the calling thread.
+
+        Returns:
+        - Shareable link to the uploaded image.
+        """
+        return upload_jpeg_to_drive(self.get_service(), jpeg_bytes, folder_id, filename)
+
+    def _upload_outcome(self, jpeg_bytes, folder_id, filename):
+        try:
+            return True, self.upload(jpeg_bytes, folder_id, filename), None
+        except Exception as e:
+            return False, None, e
+
+    def upload_many(self, uploads):
+        """
+        Upload many JPEG files concurrently, with at most `max_workers` uploads in flight.
+
+        Args:
+        - uploads: Iterable of (jpeg_bytes, folder_id, filename).
+
+        Yields:
+        - (ok, link, error): Outcome of each upload, in order.
+        """
+        pending = deque()
+        for jpeg_bytes, folder_id, filename in uploads:
+            pending.append(self.executor.submit(self._upload_outcome, jpeg_bytes, folder_id, filename))
+            if len(pending) >= self.max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        """
+        Stops the upload threads.
+        """
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
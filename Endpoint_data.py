@@ -1,22 +1,44 @@
-from Libraries import * 
+import json
+from collections import Counter
+import requests
 from Model import map_numbers_to_classes
-def get_Endpoint_1_data(df):
+from Backend_Client import BackendClient, summarize_report
+from Mask_Encoding import to_python_value
+def update_zone_votes(zone_votes, location, image_class):
     """
-    Processes the input DataFrame to determine the majority vote for 'Image_Class' by 'Location' and maps
+    Adds one image's class to the running per-zone vote, so the zone majority can be
+    computed without keeping every image in a DataFrame.
+
+    Args:
+    - zone_votes: Dictionary mapping each location to a Counter of its image classes (updated in place).
+    - location: Location (zone name) of the image.
+    - image_class: Image classification of the image.
+
+    Returns:
+    - zone_votes: The updated dictionary.
+    """
+    zone_votes.setdefault(location, Counter())[image_class] += 1
+    return zone_votes
+
+
+def get_Endpoint_1_data_from_votes(zone_votes):
+    """
+    Determines the majority vote for 'Image_Class' of each zone from the running per-zone vote and maps
     these to their corresponding class names.
 
     Args:
-    - df: A pandas DataFrame containing the data to be processed.
+    - zone_votes: Dictionary mapping each location to a Counter of its image classes.
 
     Returns:
     - A dictionary with the zone names and their current disease class.
     """
-    # Group by 'Location' and determine the majority vote for 'Image_Class'
-    majority_class_per_location = df.groupby('Location')['Image_Class'].agg(lambda x: Counter(x).most_common(1)[0][0])
-    
+    # Zones are sorted by name, as a groupby on 'Location' would
+    locations = sorted(zone_votes)
+    majority_class_per_location = [zone_votes[location].most_common(1)[0][0] for location in locations]
+
     # Convert the majority class numbers to their corresponding class names
-    majority_class_names = map_numbers_to_classes(majority_class_per_location.tolist())
-    
+    majority_class_names = map_numbers_to_classes(majority_class_per_location)
+
     # Construct the output
     output = {
         "zones": [
@@ -24,30 +46,79 @@ def get_Endpoint_1_data(df):
                 "zone_name": f"{location}",
                 "current_disease": disease
             }
-            for location, disease in zip(majority_class_per_location.index, majority_class_names)
+            for location, disease in zip(locations, majority_class_names)
         ]
     }
-    
+
     return output
 
 
-def get_Period_ID(file, zone_periods_Endpoint_link):
+def get_Endpoint_1_data(df):
+    """
+    Processes the input DataFrame to determine the majority vote for 'Image_Class' by 'Location' and maps
+    these to their corresponding class names.
+
+    Args:
+    - df: A pandas DataFrame containing the data to be processed.
+
+    Returns:
+    - A dictionary with the zone names and their current disease class.
+    """
+    zone_votes = {}
+    for location, image_class in zip(df['Location'], df['Image_Class']):
+        update_zone_votes(zone_votes, location, image_class)
+
+    return get_Endpoint_1_data_from_votes(zone_votes)
+
+
+def get_Period_ID(file, zone_periods_Endpoint_link, client=None):
     """
     Sends a POST request to retrieve period IDs for the given file.
 
     Args:
     - file: The file content to be sent in the request body.
     - zone_periods_Endpoint_link: URL of the endpoint to which the POST request is sent.
+    - client: Optional BackendClient; the request then goes over its pooled session, with retries.
 
     Returns:
     - A list of period IDs extracted from the response.
     """
-    res = requests.post(
-        zone_periods_Endpoint_link,
-        json=file,
-    )
-    data =json.loads(res.content)
-    return(data['data']['periodIds'])
+    if client is None:
+        res = requests.post(
+            zone_periods_Endpoint_link,
+            json=file,
+        )
+        data =json.loads(res.content)
+        return(data['data']['periodIds'])
+
+    result = client.post_json(zone_periods_Endpoint_link, file)
+    if not result['ok']:
+        raise RuntimeError(f"Period IDs request failed after {result['attempts']} attempts: {result['error']}")
+    return result['data']['data']['periodIds']
+
+
+def get_zone_to_id_mapping(zones_output, ids):
+    """
+    Builds a mapping from zone numbers to their period IDs.
+
+    Args:
+    - zones_output: A dictionary containing zone names and their current disease classes.
+    - ids: A list of period IDs, in the same order as the zones.
+
+    Returns:
+    - A dictionary mapping each zone number to its period ID.
+    """
+    return {
+        extract_zone_number(zone['zone_name']): period_id
+        for zone, period_id in zip(zones_output['zones'], ids)
+    }
+
+
+def extract_zone_number(zone_name):
+    """
+    Extracts the zone number from a zone name such as "Zone 3".
+    """
+    return zone_name.split()[1]
 
 
 def add_period_ids(df, zones_output, ids):
@@ -62,21 +133,8 @@ def add_period_ids(df, zones_output, ids):
     Returns:
     - The DataFrame with added 'PeriodOfDiseaesId' column.
     """
-    # Create a mapping from zone names to IDs
-    zone_to_id_mapping = {
-        zone['zone_name']: period_id
-        for zone, period_id in zip(zones_output['zones'], ids)
-    }
-    
-    # Extract the zone number from the 'zone_name' for easier comparison with 'Location'
-    def extract_zone_number(zone_name):
-        return zone_name.split()[1]
-    
-    # Adjust the zone_to_id_mapping to use the zone numbers as keys
-    zone_to_id_mapping = {
-        extract_zone_number(zone_name): period_id
-        for zone_name, period_id in zone_to_id_mapping.items()
-    }
+    # Create a mapping from zone numbers to IDs
+    zone_to_id_mapping = get_zone_to_id_mapping(zones_output, ids)
     
     # Extract the zone number from the 'Location' column
     df['LocationNumber'] = df['Location'].apply(extract_zone_number)
@@ -90,7 +148,66 @@ def add_period_ids(df, zones_output, ids):
     return df
 
 
-def upload_data(df, columns, url):
+def add_period_ids_to_records(records, zones_output, ids):
+    """
+    Adds period IDs to per-image records based on zone names and their corresponding period IDs.
+
+    Args:
+    - records: List of per-image dictionaries with a 'Location' key (updated in place).
+    - zones_output: A dictionary containing zone names and their current disease classes.
+    - ids: A list of period IDs to be mapped to the records.
+
+    Returns:
+    - The records with an added 'PeriodOfDiseaesId' key.
+    """
+    zone_to_id_mapping = get_zone_to_id_mapping(zones_output, ids)
+    for record in records:
+        record['PeriodOfDiseaesId'] = zone_to_id_mapping.get(extract_zone_number(record['Location']))
+    return records
+
+
+def upload_records(records, columns, url, client=None):
+    """
+    Uploads per-image records to the specified URL, one POST request per record, several at a time.
+
+    Failed requests are retried with backoff by the BackendClient; the rows that still fail
+    are printed and reported, and the others are uploaded anyway.
+
+    Args:
+    - records: Iterable of mappings (dictionaries or DataFrame rows) containing the data to be uploaded.
+    - columns: A list of column names to be included in the payload.
+    - url: The endpoint URL to which the POST request will be sent to create image.
+    - client: Optional BackendClient to use (default is a new one, closed at the end).
+
+    Returns:
+    - report: List with one result per record: 'Image_Path', 'ok', 'status', 'attempts' and 'error'.
+    """
+    own_client = client is None
+    if own_client:
+        client = BackendClient()
+
+    # Create a dictionary with the specified columns, numpy values converted to lists / Python types
+    records = list(records)
+    payloads = ({col: to_python_value(record[col]) for col in columns} for record in records)
+
+    report = []
+    try:
+        for record, result in zip(records, client.post_many(url, payloads)):
+            if not result['ok']:
+                print(f"Upload of {record.get('Image_Path')} failed:", result['error'])
+            report.append({'Image_Path': record.get('Image_Path'), 'ok': result['ok'], 'status': result['status'],
+                           'attempts': result['attempts'], 'error': result['error']})
+    finally:
+        if own_client:
+            client.close()
+
+    summary = summarize_report(report)
+    if summary['failed']:
+        print(f"{summary['failed']} of {summary['sent']} records failed to upload.")
+    return report
+
+
+def upload_data(df, columns, url, client=None):
     """
     Uploads data from the DataFrame to the specified URL by sending a POST request for each row.
 
@@ -98,32 +215,9 @@ def upload_data(df, columns, url):
     - df: A pandas DataFrame containing the data to be uploaded.
     - columns: A list of column names to be included in the payload.
     - url: The endpoint URL to which the POST request will be sent to create image.
+    - client: Optional BackendClient to use.
 
     Returns:
-    - None
+    - report: Per-row upload report, see `upload_records`.
     """
-    
-    # Iterate over each row in the DataFrame
-    for _, row in df.iterrows():
-        # Create a dictionary with the specified columns
-        row_data = {col: row[col] for col in columns}
-        
-        # Convert numpy arrays to lists
-        for key, value in row_data.items():
-            if isinstance(value, np.ndarray):
-                row_data[key] = value.tolist()
-        
-        
-        # Send the dictionary as a JSON payload in a POST request
-        try:
-            headers = {'Content-Type': 'application/json'}
-            res = requests.post(url, json=row_data, headers=headers)
-            res.raise_for_status()  # Raise an exception for HTTP errors
-            data = res.json()
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-            print(f"Response content: {res.content}")
-        except requests.exceptions.RequestException as req_err:
-            print(f"Request exception occurred: {req_err}")
-        except ValueError as val_err:
-            print(f"Value error occurred: {val_err}")
+    return upload_records((row for _, row in df.iterrows()), columns, url, client)
@@ -0,0 +1,202 @@
+import threading
+from collections import deque
+from io import BytesIO
+import numpy as np
+import requests
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from Local_Cache import file_cache_key, reduced_cache_key
+
+# Drive v3 media endpoint, the same one `files().get_media` calls
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+
+
+def decode_image(image_bytes):
+    """
+    Decodes image bytes into a numpy array.
+
+    Args:
+    - image_bytes: Encoded image (e.g. JPEG) bytes.
+
+    Returns:
+    - img: The decoded image as a numpy array.
+    """
+    return np.array(Image.open(BytesIO(image_bytes)))
+
+
+def decode_reduced_image(image_bytes, max_side=None):
+    """
+    Decodes image bytes straight to a reduced working resolution.
+
+    JPEGs are decoded with libjpeg DCT scaling (PIL `draft`), which skips most of the decoding
+    work: the image comes out at the strongest 1/2, 1/4 or 1/8 reduction that keeps its longest
+    side at least `max_side`. Other formats are decoded in full, then reduced by an integer factor.
+
+    Args:
+    - image_bytes: Encoded image (e.g. JPEG) bytes.
+    - max_side: Minimum longest side of the decoded image, or None to decode at full resolution.
+
+    Returns:
+    - img: The decoded image as a numpy array.
+    - scale: Size of the decoded image relative to the original (1.0 at full resolution).
+    """
+    image = Image.open(BytesIO(image_bytes))
+    width, height = image.size
+    if max_side is None or max(width, height) <= max_side:
+        return np.array(image), 1.0
+
+    ratio = max_side / max(width, height)
+    image.draft(image.mode, (int(np.ceil(width * ratio)), int(np.ceil(height * ratio))))
+    factor = int(max(image.size) // max_side)
+    if factor > 1:
+        image = image.reduce(factor)
+    return np.array(image), image.size[0] / width
+
+
+class ImageDownloader:
+    """
+    Concurrent Google Drive image downloader.
+
+    Files are fetched over one pooled, authenticated session by a pool of worker threads,
+    which also decode them. `iterate` keeps at most `prefetch` images in flight ahead of
+    the consumer, so processing image N overlaps the download of images N+1..N+prefetch
+    while memory stays bounded.
+
+    Args:
+    - credentials: Credentials object used to authenticate the session. Ignored if `session` is given.
+    - session: requests.Session to use instead of an authorized Drive session (e.g. for a local stand-in).
+    - max_workers: Number of download/decode threads and pooled connections.
+    - prefetch: Maximum number of images downloaded ahead of the consumer.
+    - media_url: URL template of the file contents, with a {file_id} placeholder.
+    - timeout: Timeout in seconds of each download.
+    - cache: Optional ContentCache; images are read from it instead of downloaded when present,
+             and stored in it after decoding (see `cache_key`).
+    - max_side: Optional working resolution: images are decoded straight to a longest side of at
+                least `max_side` (see `decode_reduced_image`) instead of their full resolution.
+
+    `failures` counts the files that could not be downloaded or decoded so far.
+    """
+
+    def __init__(self, credentials=None, session=None, max_workers=8, prefetch=8, media_url=DRIVE_MEDIA_URL, timeout=120, cache=None,
+                 max_side=None):
+        if session is None:
+            session = AuthorizedSession(credentials) if credentials is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.session = session
+        self.max_workers = max_workers
+        self.prefetch = max(1, prefetch)
+        self.media_url = media_url
+        self.timeout = timeout
+        self.cache = cache
+        self.max_side = max_side
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='drive-download')
+
+    def fetch(self, file):
+        """
+        Downloads the contents of one file.
+
+        Args:
+        - file: File metadata dictionary with at least the 'id' key.
+
+        Returns:
+        - The file contents as bytes.
+        """
+        response = self.session.get(self.media_url.format(file_id=file['id']), timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def cache_key(self, file):
+        """
+        Cache key of the image of a file at the working resolution, also used for its masks.
+        """
+        key = file_cache_key(file)
+        if self.max_side is None:
+            return key
+        return reduced_cache_key(key, self.max_side)
+
+    def fetch_and_decode(self, file):
+        """
+        Downloads and decodes one image (or reads it from the cache), returning None instead of raising on failure.
+
+        Args:
+        - file: File metadata dictionary with at least the 'id' key.
+
+        Returns:
+        - img: The decoded image as a numpy array, or None if the download or decoding failed.
+        - scale: Size of the decoded image relative to the original image.
+        """
+        key = self.cache_key(file)
+        try:
+            if self.cache is not None and key is not None:
+                if self.max_side is None:
+                    img = self.cache.get_image(key)
+                    if img is not None:
+                        return img, 1.0
+                else:
+                    cached = self.cache.get_scaled_image(key)
+                    if cached is not None:
+                        return cached
+
+            img, scale = decode_reduced_image(self.fetch(file), self.max_side)
+        except Exception as e:
+            print(f"Failed to download {file.get('name', file['id'])}:", e)
+            with self.lock:
+                self.failures += 1
+            return None, 1.0
+
+        # A failed cache write (full disk, entry evicted meanwhile) doesn't lose the decoded image
+        if self.cache is not None and key is not None:
+            try:
+                if self.max_side is None:
+                    self.cache.put_image(key, img)
+                else:
+                    self.cache.put_scaled_image(key, img, scale)
+            except OSError as e:
+                print(f"Failed to cache {file.get('name', file['id'])}:", e)
+        return img, scale
+
+    def iterate(self, files):
+        """
+        Downloads the given files concurrently and yields them in order, with bounded prefetch.
+
+        Args:
+        - files: Iterable of file metadata dictionaries.
+
+        Yields:
+        - (file, img, scale): The file metadata, its decoded image (None if the download failed)
+                              and the size of the image relative to the original.
+        """
+        pending = deque()
+        files = iter(files)
+        for file in files:
+            pending.append((file, self.executor.submit(self.fetch_and_decode, file)))
+            if len(pending) >= self.prefetch:
+                break
+
+        while pending:
+            file, future = pending.popleft()
+            # Keep the queue full before handing the next image to the consumer
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append((next_file, self.executor.submit(self.fetch_and_decode, next_file)))
+            img, scale = future.result()
+            yield file, img, scale
+
+    def close(self):
+        """
+        Stops the worker threads and closes the pooled session.
+        """
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
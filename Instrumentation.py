@@ -0,0 +1,327 @@
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+Per-stage instrumentation of a pipeline run.
+
+A RunReport records, for every stage of a run, the wall time and CPU time spent in it, its
+memory (see below), how many items of each unit it handled (images, masks, leaves,
+requests...) and how many errors it hit. Stages are either blocks of code (`stage`) or
+streaming generators (`iterate`). Stages can be nested, e.g. the pipeline generators pulling
+from each other: a stage's time excludes the time of the stages it calls, so the stages of a
+run add up to the run.
+
+CPU time is the process CPU time while the stage runs, so it includes the worker threads busy
+at the same time (downloads, uploads). Each thread has its own stage stack, so stages timed by
+the outbox flusher thread don't nest into the main thread's.
+
+Memory is read from the process peak RSS (`ru_maxrss`) when a stage starts and ends: when a
+stage raises it, the new process peak is a transient peak of that stage (SAM activations, TF
+batch buffers...) even if the memory is freed before the stage ends. `peak_rss_increase_bytes`
+adds up how much each stage raised the process peak (nested stages included, other threads
+too), and `peak_rss_bytes` is the highest of the process peaks a stage reached and of the RSS at
+its exits; a stage that never raised the process peak only gets its RSS at exit, a lower bound.
+
+The report is written as JSON, and optionally as a Prometheus textfile (for the node_exporter
+textfile collector).
+"""
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_bytes():
+    """
+    Current resident set size of the process, in bytes (the peak RSS where /proc is not available).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of the process so far, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def thread_settings():
+    """
+    Thread counts of the numeric libraries, for the ones already imported (none is imported here).
+
+    Returns:
+    - settings: Dictionary with the CPU count, the thread-related environment variables, and the
+                torch / TensorFlow thread pools if those are loaded.
+    """
+    settings = {'cpus': os.cpu_count()}
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS'):
+        if variable in os.environ:
+            settings[variable] = os.environ[variable]
+    if 'torch' in sys.modules:
+        torch = sys.modules['torch']
+        settings['torch_threads'] = torch.get_num_threads()
+        settings['torch_interop_threads'] = torch.get_num_interop_threads()
+    if 'tensorflow' in sys.modules:
+        tf = sys.modules['tensorflow']
+        # 0 means TensorFlow picks the number of threads itself
+        settings['tf_intra_op_threads'] = tf.config.threading.get_intra_op_parallelism_threads()
+        settings['tf_inter_op_threads'] = tf.config.threading.get_inter_op_parallelism_threads()
+    return settings
+
+
+class StageStats:
+    """
+    Accumulated measurements of one stage.
+    """
+
+    def __init__(self, name, lock):
+        self.name = name
+        self.lock = lock
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.peak_rss_increase_bytes = 0
+        self.calls = 0
+        self.counts = {}
+        self.errors = 0
+
+    def add(self, unit, count=1):
+        """
+        Count `count` items of a unit (e.g. 'images', 'leaves', 'requests') handled by the stage.
+        """
+        with self.lock:
+            self.counts[unit] = self.counts.get(unit, 0) + count
+
+    def error(self, count=1):
+        with self.lock:
+            self.errors += count
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'wall_seconds': self.wall_seconds,
+                'cpu_seconds': self.cpu_seconds,
+                'peak_rss_bytes': self.peak_rss_bytes,
+                'peak_rss_increase_bytes': self.peak_rss_increase_bytes,
+                'calls': self.calls,
+                'counts': dict(self.counts),
+                'per_second': {unit: count / self.wall_seconds if self.wall_seconds else None
+                               for unit, count in self.counts.items()},
+                'errors': self.errors,
+            }
+
+
+class RunReport:
+    """
+    Measurements of the stages of one run.
+
+    Args:
+    - name: Name of the run, used in the JSON report.
+    - markers: Print a line with the process id and a monotonic timestamp when each block stage
+               starts and ends, to line stages up with an external profiler (e.g. py-spy).
+    """
+
+    def __init__(self, name='run', markers=False):
+        self.name = name
+        self.markers = markers
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stages = {}
+        self.info = {}
+
+    def get_stage(self, name):
+        """
+        Returns the StageStats of a stage, creating it on first use.
+        """
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats(name, self.lock)
+            return self.stages[name]
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _enter(self, name):
+        # [name, wall start, cpu start, wall of nested stages, cpu of nested stages, process peak RSS at start]
+        self._stack().append([name, time.perf_counter(), time.process_time(), 0.0, 0.0, peak_rss_bytes()])
+
+    def _exit(self):
+        stack = self._stack()
+        name, wall_start, cpu_start, nested_wall, nested_cpu, peak_start = stack.pop()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        if stack:
+            stack[-1][3] += wall
+            stack[-1][4] += cpu
+        stats = self.get_stage(name)
+        rss = current_rss_bytes()
+        peak = peak_rss_bytes()
+        with self.lock:
+            stats.wall_seconds += wall - nested_wall
+            stats.cpu_seconds += cpu - nested_cpu
+            if peak > peak_start:
+                # The process peak was reached during this stage
+                stats.peak_rss_increase_bytes += peak - peak_start
+                rss = max(rss, peak)
+            stats.peak_rss_bytes = max(stats.peak_rss_bytes, rss)
+            stats.calls += 1
+
+    def _error(self, name, e):
+        # An exception crossing several nested stages is only counted by the one it was raised in
+        if not getattr(e, '_counted_by_report', False):
+            self.get_stage(name).error()
+            try:
+                e._counted_by_report = True
+            except AttributeError:
+                pass
+
+    def _marker(self, name, event):
+        if self.markers:
+            print(f"[stage] {event} {name} pid={os.getpid()} t={time.monotonic():.6f}", file=sys.stderr, flush=True)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of code as a stage.
+
+        Yields:
+        - stats: StageStats of the stage, to count the items handled with `add` and `error`.
+        """
+        stats = self.get_stage(name)
+        self._marker(name, 'start')
+        self._enter(name)
+        try:
+            yield stats
+        except Exception as e:
+            self._error(name, e)
+            raise
+        finally:
+            self._exit()
+            self._marker(name, 'end')
+
+    def iterate(self, name, stream, counters=None):
+        """
+        Time a streaming stage: the time spent producing each item of `stream` is charged to the stage.
+
+        Args:
+        - name: Name of the stage.
+        - stream: Iterable of items produced by the stage (e.g. a Pipeline generator).
+        - counters: Optional dictionary mapping units to a function returning how many of that
+                    unit an item holds, e.g. {'leaves': lambda record: len(record['Masks_b'])}.
+                    Items are always counted under 'items'.
+
+        Yields:
+        - item: The items of `stream`, unchanged.
+        """
+        stats = self.get_stage(name)
+        stream = iter(stream)
+        while True:
+            self._enter(name)
+            try:
+                item = next(stream)
+            except StopIteration:
+                self._exit()
+                return
+            except Exception as e:
+                self._error(name, e)
+                self._exit()
+                raise
+            self._exit()
+
+            stats.add('items')
+            for unit, counter in (counters or {}).items():
+                stats.add(unit, counter(item))
+            yield item
+
+    def wrap_outcomes(self, name, handler, unit='requests'):
+        """
+        Wrap a batch handler returning one (ok, result, error) tuple per item (see `Outbox.flush`)
+        so each call is timed as a stage, with its items and failed items counted.
+        """
+        def instrumented(items):
+            with self.stage(name) as stats:
+                outcomes = handler(items)
+                stats.add(unit, len(outcomes))
+                stats.error(sum(1 for ok, _, _ in outcomes if not ok))
+            return outcomes
+        return instrumented
+
+    def to_dict(self):
+        """
+        The report as a JSON-serializable dictionary.
+        """
+        with self.lock:
+            stages = list(self.stages.values())
+        return {
+            'name': self.name,
+            'started_at': datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+            'duration_seconds': time.perf_counter() - self.started,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'threads': thread_settings(),
+            'info': dict(self.info),
+            'stages': {stats.name: stats.to_dict() for stats in stages},
+        }
+
+    def write_json(self, path):
+        """
+        Write the report as JSON.
+        """
+        _write_atomically(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path, prefix='rowling'):
+        """
+        Write the report in the Prometheus text format, e.g. for the node_exporter textfile collector.
+        """
+        report = self.to_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        stages = report['stages']
+        metric('run_timestamp_seconds', "Start time of the last run.", [({}, self.started_at)])
+        metric('run_duration_seconds', "Duration of the last run.", [({}, report['duration_seconds'])])
+        metric('run_peak_rss_bytes', "Peak resident memory of the process.", [({}, report['peak_rss_bytes'])])
+        metric('stage_wall_seconds', "Wall time spent in the stage, nested stages excluded.",
+               [({'stage': name}, stats['wall_seconds']) for name, stats in stages.items()])
+        metric('stage_cpu_seconds', "Process CPU time spent in the stage, nested stages excluded.",
+               [({'stage': name}, stats['cpu_seconds']) for name, stats in stages.items()])
+        metric('stage_peak_rss_bytes', "Highest process peak reached during the stage, or resident memory at its exit.",
+               [({'stage': name}, stats['peak_rss_bytes']) for name, stats in stages.items()])
+        metric('stage_peak_rss_increase_bytes', "How much the stage raised the process peak resident memory.",
+               [({'stage': name}, stats['peak_rss_increase_bytes']) for name, stats in stages.items()])
+        metric('stage_items', "Items handled by the stage, per unit.",
+               [({'stage': name, 'unit': unit}, count) for name, stats in stages.items() for unit, count in stats['counts'].items()])
+        metric('stage_errors', "Errors hit by the stage.",
+               [({'stage': name}, stats['errors']) for name, stats in stages.items()])
+        _write_atomically(path, '\n'.join(lines) + '\n')
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomically(path, text):
+    # Readers (e.g. the textfile collector) never see a half-written file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w') as f:
+        f.write(text)
+    os.replace(temporary_path, path)
@@ -0,0 +1,202 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from Mask_Encoding import encode_masks, decode_masks
+
+
+def content_key(file_id, checksum):
+    """
+    Build the cache key of a Drive file from its id and content checksum.
+
+    Args:
+    - file_id: Google Drive file id.
+    - checksum: Content checksum of the file (Drive `md5Checksum`).
+
+    Returns:
+    - key: String usable as a directory name.
+    """
+    return hashlib.sha1(f"{file_id}:{checksum}".encode()).hexdigest()
+
+
+def file_cache_key(file):
+    """
+    Build the cache key of a Drive file from its metadata: id and `md5Checksum`, or `modifiedTime`
+    for files Drive has no checksum for.
+
+    Args:
+    - file: File metadata dictionary.
+
+    Returns:
+    - key: Cache key, or None if the metadata has neither a checksum nor a modified time.
+    """
+    checksum = file.get('md5Checksum', file.get('modifiedTime'))
+    if checksum is None:
+        return None
+    return content_key(file['id'], checksum)
+
+
+def reduced_cache_key(key, max_side):
+    """
+    Build the cache key of an image decoded at a reduced working resolution (see
+    `Image_Downloader.decode_reduced_image`), so its image and masks are cached apart from the
+    full-resolution ones.
+
+    Args:
+    - key: Cache key of the file, from `file_cache_key`.
+    - max_side: Working resolution the image is decoded at.
+
+    Returns:
+    - key: Cache key, or None if `key` is None.
+    """
+    if key is None:
+        return None
+    return hashlib.sha1(f"{key}:{max_side}".encode()).hexdigest()
+
+
+class ContentCache:
+    """
+    Content-addressed on-disk cache of decoded images and SAM mask sets.
+
+    Each entry is a directory named after its key holding `image.npy` (or `image.npz`, with its
+    scale, for images decoded at a reduced resolution) and one `masks_<tag>.json.gz` per SAM
+    configuration, with run-length encoded segmentations.
+    Entries are evicted least recently used first once the cache grows over `max_bytes`. The
+    total size is scanned once at startup and kept up to date by the writes, so the cache
+    directory is only walked when it has to be evicted.
+
+    Args:
+    - directory: Directory where the cache is stored.
+    - max_bytes: Maximum total size of the cache in bytes.
+    """
+
+    def __init__(self, directory, max_bytes=20 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._scan())
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def _touch(self, key):
+        try:
+            os.utime(self._entry(key))
+        except OSError:
+            pass
+
+    def _write(self, key, name, write):
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+        path = os.path.join(entry, name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        write(tmp_path)
+        added = os.path.getsize(tmp_path)
+        try:
+            added -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+        self._touch(key)
+        with self.lock:
+            self.total_bytes += added
+            over = self.total_bytes > self.max_bytes
+        if over:
+            self.evict()
+
+    def get_image(self, key):
+        """
+        Returns the cached decoded image of the key, or None on a cache miss.
+        """
+        path = os.path.join(self._entry(key), 'image.npy')
+        try:
+            image = np.load(path)
+        except (OSError, ValueError):
+            return None
+        self._touch(key)
+        return image
+
+    def put_image(self, key, image):
+        """
+        Stores the decoded image of the key.
+        """
+        def write(path):
+            with open(path, 'wb') as f:
+                np.save(f, image)
+        self._write(key, 'image.npy', write)
+
+    def get_scaled_image(self, key):
+        """
+        Returns the cached (image, scale) of a reduced-resolution key, or None on a cache miss.
+        """
+        path = os.path.join(self._entry(key), 'image.npz')
+        try:
+            with np.load(path) as data:
+                image, scale = data['image'], float(data['scale'])
+        except (OSError, ValueError, KeyError):
+            return None
+        self._touch(key)
+        return image, scale
+
+    def put_scaled_image(self, key, image, scale):
+        """
+        Stores an image decoded at a reduced resolution, with its scale to the original image.
+        """
+        def write(path):
+            with open(path, 'wb') as f:
+                np.savez(f, image=image, scale=scale)
+        self._write(key, 'image.npz', write)
+
+    def get_masks(self, key, tag='', compact=False):
+        """
+        Returns the cached SAM masks of the key for the SAM configuration `tag`, or None on a cache miss.
+        With `compact`, the masks are returned as CompactMask objects.
+        """
+        path = os.path.join(self._entry(key), f'masks_{tag}.json.gz')
+        try:
+            with gzip.open(path, 'rt') as f:
+                masks = decode_masks(json.load(f), compact)
+        except (OSError, EOFError, ValueError):
+            return None
+        self._touch(key)
+        return masks
+
+    def put_masks(self, key, masks, tag=''):
+        """
+        Stores the SAM masks of the key for the SAM configuration `tag`.
+        """
+        def write(path):
+            with gzip.open(path, 'wt', compresslevel=3) as f:
+                json.dump(encode_masks(masks), f)
+        self._write(key, f'masks_{tag}.json.gz', write)
+
+    def _scan(self):
+        # (last use, size, path) of every entry
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is under `max_bytes`, and
+        resynchronizes the running total with the disk.
+        """
+        with self.lock:
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+            self.total_bytes = total
@@ -0,0 +1,360 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+"""
+Local stand-ins for the external services the pipeline talks to (Drive, the backend API, MongoDB),
+so the download, upload and database stages can be exercised and timed offline.
+"""
+
+
+class LocalHTTPServer:
+    """
+    Threaded HTTP server running in a background thread on 127.0.0.1.
+
+    Args:
+    - handler_class: BaseHTTPRequestHandler subclass serving the requests. The server
+                     instance is available to it as `self.server.owner`.
+    - port: Port to listen on (default 0, any free port).
+    """
+
+    def __init__(self, handler_class, port=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+        self.httpd.owner = self
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        owner = self.server.owner
+        # Paths look like /drive/v3/files/<file_id>
+        file_id = urlparse(self.path).path.rstrip('/').split('/')[-1]
+        with owner.lock:
+            owner.requests_count += 1
+        image_bytes = owner.images.get(file_id)
+        if image_bytes is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(image_bytes)))
+        self.end_headers()
+        self.wfile.write(image_bytes)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageServer(LocalHTTPServer):
+    """
+    Stand-in for the Drive media endpoint, serving image bytes by file id.
+
+    Args:
+    - images: Dictionary mapping file ids to encoded image bytes.
+    - port: Port to listen on (default 0, any free port).
+
+    Use `media_url` as the `media_url` of an ImageDownloader built on a plain requests.Session.
+    """
+
+    def __init__(self, images, port=0):
+        super().__init__(_ImageHandler, port)
+        self.images = dict(images)
+        self.requests_count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def media_url(self):
+        return self.url + "/drive/v3/files/{file_id}?alt=media"
+
+
+class _BackendHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, as the real backend; headers and body go out in separate writes
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        owner = self.server.owner
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        key = self.headers.get('Idempotency-Key')
+        time.sleep(owner.latency)
+
+        with owner.lock:
+            owner.requests_count += 1
+            fail = owner.rng.random() < owner.failure_rate
+
+        if fail:
+            self._reply(503, {'detail': 'Service unavailable'})
+            return
+        if self.path.endswith('/handle_zones_periods_of_disease'):
+            ids = [f"period-{zone['zone_name']}" for zone in payload['zones']]
+            self._reply(200, {'data': {'periodIds': ids}})
+            return
+        with owner.lock:
+            if key is not None and key in owner.created:
+                owner.duplicates += 1
+            else:
+                owner.created[key or uuid.uuid4().hex] = payload
+        self._reply(201, {'data': {'Image_Path': payload.get('Image_Path') if isinstance(payload, dict) else None}})
+
+    def _reply(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BackendServer(LocalHTTPServer):
+    """
+    Stand-in for the backend REST API (`create_image` and `handle_zones_periods_of_disease`).
+
+    Created images are stored by Idempotency-Key, and a repeated key is counted as a
+    duplicate instead of creating the image again.
+
+    Args:
+    - latency: Seconds each request takes to answer.
+    - failure_rate: Fraction of requests answered with a 503.
+    - seed: Random seed of the failures.
+    - port: Port to listen on (default 0, any free port).
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0, port=0):
+        super().__init__(_BackendHandler, port)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.created = {}
+        self.duplicates = 0
+        self.requests_count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def create_image_url(self):
+        return self.url + "/api/v1/create_image"
+
+    @property
+    def zone_periods_url(self):
+        return self.url + "/api/v1/handle_zones_periods_of_disease"
+
+
+class _FakeRequest:
+
+    def __init__(self, function):
+        self.function = function
+
+    def execute(self, num_retries=0):
+        return self.function()
+
+
+def _project(file, fields):
+    """
+    Keeps only the requested fields of a file, as Drive does with the `fields` mask.
+    """
+    if not fields:
+        return dict(file)
+    match = re.search(r'files\(([^)]*)\)', fields)
+    names = match.group(1) if match else fields
+    names = [name.strip() for name in names.split(',') if name.strip()]
+    return {name: file[name] for name in names if name in file}
+
+
+class _FakeFiles:
+
+    def __init__(self, service):
+        self.service = service
+
+    def _matches(self, file, q):
+        for clause in re.split(r'\s+and\s+', q or ''):
+            clause = clause.strip()
+            if not clause:
+                continue
+            match = re.fullmatch(r"'([^']+)' in parents", clause)
+            if match:
+                if match.group(1) not in file.get('parents', []):
+                    return False
+                continue
+            match = re.fullmatch(r"mimeType\s*=\s*'([^']+)'", clause)
+            if match:
+                if file.get('mimeType') != match.group(1):
+                    return False
+                continue
+            match = re.fullmatch(r"modifiedTime\s*>\s*'([^']+)'", clause)
+            if match:
+                if file.get('modifiedTime', '') <= match.group(1):
+                    return False
+                continue
+            match = re.fullmatch(r"trashed\s*=\s*(true|false)", clause)
+            if match:
+                if file.get('trashed', False) != (match.group(1) == 'true'):
+                    return False
+                continue
+            raise ValueError(f"Unsupported query clause: {clause}")
+        return True
+
+    def list(self, q=None, fields=None, pageSize=100, pageToken=None, orderBy=None, **kwargs):
+        def run():
+            service = self.service
+            with service.lock:
+                service.list_calls += 1
+                files = [file for file in service.files_store.values() if self._matches(file, q)]
+            if orderBy:
+                for clause in reversed([clause.strip() for clause in orderBy.split(',')]):
+                    key, _, direction = clause.partition(' ')
+                    files.sort(key=lambda file: file.get(key, ''), reverse=direction == 'desc')
+            start = int(pageToken or 0)
+            page = files[start:start + pageSize]
+            result = {'files': [_project(file, fields) for file in page]}
+            if start + pageSize < len(files):
+                result['nextPageToken'] = str(start + pageSize)
+            return result
+        return _FakeRequest(run)
+
+    def get(self, fileId, fields=None, **kwargs):
+        return _FakeRequest(lambda: _project(self.service.files_store[fileId], fields))
+
+    def get_media(self, fileId, **kwargs):
+        return _FakeRequest(lambda: self.service.contents[fileId])
+
+    def update(self, fileId, addParents=None, removeParents=None, body=None, fields=None, **kwargs):
+        def run():
+            with self.service.lock:
+                file = self.service.files_store[fileId]
+                parents = [parent for parent in file.get('parents', []) if parent not in (removeParents or '').split(',')]
+                if addParents:
+                    parents.extend(addParents.split(','))
+                file['parents'] = parents
+                file.update(body or {})
+            return _project(file, fields)
+        return _FakeRequest(run)
+
+    def create(self, body=None, media_body=None, fields=None, **kwargs):
+        def run():
+            service = self.service
+            file = dict(body or {})
+            file['id'] = uuid.uuid4().hex
+            with service.lock:
+                service.create_calls += 1
+                service.files_store[file['id']] = file
+                if media_body is not None:
+                    service.contents[file['id']] = media_body.getbytes(0, media_body.size())
+            return _project(file, fields)
+        return _FakeRequest(run)
+
+
+class FakeDriveService:
+    """
+    In-memory stand-in for the Drive v3 service object built by `build('drive', 'v3', ...)`.
+
+    Supports the `files()` calls the pipeline makes: `list` (with paging, `fields`, `orderBy`
+    and the `in parents` / `mimeType` / `modifiedTime >` / `trashed` query clauses), `get`,
+    `get_media`, `update` and `create`.
+
+    Args:
+    - files: Optional list of file metadata dictionaries (with 'id' and 'parents').
+    - contents: Optional dictionary mapping file ids to their bytes.
+    """
+
+    def __init__(self, files=None, contents=None):
+        self.files_store = {file['id']: dict(file) for file in (files or [])}
+        self.contents = dict(contents or {})
+        self.list_calls = 0
+        self.create_calls = 0
+        self.lock = threading.Lock()
+
+    def files(self):
+        return _FakeFiles(self)
+
+
+class _BulkWriteResult:
+
+    def __init__(self, inserted_count, upserted_count, modified_count):
+        self.inserted_count = inserted_count
+        self.upserted_count = upserted_count
+        self.modified_count = modified_count
+
+
+class _MockCollection:
+    """
+    mongomock collection whose `bulk_write` accepts the InsertOne / ReplaceOne operations of
+    the installed pymongo (recent pymongo versions pass arguments mongomock doesn't know).
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        import pymongo
+        inserted = upserted = modified = 0
+        for request in requests:
+            if isinstance(request, pymongo.InsertOne):
+                self.collection.insert_one(request._doc)
+                inserted += 1
+            elif isinstance(request, pymongo.ReplaceOne):
+                result = self.collection.replace_one(request._filter, request._doc, upsert=request._upsert)
+                modified += result.modified_count
+                upserted += result.upserted_id is not None
+            else:
+                raise TypeError(f"Unsupported bulk operation: {type(request).__name__}")
+        return _BulkWriteResult(inserted, upserted, modified)
+
+
+class _MockDatabase:
+
+    def __init__(self, database):
+        self.database = database
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def __getitem__(self, name):
+        return _MockCollection(self.database[name])
+
+
+class MockMongoClient:
+    """
+    In-memory stand-in for pymongo.MongoClient, backed by mongomock.
+    """
+
+    def __init__(self):
+        import mongomock
+        self.client = mongomock.MongoClient()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def __getitem__(self, name):
+        return _MockDatabase(self.client[name])
@@ -0,0 +1,268 @@
+import numpy as np
+
+
+def encode_rle(mask):
+    """
+    Encode a boolean mask as an uncompressed COCO-style run-length encoding.
+
+    Runs are counted in column-major order and start with a run of zeros (possibly empty).
+
+    Args:
+    - mask: 2D boolean array.
+
+    Returns:
+    - rle: Dictionary with the mask 'size' [height, width] and the run 'counts'.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    pixels = mask.ravel(order='F')
+    if pixels.size == 0:
+        return {'size': list(mask.shape), 'counts': []}
+
+    # Positions where the value changes mark the run boundaries
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [pixels.size])))
+    if pixels[0]:
+        counts = np.concatenate(([0], counts))
+    return {'size': list(mask.shape), 'counts': counts.tolist()}
+
+
+def decode_rle(rle):
+    """
+    Decode a run-length encoding produced by `encode_rle` back into a boolean mask.
+
+    Args:
+    - rle: Dictionary with the mask 'size' [height, width] and the run 'counts'.
+
+    Returns:
+    - mask: 2D boolean array.
+    """
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape((height, width), order='F')
+
+
+def decode_rle_columns(rle, first_column, last_column):
+    """
+    Decode only a range of columns of a run-length encoding produced by `encode_rle`.
+
+    Args:
+    - rle: Dictionary with the mask 'size' [height, width] and the run 'counts'.
+    - first_column: Index of the first column to decode.
+    - last_column: Index of the last column to decode (inclusive).
+
+    Returns:
+    - strip: 2D boolean array of shape (height, last_column - first_column + 1).
+    """
+    height = rle['size'][0]
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # Runs overlapping the columns, clipped to them; odd runs are the mask pixels
+    low, high = first_column * height, (last_column + 1) * height
+    runs = np.flatnonzero((ends > low) & (starts < high))
+    lengths = np.minimum(ends[runs], high) - np.maximum(starts[runs], low)
+    return np.repeat(runs % 2 == 1, lengths).reshape((height, last_column - first_column + 1), order='F')
+
+
+def to_python_value(value):
+    """
+    Converts numpy arrays and numpy scalars to plain Python values, e.g. to store them as JSON or BSON.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def encode_masks(masks):
+    """
+    Convert SAM masks into a JSON-serializable form, with the segmentation run-length encoded.
+
+    Args:
+    - masks: List of SAM mask dictionaries ('segmentation', 'bbox', 'area', 'predicted_iou', ...).
+
+    Returns:
+    - encoded_masks: List of dictionaries with the 'segmentation' replaced by its RLE.
+    """
+    encoded_masks = []
+    for mask_info in masks:
+        if isinstance(mask_info, CompactMask):
+            encoded_masks.append(mask_info.encode())
+            continue
+        encoded = {key: to_python_value(value) for key, value in mask_info.items() if key != 'segmentation'}
+        encoded['segmentation'] = encode_rle(mask_info['segmentation'])
+        encoded_masks.append(encoded)
+    return encoded_masks
+
+
+def decode_masks(encoded_masks, compact=False):
+    """
+    Convert masks produced by `encode_masks` back into SAM masks.
+
+    Args:
+    - encoded_masks: List of dictionaries with a run-length encoded 'segmentation'.
+    - compact: Return CompactMask objects instead of dictionaries with a dense segmentation.
+
+    Returns:
+    - masks: List of SAM mask dictionaries with a dense boolean 'segmentation', or of CompactMask.
+    """
+    masks = []
+    for encoded in encoded_masks:
+        if compact or 'window' in encoded['segmentation']:
+            mask = CompactMask.from_encoded(encoded)
+            masks.append(mask if compact else mask.to_dict())
+            continue
+        mask_info = dict(encoded)
+        mask_info['segmentation'] = decode_rle(encoded['segmentation'])
+        masks.append(mask_info)
+    return masks
+
+
+class CompactMask:
+    """
+    SAM mask stored as the run-length encoding of its bounding box window only, with its bbox,
+    area and the other SAM metadata alongside.
+
+    Its size grows with the mask outline (one or two runs per window column) instead of with
+    the image area, and the pixels are only decoded on request, for the bbox window.
+    It reads like a SAM mask dictionary: `mask['bbox']`, `mask['area']`, `mask.get('predicted_iou')`;
+    `mask['segmentation']` decodes the full-image boolean mask.
+
+    Args:
+    - size: (height, width) of the image.
+    - bbox: SAM bounding box [x, y, w, h], spanning from the first to the last mask pixel.
+    - area: Number of mask pixels.
+    - counts: Run-length encoding of the bbox window, as produced by `encode_rle`.
+    - metadata: Dictionary with the other SAM keys ('predicted_iou', 'stability_score', ...).
+    """
+
+    __slots__ = ('size', 'bbox', 'area', 'counts', 'metadata')
+
+    def __init__(self, size, bbox, area, counts, metadata=None):
+        self.size = (int(size[0]), int(size[1]))
+        self.bbox = [int(value) for value in bbox]
+        self.area = int(area)
+        self.counts = np.asarray(counts, dtype=np.uint32)
+        self.metadata = metadata if metadata is not None else {}
+
+    @classmethod
+    def from_dense(cls, segmentation, size=None, offset=(0, 0), metadata=None):
+        """
+        Build a compact mask from a boolean array.
+
+        Args:
+        - segmentation: 2D boolean array, the whole mask or a window of it.
+        - size: (height, width) of the image, if `segmentation` is only a window of it.
+        - offset: (x, y) position of the window in the image.
+        - metadata: Dictionary with the other SAM keys.
+        """
+        segmentation = np.asarray(segmentation, dtype=bool)
+        size = segmentation.shape if size is None else size
+        rows = np.flatnonzero(segmentation.any(axis=1))
+        cols = np.flatnonzero(segmentation.any(axis=0))
+        if rows.size == 0:
+            return cls(size, [0, 0, 0, 0], 0, [1], metadata)
+        window = segmentation[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        bbox = [offset[0] + cols[0], offset[1] + rows[0], cols[-1] - cols[0], rows[-1] - rows[0]]
+        return cls(size, bbox, np.count_nonzero(window), encode_rle(window)['counts'], metadata)
+
+    @classmethod
+    def from_rle(cls, rle, bbox, area, metadata=None):
+        """
+        Build a compact mask from a full-image run-length encoding (SAM's 'uncompressed_rle' output
+        or `encode_rle`), decoding only the bbox columns.
+        """
+        x, y, w, h = (int(value) for value in bbox)
+        if area == 0:
+            return cls(rle['size'], [0, 0, 0, 0], 0, [1], metadata)
+        window = decode_rle_columns(rle, x, x + w)[y:y + h + 1]
+        return cls(rle['size'], [x, y, w, h], area, encode_rle(window)['counts'], metadata)
+
+    @classmethod
+    def from_sam(cls, mask_info):
+        """
+        Build a compact mask from a SAM mask dictionary, with a dense or run-length encoded segmentation.
+        """
+        metadata = {key: value for key, value in mask_info.items() if key not in ('segmentation', 'bbox', 'area')}
+        segmentation = mask_info['segmentation']
+        if isinstance(segmentation, dict):
+            return cls.from_rle(segmentation, mask_info['bbox'], mask_info['area'], metadata)
+        return cls.from_dense(segmentation, metadata=metadata)
+
+    @classmethod
+    def from_encoded(cls, encoded):
+        """
+        Build a compact mask from an entry of `encode_masks`.
+        """
+        rle = encoded['segmentation']
+        metadata = {key: value for key, value in encoded.items() if key not in ('segmentation', 'bbox', 'area')}
+        if 'window' in rle:
+            return cls(rle['size'], rle['window'], encoded['area'], rle['counts'], metadata)
+        return cls.from_rle(rle, encoded['bbox'], encoded['area'], metadata)
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def window(self):
+        """
+        Decode the bbox window of the mask.
+
+        Returns:
+        - window: 2D boolean array of shape (h + 1, w + 1).
+        """
+        x, y, w, h = self.bbox
+        return decode_rle({'size': [h + 1, w + 1], 'counts': self.counts})
+
+    def decode(self):
+        """
+        Decode the full-image mask.
+
+        Returns:
+        - segmentation: 2D boolean array of the image size.
+        """
+        segmentation = np.zeros(self.size, dtype=bool)
+        if self.area:
+            x, y, w, h = self.bbox
+            segmentation[y:y + h + 1, x:x + w + 1] = self.window()
+        return segmentation
+
+    def encode(self):
+        """
+        JSON-serializable form, as stored by `encode_masks`.
+        """
+        encoded = {key: to_python_value(value) for key, value in self.metadata.items()}
+        encoded['bbox'] = list(self.bbox)
+        encoded['area'] = self.area
+        encoded['segmentation'] = {'size': list(self.size), 'window': list(self.bbox), 'counts': self.counts.tolist()}
+        return encoded
+
+    def to_dict(self):
+        """
+        SAM mask dictionary with the dense segmentation.
+        """
+        mask_info = dict(self.metadata)
+        mask_info.update(segmentation=self.decode(), bbox=list(self.bbox), area=self.area)
+        return mask_info
+
+    def __getitem__(self, key):
+        if key == 'bbox':
+            return self.bbox
+        if key == 'area':
+            return self.area
+        if key == 'segmentation':
+            return self.decode()
+        return self.metadata[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in ('bbox', 'area', 'segmentation') or key in self.metadata
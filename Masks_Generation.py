@@ -1,9 +1,295 @@
-from Libraries import * 
+import hashlib
+import cv2
+import numpy as np
+from Mask_Encoding import CompactMask
+
+# Named SAM speed profiles: the backbone, the longest image side fed to SAM (None keeps the
+# full resolution) and the `SamAutomaticMaskGenerator` settings.
+# 'accurate' is the original configuration (vit_l, 32x32 point grid, full resolution).
+SAM_PROFILES = {
+    'accurate': {
+        'model_type': 'vit_l',
+        'max_side': None,
+        'generator_kwargs': {},
+    },
+    'balanced': {
+        'model_type': 'vit_l',
+        'max_side': 1024,
+        'generator_kwargs': {'points_per_side': 16, 'points_per_batch': 128, 'pred_iou_thresh': 0.88,
+                             'stability_score_thresh': 0.95, 'crop_n_layers': 0},
+    },
+    'fast': {
+        'model_type': 'vit_b',
+        'max_side': 768,
+        'generator_kwargs': {'points_per_side': 12, 'points_per_batch': 144, 'pred_iou_thresh': 0.86,
+                             'stability_score_thresh': 0.92, 'crop_n_layers': 0},
+    },
+}
+
+
+def get_sam_profile(profile):
+    """
+    Look up a SAM speed profile.
+
+    Args:
+    - profile: str, Name of the profile in SAM_PROFILES ('accurate', 'balanced' or 'fast').
+
+    Returns:
+    - model_type: str, SAM backbone.
+    - max_side: Longest image side fed to SAM, or None for the full resolution.
+    - generator_kwargs: Dictionary of `SamAutomaticMaskGenerator` settings (a copy).
+    """
+    if profile not in SAM_PROFILES:
+        raise ValueError(f"Unknown SAM profile: {profile}")
+    settings = SAM_PROFILES[profile]
+    return settings['model_type'], settings['max_side'], dict(settings['generator_kwargs'])
+
+
+def sam_cache_tag(model_type, generator_kwargs, max_side=None):
+    """
+    Identifies a SAM configuration, so masks cached with different settings are kept apart.
+
+    Args:
+    - model_type: str, SAM backbone.
+    - generator_kwargs: Keyword arguments of `SamAutomaticMaskGenerator`.
+    - max_side: Optional longest image side fed to SAM.
+
+    Returns:
+    - tag: Short hexadecimal string.
+    """
+    settings = dict(generator_kwargs)
+    if max_side is not None:
+        settings['max_side'] = max_side
+    settings = ",".join(f"{key}={value}" for key, value in sorted(settings.items()))
+    return hashlib.sha1(f"{model_type}:{settings}".encode()).hexdigest()[:16]
+
+
+def downscale_image(image, max_side):
+    """
+    Shrink an image so its longest side is at most `max_side` pixels.
+
+    Args:
+    - image: Input image.
+    - max_side: Longest side allowed, or None to keep the image as is.
+
+    Returns:
+    - small_image: The downscaled image (the input itself if it is small enough).
+    - scale: Ratio between the downscaled and the original size (1.0 if unchanged).
+    """
+    height, width = image.shape[:2]
+    if max_side is None or max(height, width) <= max_side:
+        return image, 1.0
+    scale = max_side / max(height, width)
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+
+def upscale_masks(masks, shape, scale):
+    """
+    Map masks generated on a downscaled image back to the original image coordinates.
+
+    The segmentations are resized to the original size (nearest neighbour), and the bbox and
+    area are recomputed from them so they follow the same conventions as SAM. Compact masks
+    only have their bbox window resized.
+
+    Args:
+    - masks: List of SAM masks (dictionaries or CompactMask) generated on the downscaled image.
+    - shape: Shape of the original image.
+    - scale: Ratio between the downscaled and the original size, from `downscale_image`.
+
+    Returns:
+    - masks: List of the upscaled masks (dictionaries are updated in place).
+    """
+    height, width = shape[:2]
+    upscaled = []
+    for mask_info in masks:
+        if isinstance(mask_info, CompactMask):
+            x, y, w, h = mask_info.bbox
+            left, top = int(x / scale), int(y / scale)
+            right = max(left + 1, min(width, int(np.ceil((x + w + 1) / scale))))
+            bottom = max(top + 1, min(height, int(np.ceil((y + h + 1) / scale))))
+            window = cv2.resize(mask_info.window().astype(np.uint8), (right - left, bottom - top),
+                                interpolation=cv2.INTER_NEAREST)
+            metadata = _upscale_metadata(dict(mask_info.metadata), width, height, scale)
+            upscaled.append(CompactMask.from_dense(window, (height, width), (left, top), metadata))
+            continue
+
+        segmentation = cv2.resize(mask_info['segmentation'].astype(np.uint8), (width, height),
+                                  interpolation=cv2.INTER_NEAREST).astype(bool)
+        rows = np.flatnonzero(segmentation.any(axis=1))
+        cols = np.flatnonzero(segmentation.any(axis=0))
+        if rows.size:
+            # SAM boxes span from the first to the last mask pixel
+            bbox = [int(cols[0]), int(rows[0]), int(cols[-1] - cols[0]), int(rows[-1] - rows[0])]
+        else:
+            bbox = [0, 0, 0, 0]
+        mask_info['segmentation'] = segmentation
+        mask_info['bbox'] = bbox
+        mask_info['area'] = int(np.count_nonzero(segmentation))
+        upscaled.append(_upscale_metadata(mask_info, width, height, scale))
+    return upscaled
+
+
+def _upscale_metadata(mask_info, width, height, scale):
+    # Point and crop box coordinates of SAM, back to the original image
+    if 'point_coords' in mask_info:
+        mask_info['point_coords'] = [[x / scale, y / scale] for x, y in mask_info['point_coords']]
+    if 'crop_box' in mask_info:
+        x, y, w, h = mask_info['crop_box']
+        mask_info['crop_box'] = [int(round(x / scale)), int(round(y / scale)),
+                                 min(width, int(round(w / scale))), min(height, int(round(h / scale)))]
+    return mask_info
+
+
+class MaskEngine:
+    """
+    Long-lived SAM mask generator.
+
+    The checkpoint is deserialized once, on the first call to `load` (or `generate`),
+    and the resulting `SamAutomaticMaskGenerator` is reused for every image afterwards.
+
+    Args:
+    - CheckPointPath: str, Path to the SAM Checkpoint file.
+    - model_type: str, SAM backbone registered in `sam_model_registry` (default is "vit_l").
+    - cache: Optional ContentCache; masks of images generated with a cache key are stored in it
+             and returned from it on later runs without running SAM.
+    - max_side: Optional longest image side fed to SAM. Larger images are downscaled first and
+                the masks are mapped back to the original coordinates.
+    - compact: Return CompactMask objects (run-length encoded bbox windows) instead of dense
+               boolean segmentations; SAM then never builds the full-image masks.
+    - generator_kwargs: Extra keyword arguments forwarded to `SamAutomaticMaskGenerator`.
+    """
+
+    def __init__(self, CheckPointPath, model_type="vit_l", cache=None, max_side=None, compact=False, **generator_kwargs):
+        self.CheckPointPath = CheckPointPath
+        self.model_type = model_type
+        self.cache = cache
+        self.max_side = max_side
+        self.compact = compact
+        self.generator_kwargs = generator_kwargs
+        self.mask_generator = None
+
+    @property
+    def cache_tag(self):
+        return sam_cache_tag(self.model_type, self.generator_kwargs, self.max_side)
+
+    @property
+    def loaded(self):
+        return self.mask_generator is not None
+
+    def load(self):
+        """
+        Load the SAM checkpoint and build the mask generator if not done already (warm start).
+
+        Returns:
+        - self, so the call can be chained.
+        """
+        if self.mask_generator is None:
+            # segment_anything (and torch with it) is only imported when SAM is actually needed
+            from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+            sam = sam_model_registry[self.model_type](checkpoint=self.CheckPointPath)
+            generator_kwargs = dict(self.generator_kwargs)
+            if self.compact:
+                generator_kwargs['output_mode'] = 'uncompressed_rle'
+            self.mask_generator = SamAutomaticMaskGenerator(sam, **generator_kwargs)
+        return self
+
+    def generate(self, image, cache_key=None):
+        """
+        Generate masks for a single image.
+
+        Args:
+        - image: Input image.
+        - cache_key: Optional cache key of the image (see `Local_Cache.file_cache_key`).
+
+        Returns:
+        - masks: List of masks.
+        """
+        if self.cache is not None and cache_key is not None:
+            masks = self.cache.get_masks(cache_key, self.cache_tag, self.compact)
+            if masks is not None:
+                return masks
+
+        self.load()
+        image = np.asarray(image)
+        small_image, scale = downscale_image(image, self.max_side)
+        masks = self.mask_generator.generate(np.array(small_image))
+        if self.compact:
+            masks = [CompactMask.from_sam(mask_info) for mask_info in masks]
+        if scale != 1.0:
+            masks = upscale_masks(masks, image.shape, scale)
+
+        if self.cache is not None and cache_key is not None:
+            self.cache.put_masks(cache_key, masks, self.cache_tag)
+        return masks
+
+    def generate_many(self, images, cache_keys=None):
+        """
+        Generate masks for several images, one after the other, with the same loaded model.
+
+        Args:
+        - images: Iterable of input images.
+        - cache_keys: Optional iterable with the cache key of each image.
+
+        Returns:
+        - masks_list: List with the list of masks of each image.
+        """
+        if cache_keys is None:
+            return [self.generate(image) for image in images]
+        return [self.generate(image, cache_key) for image, cache_key in zip(images, cache_keys)]
+
+
+# Engines shared by every caller in this process, keyed by checkpoint and configuration
+_mask_engines = {}
+
+
+def get_mask_engine(CheckPointPath, model_type="vit_l", cache=None, max_side=None, compact=False, **generator_kwargs):
+    """
+    Return the process-wide mask engine for the given checkpoint and configuration, creating it if needed.
+
+    Args:
+    - CheckPointPath: str, Path to the SAM Checkpoint file.
+    - model_type: str, SAM backbone (default is "vit_l").
+    - cache: Optional ContentCache to attach to the engine.
+    - max_side: Optional longest image side fed to SAM.
+    - compact: Return CompactMask objects instead of dense masks.
+    - generator_kwargs: Extra keyword arguments forwarded to `SamAutomaticMaskGenerator`.
+
+    Returns:
+    - engine: MaskEngine instance (not loaded until first used or `load` is called).
+    """
+    key = (CheckPointPath, model_type, max_side, compact, tuple(sorted(generator_kwargs.items())))
+    if key not in _mask_engines:
+        _mask_engines[key] = MaskEngine(CheckPointPath, model_type, max_side=max_side, compact=compact, **generator_kwargs)
+    if cache is not None:
+        _mask_engines[key].cache = cache
+    return _mask_engines[key]
+
+
+def get_profile_engine(profile, CheckPointPath, cache=None, compact=False):
+    """
+    Return the process-wide mask engine of a SAM speed profile.
+
+    Args:
+    - profile: str, Name of the profile in SAM_PROFILES.
+    - CheckPointPath: str, Path to the SAM Checkpoint file of the profile backbone
+                      (see `Paths.get_sam_checkpoint_path`).
+    - cache: Optional ContentCache to attach to the engine.
+    - compact: Return CompactMask objects instead of dense masks.
+
+    Returns:
+    - engine: MaskEngine instance (not loaded until first used or `load` is called).
+    """
+    model_type, max_side, generator_kwargs = get_sam_profile(profile)
+    return get_mask_engine(CheckPointPath, model_type, cache, max_side, compact, **generator_kwargs)
+
 
 def generate_masks(image, CheckPointPath):
     """
     Generate masks from an image using a mask generator.
 
+    The SAM model is loaded once per process and shared through `get_mask_engine`.
+
     Args:
     - image: Input image.
     - CheckPointPath: str, Path to the SAM Checkpoint file.
@@ -11,14 +297,44 @@ def generate_masks(image, CheckPointPath):
     Returns:
     - masks: List of masks.
     """
+    return get_mask_engine(CheckPointPath).generate(image)
+
+# Filtering criteria
+MIN_LEAF_AREA_RATIO = 0.4  # Minimum leaf area, as a fraction of the largest mask area of the image
+MAX_ASPECT_RATIO = 2.5  # Maximum aspect ratio for a leaf
+
+
+def mask_statistics(masks_l):
+    """
+    Gather the SAM metadata of a set of masks into numpy arrays, without touching the segmentations.
+
+    Args:
+    - masks_l: List of masks.
+
+    Returns:
+    - stats: Dictionary of arrays, one value per mask: 'area', 'bbox' (N x 4, XYWH),
+             'aspect_ratio', 'predicted_iou' and 'stability_score'.
+    """
+    count = len(masks_l)
+    area = np.fromiter((mask_info['area'] for mask_info in masks_l), dtype=np.float64, count=count)
+    bbox = np.array([mask_info['bbox'] for mask_info in masks_l], dtype=np.float64).reshape(count, 4)
+    predicted_iou = np.fromiter((mask_info.get('predicted_iou', 0.0) for mask_info in masks_l), dtype=np.float64, count=count)
+    stability_score = np.fromiter((mask_info.get('stability_score', 0.0) for mask_info in masks_l), dtype=np.float64, count=count)
+
+    # SAM boxes span from the first to the last mask pixel (w = x_max - x_min), while the aspect
+    # ratio is measured on the pixel extent of the mask, as cv2.boundingRect does
+    width = bbox[:, 2] + 1
+    height = bbox[:, 3] + 1
+    aspect_ratio = width / height
+
+    return {
+        'area': area,
+        'bbox': bbox,
+        'aspect_ratio': aspect_ratio,
+        'predicted_iou': predicted_iou,
+        'stability_score': stability_score,
+    }
 
-    model_type = "vit_l"
-    sam = sam_model_registry[model_type](checkpoint=CheckPointPath)
-    mask_generator = SamAutomaticMaskGenerator(sam)
-    # Generate masks
-    masks = mask_generator.generate(np.array(image))
-    
-    return masks
 
 def filter_parameters(df):
     """
@@ -31,119 +347,391 @@ def filter_parameters(df):
     - min_leaf_areas: list, Minimum leaf areas calculated based on maximum mask areas.
     """
     # Define filtering criteria
-    area_max = [max(mask_info['area'] for mask_info in mask_1) for mask_1 in df['Masks']]
-    min_leaf_areas = [0.4 * max_area for max_area in area_max]  # Minimum area for a leaf
+    area_max = [mask_statistics(mask_1)['area'].max() for mask_1 in df['Masks']]
+    min_leaf_areas = [MIN_LEAF_AREA_RATIO * max_area for max_area in area_max]  # Minimum area for a leaf
     return min_leaf_areas
 
-def filter_masks(masks_l, min_leaf_area):
+
+def leaf_mask_selection(stats, min_leaf_area, max_aspect_ratio=MAX_ASPECT_RATIO, min_predicted_iou=None, min_stability_score=None):
+    """
+    Apply the leaf criteria to the statistics of a set of masks, all at once.
+
+    Args:
+    - stats: Mask statistics from `mask_statistics`.
+    - min_leaf_area: Minimum area threshold for a leaf (scalar, or one value per mask).
+    - max_aspect_ratio: Maximum aspect ratio for a leaf.
+    - min_predicted_iou: Optional minimum SAM predicted IoU.
+    - min_stability_score: Optional minimum SAM stability score.
+
+    Returns:
+    - keep: Boolean array, True for the masks that meet the criteria.
+    """
+    keep = (stats['area'] > min_leaf_area) & (stats['aspect_ratio'] < max_aspect_ratio)
+    if min_predicted_iou is not None:
+        keep &= stats['predicted_iou'] >= min_predicted_iou
+    if min_stability_score is not None:
+        keep &= stats['stability_score'] >= min_stability_score
+    return keep
+
+
+def filter_masks(masks_l, min_leaf_area=None, max_aspect_ratio=MAX_ASPECT_RATIO, min_predicted_iou=None, min_stability_score=None):
     """
     Filter masks based on area and aspect ratio criteria.
 
+    The criteria are evaluated on the SAM 'area' and 'bbox' of all the masks at once; the
+    segmentation of a mask is only looked up if it survives. Compact masks are kept compact:
+    they are their own filtered segmentation.
+
     Args:
-    - masks_l: List of masks.
-    - min_leaf_area: Minimum area threshold for a leaf.
+    - masks_l: List of masks (dictionaries or CompactMask).
+    - min_leaf_area: Minimum area threshold for a leaf. Defaults to 0.4 times the largest mask area.
+    - max_aspect_ratio: Maximum aspect ratio for a leaf.
+    - min_predicted_iou: Optional minimum SAM predicted IoU.
+    - min_stability_score: Optional minimum SAM stability score.
 
     Returns:
     - filtered_masks: List of filtered masks.
     - masks_b: List of mask information corresponding to filtered masks.
     """
-    max_aspect_ratio = 2.5  # Maximum aspect ratio for a leaf
-    filtered_masks = []
-    masks_b = []
-    for mask_info in masks_l:
-        # Get the segmentation mask
-        mask = mask_info['segmentation']
+    if len(masks_l) == 0:
+        return [], []
 
-        # Compute the area of the segmented region
-        area = np.sum(mask)
+    stats = mask_statistics(masks_l)
+    if min_leaf_area is None:
+        min_leaf_area = MIN_LEAF_AREA_RATIO * stats['area'].max()
 
-        # Compute the bounding box of the segmented region
-        contours, _ = cv2.findContours(np.uint8(mask), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        x, y, w, h = cv2.boundingRect(contours[0])
+    keep = leaf_mask_selection(stats, min_leaf_area, max_aspect_ratio, min_predicted_iou, min_stability_score)
 
-        # Compute the aspect ratio of the bounding box
-        aspect_ratio = w / h if h != 0 else 0
+    masks_b = [masks_l[index] for index in np.flatnonzero(keep)]
+    filtered_masks = [_segmentation(mask_info) for mask_info in masks_b]
+    return filtered_masks, masks_b
 
-        # Check if the mask meets the filtering criteria
-        if area > min_leaf_area and aspect_ratio < max_aspect_ratio:
-            filtered_masks.append(mask)
-            masks_b.append(mask_info)
 
-    return filtered_masks, masks_b
+def _segmentation(mask_info):
+    # Compact masks are only decoded when their leaf is cropped
+    if isinstance(mask_info, CompactMask):
+        return mask_info
+    return mask_info['segmentation']
 
 
-def prepare_test_images(masked_images, img_size=(224, 224), color_mode='rgb'):
+def filter_masks_batch(masks_sets, min_leaf_areas=None, max_aspect_ratio=MAX_ASPECT_RATIO, min_predicted_iou=None, min_stability_score=None):
     """
-    Prepare test images for input to the model from masked image arrays.
+    Filter the masks of several images in one vectorized pass.
 
     Args:
-    - masked_images: List of masked images (arrays).
-    - img_size: Tuple specifying the target size of the images (default is (224, 224)).
-    - color_mode: Color mode of the images ('rgb' or 'grayscale').
+    - masks_sets: List with the list of masks of each image.
+    - min_leaf_areas: Optional minimum leaf area of each image. Defaults to 0.4 times the
+                      largest mask area of each image.
+    - max_aspect_ratio: Maximum aspect ratio for a leaf.
+    - min_predicted_iou: Optional minimum SAM predicted IoU.
+    - min_stability_score: Optional minimum SAM stability score.
 
     Returns:
-    - test_images_prepared: A numpy array containing the prepared test images.
+    - results: List with the (filtered_masks, masks_b) of each image, as returned by `filter_masks`.
     """
+    counts = np.array([len(masks_l) for masks_l in masks_sets], dtype=np.int64)
+    all_masks = [mask_info for masks_l in masks_sets for mask_info in masks_l]
+    if len(all_masks) == 0:
+        return [([], []) for _ in masks_sets]
 
-    # Initialize an empty list to store prepared images
-    test_images_prepared = []
+    stats = mask_statistics(all_masks)
+    image_index = np.repeat(np.arange(len(masks_sets)), counts)
 
-    # Preprocess each masked image
-    for masked_image in masked_images:
+    if min_leaf_areas is None:
+        # Largest mask area of each image; images without masks get no threshold at all
+        max_areas = np.zeros(len(masks_sets))
+        np.maximum.at(max_areas, image_index, stats['area'])
+        min_leaf_areas = MIN_LEAF_AREA_RATIO * max_areas
+    min_leaf_area = np.asarray(min_leaf_areas, dtype=np.float64)[image_index]
 
+    keep = leaf_mask_selection(stats, min_leaf_area, max_aspect_ratio, min_predicted_iou, min_stability_score)
 
-        # Resize the non-black region to fit within a 220x220 dimension
-        resized_masked_image = cv2.resize(masked_image, (150, 150))
+    results = [([], []) for _ in masks_sets]
+    for index in np.flatnonzero(keep):
+        filtered_masks, masks_b = results[image_index[index]]
+        masks_b.append(all_masks[index])
+        filtered_masks.append(_segmentation(all_masks[index]))
+    return results
 
-        # Create a black image of size 224x224
-        final_image = np.zeros((224, 224, 3), dtype=np.uint8)
 
-        # Insert the resized non-black region into the black image at an appropriate position
-        final_image[37 : 187 , 37 : 187, :] = resized_masked_image
+# Duplicate criteria
+DEDUP_IOU_THRESHOLD = 0.7  # Masks overlapping more than this are the same leaf
+DEDUP_CONTAINMENT_THRESHOLD = 0.8  # A mask lying this much inside a better one is a part of it
 
-        # Resize the image to the specified size
-        img_resized = tf.image.resize(final_image, img_size)
+# Number of set bits of each byte value
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int64)
 
-        # Normalize pixel values to [0, 1]
-        #img_normalized = img_resized / 255.0
-        # Append preprocessed image to the list
-        test_images_prepared.append(img_resized)
 
-    # Convert list of images to numpy array
-    test_images_prepared = np.array(test_images_prepared)
+def _packed_window(mask_info):
+    """
+    Bit-packed rows of the bbox window of a mask. The window is widened left to a multiple of 8
+    pixels so that the bytes of any two masks line up on the same image columns.
 
-    return test_images_prepared
+    Returns:
+    - packed: 2D uint8 array, 8 pixels per byte.
+    - first_byte: Image column of the first byte, divided by 8.
+    - first_row: Image row of the first row.
+    """
+    x, y, w, h = (int(value) for value in mask_info['bbox'])
+    if isinstance(mask_info, CompactMask):
+        window = mask_info.window()
+    else:
+        window = np.asarray(mask_info['segmentation'])[y:y + h + 1, x:x + w + 1]
+    if x % 8:
+        window = np.pad(window, ((0, 0), (x % 8, 0)))
+    return np.packbits(window, axis=1), x // 8, y
 
 
-def get_masked_leaves(filtered_masks_set, image):
+def mask_overlaps(masks_l):
     """
-    Process masks and generate test images.
+    Intersection area of every pair of masks whose boxes overlap.
+
+    The boxes of all the masks are compared at once; only the pairs with overlapping boxes have
+    their pixels compared, as the AND of their bit-packed windows on the common rows and bytes.
 
     Args:
-    - filtered_masks_set: List of filtered masks.
-    - image: Input image.
+    - masks_l: List of masks (dictionaries or CompactMask).
+
+    Returns:
+    - first: Array with the index of the first mask of each pair.
+    - second: Array with the index of the second mask of each pair (second > first).
+    - intersections: Array with the number of pixels of each pair in both masks.
+    """
+    bbox = mask_statistics(masks_l)['bbox']
+    x0, y0 = bbox[:, 0], bbox[:, 1]
+    x1, y1 = x0 + bbox[:, 2], y0 + bbox[:, 3]
+    overlap = ((x0[:, None] <= x1[None, :]) & (x0[None, :] <= x1[:, None]) &
+               (y0[:, None] <= y1[None, :]) & (y0[None, :] <= y1[:, None]))
+    first, second = np.nonzero(np.triu(overlap, k=1))
+
+    packed = {}
+    intersections = np.zeros(len(first), dtype=np.int64)
+    for pair, (index_a, index_b) in enumerate(zip(first, second)):
+        for index in (index_a, index_b):
+            if index not in packed:
+                packed[index] = _packed_window(masks_l[index])
+        window_a, byte_a, row_a = packed[index_a]
+        window_b, byte_b, row_b = packed[index_b]
+        rows = slice(max(row_a, row_b), min(row_a + window_a.shape[0], row_b + window_b.shape[0]))
+        columns = slice(max(byte_a, byte_b), min(byte_a + window_a.shape[1], byte_b + window_b.shape[1]))
+        both = (window_a[rows.start - row_a:rows.stop - row_a, columns.start - byte_a:columns.stop - byte_a] &
+                window_b[rows.start - row_b:rows.stop - row_b, columns.start - byte_b:columns.stop - byte_b])
+        intersections[pair] = _POPCOUNT[both].sum()
+    return first, second, intersections
+
+
+def deduplicate_masks(masks_l, iou_threshold=DEDUP_IOU_THRESHOLD, containment_threshold=DEDUP_CONTAINMENT_THRESHOLD):
+    """
+    Find the masks duplicating a better mask of the same leaf: overlapping it with an IoU above
+    `iou_threshold`, or lying inside it (or around it) for more than `containment_threshold`
+    of the smaller mask's area.
+
+    Of two masks overlapping above `iou_threshold`, the one with the higher SAM predicted IoU,
+    then stability score, is the better; of two masks duplicates by containment only, the
+    larger one is, so the whole leaf is kept rather than a part of it SAM is surer of. Masks
+    are then suppressed greedily from the best ranked one down, as in non-maximum suppression:
+    a mask only suppresses others if it is kept itself.
+
+    Args:
+    - masks_l: List of masks (dictionaries or CompactMask), e.g. the `masks_b` of `filter_masks`.
+    - iou_threshold: IoU above which two masks are duplicates.
+    - containment_threshold: Fraction of the smaller mask inside the larger above which they are duplicates.
+
+    Returns:
+    - keep: Boolean array, True for the masks kept.
+    """
+    count = len(masks_l)
+    keep = np.ones(count, dtype=bool)
+    if count < 2:
+        return keep
+
+    stats = mask_statistics(masks_l)
+    first, second, intersections = mask_overlaps(masks_l)
+    area = stats['area']
+    iou = intersections / np.maximum(area[first] + area[second] - intersections, 1)
+    containment = intersections / np.maximum(np.minimum(area[first], area[second]), 1)
+    duplicate = (iou > iou_threshold) | (containment > containment_threshold)
+    first, second, same_mask = first[duplicate], second[duplicate], iou[duplicate] > iou_threshold
+    if len(first) == 0:
+        return keep
+
+    order = np.lexsort((-stats['stability_score'], -stats['predicted_iou']))
+    rank = np.empty(count, dtype=np.int64)
+    rank[order] = np.arange(count)
+    first_better = np.where(same_mask | (area[first] == area[second]), rank[first] < rank[second], area[first] > area[second])
+    better = np.where(first_better, first, second)
+    worse = np.where(first_better, second, first)
+
+    # Duplicates grouped by their better mask
+    by_better = np.argsort(better, kind='stable')
+    better, worse = better[by_better], worse[by_better]
+    starts = np.searchsorted(better, np.arange(count))
+    stops = np.searchsorted(better, np.arange(count), side='right')
+    for index in order:
+        if keep[index]:
+            keep[worse[starts[index]:stops[index]]] = False
+    return keep
+
+
+# Fraction of the classifier input taken by the leaf (150 of 224 pixels)
+LEAF_INNER_RATIO = 150 / 224
+
+
+class PreprocessingConfig:
+    """
+    How leaf crops are turned into classifier inputs.
+
+    Args:
+    - target_size: (height, width) of the images fed to the classifier.
+    - inner_size: (height, width) the leaf is resized to inside the target image ('pad' and 'letterbox').
+    - policy: 'pad' resizes the leaf to `inner_size` and centres it on a black image,
+              'letterbox' does the same but keeps the leaf aspect ratio,
+              'stretch' resizes the leaf to the whole `target_size`.
+    - dtype: dtype of the prepared batch. The EfficientNet-B3 model takes float32 pixels in [0, 255].
+    - interpolation: OpenCV interpolation flag used for resizing.
+    """
+
+    def __init__(self, target_size=(224, 224), inner_size=(150, 150), policy='pad', dtype=np.float32, interpolation=cv2.INTER_LINEAR):
+        if policy not in ('pad', 'letterbox', 'stretch'):
+            raise ValueError(f"Unknown preprocessing policy: {policy}")
+        self.target_size = tuple(target_size)
+        self.inner_size = tuple(inner_size)
+        self.policy = policy
+        self.dtype = np.dtype(dtype)
+        self.interpolation = interpolation
+
+    def allocate(self, count):
+        """
+        Allocate the black batch buffer for `count` leaves.
+        """
+        return np.zeros((count, self.target_size[0], self.target_size[1], 3), dtype=self.dtype)
+
+
+# What the EfficientNet-B3 classifier expects: a 150x150 leaf centred on a black 224x224 image
+DEFAULT_PREPROCESSING = PreprocessingConfig()
+
+
+def _resize(image, size, interpolation):
+    # Identity resizes are skipped
+    if image.shape[:2] == size:
+        return image
+    return cv2.resize(image, (size[1], size[0]), interpolation=interpolation)
+
+
+def place_leaf(canvas, masked_image, config=DEFAULT_PREPROCESSING):
+    """
+    Resize a leaf crop and write it into its (black) image of the batch buffer, in place.
+
+    Args:
+    - canvas: Array of shape (height, width, 3) to write into.
+    - masked_image: Masked leaf crop.
+    - config: PreprocessingConfig to apply.
+    """
+    target_h, target_w = config.target_size
+    if config.policy == 'stretch':
+        canvas[...] = _resize(masked_image, config.target_size, config.interpolation)
+        return
+
+    inner_h, inner_w = config.inner_size
+    if config.policy == 'letterbox':
+        scale = min(inner_h / masked_image.shape[0], inner_w / masked_image.shape[1])
+        inner_h = max(1, int(round(masked_image.shape[0] * scale)))
+        inner_w = max(1, int(round(masked_image.shape[1] * scale)))
+
+    top = (target_h - inner_h) // 2
+    left = (target_w - inner_w) // 2
+    canvas[top : top + inner_h, left : left + inner_w, :] = _resize(masked_image, (inner_h, inner_w), config.interpolation)
+
+
+def prepare_test_images(masked_images, img_size=(224, 224), color_mode='rgb', out=None, config=None):
+    """
+    Prepare test images for input to the model from masked image arrays.
+
+    The whole batch is produced in one contiguous buffer, in the dtype the model expects.
+
+    Args:
+    - masked_images: List (or iterable) of masked images (arrays).
+    - img_size: Tuple specifying the target size of the images (default is (224, 224)).
+                Ignored if `config` is given.
+    - color_mode: Color mode of the images ('rgb' or 'grayscale').
+    - out: Optional preallocated zero-filled buffer from `config.allocate`, filled in place.
+           Required when `masked_images` is an iterator without a length.
+    - config: PreprocessingConfig to apply (default is the EfficientNet-B3 preprocessing).
 
     Returns:
     - test_images_prepared: A numpy array containing the prepared test images.
     """
-    test_images = []
+    if config is None:
+        config = DEFAULT_PREPROCESSING
+        if tuple(img_size) != config.target_size:
+            # Same layout as the default, scaled to the requested size
+            inner_size = tuple(int(round(size * LEAF_INNER_RATIO)) for size in img_size)
+            config = PreprocessingConfig(target_size=img_size, inner_size=inner_size)
+
+    if out is None:
+        masked_images = list(masked_images)
+        out = config.allocate(len(masked_images))
+
+    # Resize each leaf and insert it into its black image of the batch buffer
+    for index, masked_image in enumerate(masked_images):
+        place_leaf(out[index], masked_image, config)
+
+    return out
+
+
+def crop_masked_leaf(mask, image, bbox=None):
+    """
+    Cut the bounding box of a mask out of the image, with the pixels outside the mask set to black.
+
+    Only the bounding box window of the image is copied and masked.
+
+    Args:
+    - mask: Boolean segmentation mask of the leaf, or CompactMask (only its window is decoded).
+    - image: Input image.
+    - bbox: Optional SAM bounding box [x, y, w, h] of the mask; computed from the mask if not given.
 
-    for mask in filtered_masks_set:
-        # Get the bounding box of the non-black region
-        non_zero_indices = np.argwhere(mask)
+    Returns:
+    - masked_image: The masked leaf crop.
+    """
+    if isinstance(mask, CompactMask):
+        x, y, w, h = mask.bbox
+        masked_image = image[y:y + h + 1, x:x + w + 1].copy()
+        masked_image[~mask.window()] = 0
+        return masked_image
+
+    if bbox is None:
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        min_y, max_y, min_x, max_x = rows[0], rows[-1], cols[0], cols[-1]
+    else:
+        # SAM boxes span from the first to the last mask pixel
+        x, y, w, h = (int(value) for value in bbox)
+        min_x, max_x, min_y, max_y = x, x + w, y, y + h
+
+    # Apply the mask inside the bounding box only
+    masked_image = image[min_y:max_y + 1, min_x:max_x + 1].copy()
+    masked_image[~mask[min_y:max_y + 1, min_x:max_x + 1]] = 0  # Set non-masked regions to black
+    return masked_image
+
+
+def get_masked_leaves(filtered_masks_set, image, bboxes=None, config=DEFAULT_PREPROCESSING):
+    """
+    Process masks and generate test images.
 
-        # Calculate the bounding box coordinates
-        min_x = np.min(non_zero_indices[:, 1])
-        max_x = np.max(non_zero_indices[:, 1])
-        min_y = np.min(non_zero_indices[:, 0])
-        max_y = np.max(non_zero_indices[:, 0])
+    Args:
+    - filtered_masks_set: List of filtered masks (boolean arrays or CompactMask).
+    - image: Input image.
+    - bboxes: Optional list with the SAM bounding box of each mask, used to crop before masking.
+    - config: PreprocessingConfig to apply.
 
-        # Apply the mask to the image
-        masked_image = np.copy(image)
-        masked_image[~mask] = 0  # Set non-masked regions to black
+    Returns:
+    - test_images_prepared: A numpy array containing the prepared test images.
+    """
+    if bboxes is None:
+        bboxes = [None] * len(filtered_masks_set)
 
-        # Extract the content within the bounding box defined by the mask
-        masked_image = masked_image[min_y:max_y + 1, min_x:max_x + 1]
-        test_images.append(masked_image)
+    # Each crop is written into the batch buffer as soon as it is extracted
+    out = config.allocate(len(filtered_masks_set))
+    masked_leaves = (crop_masked_leaf(mask, image, bbox) for mask, bbox in zip(filtered_masks_set, bboxes))
 
-    return prepare_test_images(test_images)
\ No newline at end of file
+    return prepare_test_images(masked_leaves, out=out, config=config)
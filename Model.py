@@ -1,4 +1,12 @@
-from Libraries import * 
+import cv2
+import numpy as np
+
+# Class names of the classifier outputs, by output index
+CLASS_NAMES = {
+    0: 'Early blight',
+    1: 'Late blight',
+    2: 'Healthy'
+}
 
 def map_numbers_to_classes(numbers):
     """
@@ -10,32 +18,35 @@ def map_numbers_to_classes(numbers):
     Returns:
     - classes: A list of class names corresponding to the input numbers.
     """
-    class_mapping = {
-        0: 'Early blight',
-        1: 'Late blight',
-        2: 'Healthy'
-    }
-
-    classes = [class_mapping[number] for number in numbers]
+    classes = [CLASS_NAMES[number] for number in numbers]
     return classes
 
-def predict_labels(test_gen, model):
+def load_classifier_model(model_path):
     """
-    Make predictions on the test images using the provided model.
+    Load the trained Keras classification model.
+
+    TensorFlow is imported here rather than at module level, so importing this module stays cheap.
 
     Args:
-    - test_gen: Test data generator.
-    - model: Trained model.
+    - model_path: String, path to the classification model file.
 
     Returns:
-    - confidences: List of confidence scores for each prediction.
-    - predictions: List of predicted classifications.
-    - detected_disease: Image Classification
+    - model: The loaded Keras model.
     """
-    preds = model.predict(test_gen)
-    predictions = np.argmax(preds, axis=1)
-    confidences = np.max(preds, axis=1)
+    from tensorflow.keras.models import load_model
+    return load_model(model_path)
+
+
+def get_detected_disease(predictions):
+    """
+    Derive the image classification from the predicted classes of its leaves.
 
+    Args:
+    - predictions: Array of predicted classifications of the leaves of one image.
+
+    Returns:
+    - detected_disease: Image Classification
+    """
     # Check if class 0 or 1 exists in the predictions
     if 0 in predictions or 1 in predictions:
         # Count occurrences of class 0 and class 1
@@ -45,8 +56,157 @@ def predict_labels(test_gen, model):
     else:
         # If only class 2 exists or no predictions, set detected_disease to 2
         detected_disease = 2
-    
-    return confidences, predictions, detected_disease
+
+    return detected_disease
+
+
+def summarize_predictions(preds):
+    """
+    Turn the class probabilities of the leaves of one image into the `predict_labels` outputs.
+
+    Args:
+    - preds: Array of class probabilities, one row per leaf.
+
+    Returns:
+    - confidences: List of confidence scores for each prediction.
+    - predictions: List of predicted classifications.
+    - detected_disease: Image Classification
+    """
+    if len(preds) == 0:
+        # No leaves (the classifiers return a (0, 0) array when no image of a batch has any)
+        return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64), 2
+    predictions = np.argmax(preds, axis=1)
+    confidences = np.max(preds, axis=1)
+    return confidences, predictions, get_detected_disease(predictions)
+
+
+def predict_labels(test_gen, model):
+    """
+    Make predictions on the test images using the provided model.
+
+    Args:
+    - test_gen: Test data generator.
+    - model: Trained model.
+
+    Returns:
+    - confidences: List of confidence scores for each prediction.
+    - predictions: List of predicted classifications.
+    - detected_disease: Image Classification
+    """
+    preds = model.predict(test_gen)
+    return summarize_predictions(preds)
+
+
+def split_predictions(preds, test_gens):
+    """
+    Scatter the class probabilities of leaves pooled from several images back to their images.
+
+    Args:
+    - preds: Array of class probabilities, one row per leaf, in the order of `test_gens`.
+    - test_gens: List with the prepared leaf images of each image.
+
+    Returns:
+    - results: List with the (confidences, predictions, detected_disease) of each image,
+               as returned by `predict_labels`.
+    """
+    results = []
+    start = 0
+    for test_gen in test_gens:
+        results.append(summarize_predictions(preds[start : start + len(test_gen)]))
+        start += len(test_gen)
+    return results
+
+
+class ClassificationEngine:
+    """
+    Batched leaf classifier.
+
+    Leaves from many images are pooled into fixed-size batches and run through a compiled
+    `model(x, training=False)` call, instead of one `model.predict` per image. The last batch
+    is padded to the next power of two (at least 8), so the function is traced only once per
+    bucket size, and a few leaves (e.g. those a cascade passes on) don't cost a whole batch.
+
+    Args:
+    - model: Trained Keras model.
+    - batch_size: Number of leaves per model call.
+    """
+
+    def __init__(self, model, batch_size=64):
+        import tensorflow as tf
+        self.model = model
+        self.batch_size = batch_size
+        self._call = tf.function(lambda x: model(x, training=False))
+        self._buffer = None
+
+    def predict(self, test_gen):
+        """
+        Class probabilities of a batch of prepared leaf images, with the same output as `model.predict`.
+
+        Args:
+        - test_gen: Array of prepared leaf images (N, height, width, 3).
+
+        Returns:
+        - preds: Array of class probabilities, one row per leaf.
+        """
+        return self.predict_many([test_gen])
+
+    def predict_many(self, test_gens):
+        """
+        Class probabilities of the leaves of several images, concatenated in order.
+
+        Args:
+        - test_gens: List with the prepared leaf images of each image.
+
+        Returns:
+        - preds: Array of class probabilities, one row per leaf.
+        """
+        total = sum(len(test_gen) for test_gen in test_gens)
+        preds = None
+        filled = 0
+        done = 0
+
+        for test_gen in test_gens:
+            start = 0
+            while start < len(test_gen):
+                if self._buffer is None or self._buffer.shape[1:] != test_gen.shape[1:]:
+                    self._buffer = np.zeros((self.batch_size,) + test_gen.shape[1:], dtype=np.float32)
+                take = min(self.batch_size - filled, len(test_gen) - start)
+                self._buffer[filled : filled + take] = test_gen[start : start + take]
+                filled += take
+                start += take
+                if filled == self.batch_size:
+                    preds = self._run(preds, total, done, filled)
+                    done += filled
+                    filled = 0
+
+        if filled:
+            preds = self._run(preds, total, done, filled)
+
+        if preds is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return preds
+
+    def _run(self, preds, total, done, filled):
+        # Stale rows past `filled` only pad the batch to its bucket size
+        size = min(self.batch_size, max(8, 1 << (filled - 1).bit_length()))
+        batch_preds = self._call(self._buffer[:size]).numpy()
+        if preds is None:
+            preds = np.empty((total, batch_preds.shape[1]), dtype=batch_preds.dtype)
+        preds[done : done + filled] = batch_preds[:filled]
+        return preds
+
+    def classify_many(self, test_gens):
+        """
+        Classify the leaves of several images together and scatter the results back per image.
+
+        Args:
+        - test_gens: List with the prepared leaf images of each image.
+
+        Returns:
+        - results: List with the (confidences, predictions, detected_disease) of each image,
+                   as returned by `predict_labels`.
+        """
+        return split_predictions(self.predict_many(test_gens), test_gens)
 
 
 def annotate_image(image, bbox_list, confidences, predictions):
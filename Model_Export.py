@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from Paths import get_paths
+from Model import split_predictions, load_classifier_model
+
+"""
+TFLite export of the EfficientNet-B3 leaf classifier, for CPU-only inference without full TensorFlow.
+
+    python Model_Export.py convert [--quantization float16|int8] [--samples samples.npz]
+    python Model_Export.py compare --tflite <model.tflite> --samples samples.npz
+"""
+
+QUANTIZATION_MODES = (None, 'float16', 'int8')
+
+
+def get_tflite_path(model_path, quantization=None):
+    """
+    Path of the TFLite export of a Keras model file.
+
+    Args:
+    - model_path: Path to the Keras (.h5) model file.
+    - quantization: None, 'float16' or 'int8'.
+
+    Returns:
+    - tflite_path: Path next to the Keras model, with the quantization mode in its name.
+    """
+    base = os.path.splitext(model_path)[0]
+    return f"{base}-{quantization}.tflite" if quantization else f"{base}.tflite"
+
+
+def convert_to_tflite(model_path, output_path=None, quantization=None, representative_images=None):
+    """
+    Convert the Keras classifier to a TFLite flatbuffer.
+
+    Args:
+    - model_path: Path to the Keras (.h5) model file.
+    - output_path: Where to write the .tflite file (default is `get_tflite_path`).
+    - quantization: None (float32), 'float16' (float16 weights) or 'int8'. With representative
+                    images int8 quantizes weights and activations, otherwise only the weights.
+    - representative_images: Optional array of prepared leaf images used to calibrate int8 activations.
+
+    Returns:
+    - output_path: Path of the written .tflite file.
+    """
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {quantization}")
+    if output_path is None:
+        output_path = get_tflite_path(model_path, quantization)
+
+    import tensorflow as tf
+
+    model = load_classifier_model(model_path)
+    with tempfile.TemporaryDirectory() as saved_model_dir:
+        # Going through a SavedModel export; from_keras_model fails on Keras 3 models with TF 2.16
+        model.export(saved_model_dir)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+        _configure_quantization(converter, quantization, representative_images)
+        tflite_model = converter.convert()
+
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    return output_path
+
+
+def _configure_quantization(converter, quantization, representative_images):
+    """
+    Set the converter options of the quantization mode (see `convert_to_tflite`).
+    """
+    import tensorflow as tf
+
+    if quantization is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8' and representative_images is not None:
+        def representative_dataset():
+            for image in representative_images:
+                yield [np.asarray(image, dtype=np.float32)[np.newaxis]]
+        converter.representative_dataset = representative_dataset
+
+
+def _make_interpreter(tflite_path, num_threads):
+    try:
+        # The standalone runtime is much lighter than full TensorFlow
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter(model_path=tflite_path, num_threads=num_threads)
+
+
+class TFLiteClassifier:
+    """
+    Leaf classifier running a TFLite export of the Keras model.
+
+    It has the same `predict` as a Keras model, so it can be passed to `predict_labels`,
+    and the same `classify_many` as ClassificationEngine, so it can be used by the pipeline.
+
+    Args:
+    - tflite_path: Path to the .tflite file.
+    - batch_size: Number of leaves per interpreter call.
+    - num_threads: Number of CPU threads used by the interpreter (default lets TFLite decide).
+    """
+
+    def __init__(self, tflite_path, batch_size=64, num_threads=None):
+        self.tflite_path = tflite_path
+        self.batch_size = batch_size
+        self.interpreter = _make_interpreter(tflite_path, num_threads)
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self._batch_shape = None
+
+    def _invoke(self, batch):
+        if self._batch_shape != batch.shape:
+            self.interpreter.resize_tensor_input(self.input_details['index'], batch.shape)
+            self.interpreter.allocate_tensors()
+            self._batch_shape = batch.shape
+
+        input_dtype = self.input_details['dtype']
+        if np.issubdtype(input_dtype, np.integer):
+            # Fully quantized input: map the pixel values to the quantized range
+            scale, zero_point = self.input_details['quantization']
+            batch = np.clip(np.round(batch / scale + zero_point), np.iinfo(input_dtype).min, np.iinfo(input_dtype).max)
+        self.interpreter.set_tensor(self.input_details['index'], batch.astype(input_dtype))
+        self.interpreter.invoke()
+
+        output = self.interpreter.get_tensor(self.output_details['index'])
+        if np.issubdtype(output.dtype, np.integer):
+            scale, zero_point = self.output_details['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+    def predict(self, test_gen):
+        """
+        Class probabilities of a batch of prepared leaf images, with the same output as `model.predict`.
+
+        Args:
+        - test_gen: Array of prepared leaf images (N, height, width, 3).
+
+        Returns:
+        - preds: Array of class probabilities, one row per leaf.
+        """
+        test_gen = np.asarray(test_gen, dtype=np.float32)
+        preds = [self._invoke(test_gen[start : start + self.batch_size]) for start in range(0, len(test_gen), self.batch_size)]
+        return np.concatenate(preds) if preds else np.zeros((0, 0), dtype=np.float32)
+
+    def classify_many(self, test_gens):
+        """
+        Classify the leaves of several images together and scatter the results back per image.
+
+        Args:
+        - test_gens: List with the prepared leaf images of each image.
+
+        Returns:
+        - results: List with the (confidences, predictions, detected_disease) of each image.
+        """
+        return split_predictions(self.predict(np.concatenate(test_gens)), test_gens)
+
+
+def save_sample_set(path, images, labels=None):
+    """
+    Store prepared leaf images (and optionally their true classes) for parity checks.
+    """
+    if labels is None:
+        np.savez_compressed(path, images=images)
+    else:
+        np.savez_compressed(path, images=images, labels=np.asarray(labels))
+
+
+def load_sample_set(path):
+    """
+    Load a sample set stored by `save_sample_set`.
+
+    Returns:
+    - images: Array of prepared leaf images.
+    - labels: Array of true classes, or None if the set has none.
+    """
+    with np.load(path) as data:
+        return data['images'], (data['labels'] if 'labels' in data else None)
+
+
+def time_per_leaf(predict, images, repeats=1):
+    """
+    Time a classifier over a set of prepared leaf images.
+
+    A first untimed pass over the whole set warms the classifier up, tracing every batch size
+    the timed passes use.
+
+    Args:
+    - predict: Function returning the class probabilities of an array of leaf images.
+    - images: Array of prepared leaf images.
+    - repeats: Number of timed passes.
+
+    Returns:
+    - preds: Class probabilities of the last pass.
+    - ms_per_leaf: Mean milliseconds per leaf.
+    """
+    predict(images)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        preds = predict(images)
+    return preds, (time.perf_counter() - start) * 1000 / (repeats * max(len(images), 1))
+
+
+def compare_backends(keras_model, tflite_classifier, images, labels=None, repeats=3):
+    """
+    Accuracy parity and latency of a TFLite classifier against the Keras model.
+
+    Args:
+    - keras_model: Trained Keras model.
+    - tflite_classifier: TFLiteClassifier to compare.
+    - images: Array of prepared leaf images.
+    - labels: Optional array of true classes.
+    - repeats: Number of timed passes over the images.
+
+    Returns:
+    - report: Dictionary with the class agreement between both backends, the largest probability
+              difference, the accuracy of each backend (if labels are given) and their latency per leaf.
+    """
+    keras_preds, keras_ms = time_per_leaf(lambda x: keras_model.predict(x, verbose=0), images, repeats)
+    tflite_preds, tflite_ms = time_per_leaf(tflite_classifier.predict, images, repeats)
+
+    keras_classes = np.argmax(keras_preds, axis=1)
+    tflite_classes = np.argmax(tflite_preds, axis=1)
+    report = {
+        'samples': int(len(images)),
+        'class_agreement': float(np.mean(keras_classes == tflite_classes)),
+        'max_probability_difference': float(np.max(np.abs(keras_preds - tflite_preds))),
+        'keras_ms_per_leaf': keras_ms,
+        'tflite_ms_per_leaf': tflite_ms,
+    }
+    if labels is not None:
+        report['keras_accuracy'] = float(np.mean(keras_classes == labels))
+        report['tflite_accuracy'] = float(np.mean(tflite_classes == labels))
+    return report
+
+
+if __name__ == '__main__':
+    _, _, Model_path, *_ = get_paths()
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='Export the Keras model to TFLite')
+    convert_parser.add_argument('--model', default=Model_path)
+    convert_parser.add_argument('--output')
+    convert_parser.add_argument('--quantization', choices=['float16', 'int8'])
+    convert_parser.add_argument('--samples', help='Sample set (.npz) used to calibrate int8 activations')
+
+    compare_parser = subparsers.add_parser('compare', help='Accuracy parity and latency against the Keras model')
+    compare_parser.add_argument('--model', default=Model_path)
+    compare_parser.add_argument('--tflite', required=True)
+    compare_parser.add_argument('--samples', required=True)
+    compare_parser.add_argument('--threads', type=int)
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        representative_images = load_sample_set(args.samples)[0] if args.samples else None
+        print(convert_to_tflite(args.model, args.output, args.quantization, representative_images))
+    else:
+        images, labels = load_sample_set(args.samples)
+        report = compare_backends(load_classifier_model(args.model), TFLiteClassifier(args.tflite, num_threads=args.threads), images, labels)
+        print(json.dumps(report, indent=2))
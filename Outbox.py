@@ -0,0 +1,262 @@
+import json
+import sqlite3
+import threading
+import time
+import traceback
+
+"""
+Durable outbox of the writes the pipeline makes once a folder has been processed:
+thumbnail uploads to Drive ('drive_upload'), `create_image` calls to the backend
+('create_image') and the final move of the folder to the checked folder ('move_folder').
+
+The results of a folder are written to a local SQLite file in one transaction, then
+delivered by `Outbox.flush` (or an OutboxFlusher thread), which retries failed items with
+backoff until they are acknowledged. An item waits for the item it depends on (a
+'create_image' for its thumbnail upload, an annotated image upload for the thumbnail), and the 'move_folder' item of a folder only runs once every other item of
+the folder is acknowledged, so a backend outage never loses results nor requires running
+SAM on the folder again. Once the move is acknowledged, the rows of the folder are deleted, so
+the file does not grow with every folder processed and the folder can be processed again if it
+is put back in the unchecked folder.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    folder TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    data BLOB,
+    depends_on INTEGER REFERENCES items(id),
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    result TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_status ON items (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS items_folder ON items (folder, status);
+"""
+
+# Items ready to be sent: pending, due, with their dependency acknowledged, and for a folder
+# move, no other item of the folder left to acknowledge
+READY_QUERY = """
+SELECT items.id, items.folder, items.kind, items.payload, items.data, items.attempts, dependency.result
+FROM items LEFT JOIN items AS dependency ON dependency.id = items.depends_on
+WHERE items.status = 'pending' AND items.next_attempt_at <= ?
+  AND (items.depends_on IS NULL OR dependency.status = 'done')
+  AND (items.kind != 'move_folder' OR NOT EXISTS (
+      SELECT 1 FROM items AS other
+      WHERE other.folder = items.folder AND other.id != items.id AND other.status != 'done'))
+ORDER BY items.id
+LIMIT ?
+"""
+
+
+class Outbox:
+    """
+    SQLite outbox of pending writes.
+
+    Args:
+    - path: Path of the SQLite file.
+    - backoff: Delay in seconds before the first retry of a failed item, doubled on each retry.
+    - max_backoff: Maximum delay in seconds between two attempts of an item.
+    """
+
+    def __init__(self, path, backoff=30, max_backoff=3600):
+        self.path = path
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def enqueue_folder(self, folder, uploads, create_images, move):
+        """
+        Store every write of a processed folder, atomically.
+
+        Args:
+        - folder: Identifier of the folder (Drive folder id).
+        - uploads: List of (payload, jpeg_bytes, upload_index) of the Drive uploads, where
+                   `upload_index` is the position in `uploads` of an earlier upload to chain
+                   this one after, or None.
+        - create_images: List of (payload, upload_index) of the `create_image` calls, where
+                         `upload_index` is the position in `uploads` of the (last chained) upload
+                         whose links go into the payload, or None.
+        - move: Payload of the final folder move, or None.
+
+        Returns:
+        - count: Number of items stored.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN")
+            try:
+                upload_ids = []
+                for payload, data, upload_index in uploads:
+                    depends_on = upload_ids[upload_index] if upload_index is not None else None
+                    cursor.execute("INSERT INTO items (folder, kind, payload, data, depends_on, created_at) VALUES (?, 'drive_upload', ?, ?, ?, ?)",
+                                   (folder, json.dumps(payload), data, depends_on, now))
+                    upload_ids.append(cursor.lastrowid)
+                for payload, upload_index in create_images:
+                    depends_on = upload_ids[upload_index] if upload_index is not None else None
+                    cursor.execute("INSERT INTO items (folder, kind, payload, depends_on, created_at) VALUES (?, 'create_image', ?, ?, ?)",
+                                   (folder, json.dumps(payload), depends_on, now))
+                if move is not None:
+                    cursor.execute("INSERT INTO items (folder, kind, payload, created_at) VALUES (?, 'move_folder', ?, ?)",
+                                   (folder, json.dumps(move), now))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        return len(uploads) + len(create_images) + (move is not None)
+
+    def has_folder(self, folder):
+        """
+        True if writes of the folder are waiting to be acknowledged (the folder was processed
+        already but not moved yet).
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM items WHERE folder = ? AND status != 'done' LIMIT 1", (folder,)).fetchone()
+        return row is not None
+
+    def ready_items(self, limit=100, now=None):
+        """
+        Items that can be sent now (or at the time `now`).
+
+        Returns:
+        - items: List of dictionaries with 'id', 'folder', 'kind', 'payload', 'data', 'attempts'
+                 and 'dependency_result' (result of the item it depends on, or None).
+        """
+        with self.lock:
+            rows = self.connection.execute(READY_QUERY, (time.time() if now is None else now, limit)).fetchall()
+        return [{
+            'id': row[0], 'folder': row[1], 'kind': row[2], 'payload': json.loads(row[3]), 'data': row[4],
+            'attempts': row[5], 'dependency_result': json.loads(row[6]) if row[6] is not None else None,
+        } for row in rows]
+
+    def acknowledge(self, item, result=None):
+        """
+        Mark an item as delivered and store its result; thumbnails drop their bytes. A folder
+        move is the last item of its folder, so once it is delivered the folder's rows are deleted.
+        """
+        with self.lock:
+            if item['kind'] == 'move_folder':
+                self.connection.execute("DELETE FROM items WHERE folder = ?", (item['folder'],))
+            else:
+                self.connection.execute("UPDATE items SET status = 'done', attempts = attempts + 1, result = ?, data = NULL, last_error = NULL WHERE id = ?",
+                                        (json.dumps(result), item['id']))
+
+    def retry_later(self, item, error, not_before=None):
+        """
+        Record a failed attempt of an item and schedule its next one (after `not_before`, if given).
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** item['attempts'])
+        next_attempt_at = time.time() + delay
+        if not_before is not None:
+            next_attempt_at = max(next_attempt_at, not_before + 0.001)
+        with self.lock:
+            self.connection.execute("UPDATE items SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                                    (next_attempt_at, str(error), item['id']))
+
+    def flush(self, handlers, batch_size=100, max_rounds=None):
+        """
+        Send the ready items, batch by batch, until none is ready. An item that fails is not
+        tried again in the same flush.
+
+        Args:
+        - handlers: Dictionary mapping each kind to a function taking a list of items and
+                    returning one (ok, result, error) tuple per item.
+        - batch_size: Maximum number of items of one kind handed to a handler at once.
+        - max_rounds: Optional maximum number of batches.
+
+        Returns:
+        - delivered: Number of items acknowledged.
+        """
+        delivered = 0
+        rounds = 0
+        started = time.time()
+        while max_rounds is None or rounds < max_rounds:
+            items = self.ready_items(batch_size, started)
+            if not items:
+                break
+            rounds += 1
+
+            # One batch per kind, in the order the kinds first appear
+            batches = {}
+            for item in items:
+                batches.setdefault(item['kind'], []).append(item)
+            for kind, batch in batches.items():
+                try:
+                    outcomes = handlers[kind](batch)
+                except Exception as e:
+                    traceback.print_exc()
+                    outcomes = [(False, None, e)] * len(batch)
+                for item, (ok, result, error) in zip(batch, outcomes):
+                    if ok:
+                        self.acknowledge(item, result)
+                        delivered += 1
+                    else:
+                        self.retry_later(item, error, started)
+        return delivered
+
+    def stats(self):
+        """
+        Number of items per kind and status, plus the number of pending items that failed at least once.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT kind, status, COUNT(*) FROM items GROUP BY kind, status").fetchall()
+            failing = self.connection.execute("SELECT COUNT(*) FROM items WHERE status = 'pending' AND attempts > 0").fetchone()[0]
+        stats = {'failing': failing}
+        for kind, status, count in rows:
+            stats[f"{kind}.{status}"] = count
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class OutboxFlusher:
+    """
+    Background thread draining an outbox every `interval_seconds`.
+
+    Args:
+    - outbox: Outbox to drain.
+    - handlers: Handlers per kind, as for `Outbox.flush`.
+    - interval_seconds: Time between two flushes.
+    """
+
+    def __init__(self, outbox, handlers, interval_seconds=60):
+        self.outbox = outbox
+        self.handlers = handlers
+        self.interval_seconds = interval_seconds
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='outbox-flusher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def wake(self):
+        """
+        Flush now instead of at the end of the interval (e.g. right after a folder is enqueued).
+        """
+        self.wake_event.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.outbox.flush(self.handlers)
+            except Exception:
+                traceback.print_exc()
+            self.wake_event.wait(self.interval_seconds)
+            self.wake_event.clear()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        self.thread.join()
@@ -45,4 +45,65 @@ def get_paths(current_directory = os.getcwd()):
     # Endpoint2
     create_image_Endpoint_link = "http://rowling-backend3.eastus.azurecontainer.io:8000/api/v1/create_image"
     
-    return CheckPointPath, Credentials_file, Model_path, Unchecked_folder_link, Checked_folder_link, Resized_folder_id, Annotated_folder_id, connection_string, zone_periods_Endpoint_link, create_image_Endpoint_link
\ No newline at end of file
+    return CheckPointPath, Credentials_file, Model_path, Unchecked_folder_link, Checked_folder_link, Resized_folder_id, Annotated_folder_id, connection_string, zone_periods_Endpoint_link, create_image_Endpoint_link
+
+
+# SAM checkpoint file of each backbone
+SAM_CHECKPOINT_NAMES = {
+    "vit_b": "sam_vit_b_01ec64.pth",
+    "vit_l": "sam_vit_l_0b3195.pth",
+    "vit_h": "sam_vit_h_4b8939.pth",
+}
+
+
+def get_sam_checkpoint_path(model_type = "vit_l", current_directory = os.getcwd()):
+    """
+    Construct the path of the SAM checkpoint of a backbone.
+
+    Args:
+    - model_type: String, SAM backbone ('vit_b', 'vit_l' or 'vit_h').
+    - current_directory: String, path to the current directory.
+
+    Returns:
+    - CheckPointPath: String, path to the SAM Checkpoint file.
+    """
+    return os.path.join(current_directory, SAM_CHECKPOINT_NAMES[model_type])
+
+
+def get_cursor_path(current_directory = os.getcwd()):
+    """
+    Construct the path of the persisted Drive listing cursor.
+
+    Args:
+    - current_directory: String, path to the current directory.
+
+    Returns:
+    - Cursor_file: String, path to the listing cursor JSON file.
+    """
+    return os.path.join(current_directory, "drive_cursor.json")
+
+
+def get_cache_directory(current_directory = os.getcwd()):
+    """
+    Construct the path of the local cache of downloaded images and SAM masks.
+
+    Args:
+    - current_directory: String, path to the current directory.
+
+    Returns:
+    - Cache_directory: String, path to the cache directory.
+    """
+    return os.path.join(current_directory, "cache")
+
+
+def get_outbox_path(current_directory = os.getcwd()):
+    """
+    Construct the path of the outbox of pending Drive and backend writes.
+
+    Args:
+    - current_directory: String, path to the current directory.
+
+    Returns:
+    - Outbox_file: String, path to the outbox SQLite file.
+    """
+    return os.path.join(current_directory, "outbox.sqlite3")
@@ -0,0 +1,256 @@
+from collections import deque
+from Drive_authentication import upload_jpeg_to_drive
+from Drive_publishing import render_thumbnail, render_annotated
+from Masks_Generation import filter_masks, deduplicate_masks, get_masked_leaves
+from Model import ClassificationEngine
+from Database_Data import add_features, scale_bboxes
+from Endpoint_data import update_zone_votes
+
+"""
+Streaming version of the processing done in main.py.
+
+Every stage is a generator that takes per-image records (dictionaries) and yields them
+one at a time, so only the image currently being processed is held at full resolution:
+
+    download -> segment -> filter -> deduplicate -> crop -> upload thumbnail -> classify [-> upload annotated]
+
+Masks are best kept as CompactMask (run-length encoded bbox windows, see Mask_Encoding),
+and are dropped as soon as the bboxes and leaf crops have been extracted,
+and the full image is dropped once its thumbnail (or annotated image) is uploaded. Leaves of consecutive images
+are then pooled into classification batches. What is left of each image is a compact
+record with the columns the backend needs.
+"""
+
+
+def segment_images(records, mask_engine):
+    """
+    Generate SAM masks for each image.
+
+    With a SegmentationPool several images are segmented at once, in worker processes.
+
+    Args:
+    - records: Iterable of per-image records with an 'Image' key, and optionally a 'Cache_Key'.
+    - mask_engine: MaskEngine or SegmentationPool used to generate the masks.
+
+    Yields:
+    - record: The record with an added 'Masks' key.
+    """
+    if not hasattr(mask_engine, 'iterate'):
+        for record in records:
+            record['Masks'] = mask_engine.generate(record['Image'], record.get('Cache_Key'))
+            yield record
+        return
+
+    # Records wait here while their image is in flight in the pool
+    pending = deque()
+
+    def images():
+        for record in records:
+            pending.append(record)
+            yield record['Image'], record.get('Cache_Key')
+
+    for masks in mask_engine.iterate(images()):
+        record = pending.popleft()
+        record['Masks'] = masks
+        yield record
+
+
+def filter_images(records):
+    """
+    Filter the masks of each image, dropping the images with non-detected leaves.
+
+    The minimum leaf area of an image is 0.4 times its largest mask area, as in `filter_parameters`.
+    Masks are filtered on their SAM metadata; only the surviving segmentations are kept
+    (compact masks stay compact).
+
+    Args:
+    - records: Iterable of per-image records with a 'Masks' key.
+
+    Yields:
+    - record: The record with 'Filtered_Masks' and 'Masks_b' instead of 'Masks'.
+    """
+    for record in records:
+        masks = record.pop('Masks')
+        record['Filtered_Masks'], record['Masks_b'] = filter_masks(masks)
+        del masks
+        if len(record['Masks_b']) > 0:
+            yield record
+
+
+def deduplicate_leaves(records):
+    """
+    Drop the leaf masks duplicating a better mask of the same leaf (a half leaf, a lesion, the
+    same leaf found twice), before any crop is built, see `deduplicate_masks`.
+
+    Args:
+    - records: Iterable of per-image records with 'Filtered_Masks' and 'Masks_b' keys.
+
+    Yields:
+    - record: The record with the duplicate masks removed from 'Filtered_Masks' and 'Masks_b'.
+    """
+    for record in records:
+        keep = deduplicate_masks(record['Masks_b'])
+        if not keep.all():
+            record['Filtered_Masks'] = [mask for mask, kept in zip(record['Filtered_Masks'], keep) if kept]
+            record['Masks_b'] = [mask_info for mask_info, kept in zip(record['Masks_b'], keep) if kept]
+        yield record
+
+
+def crop_leaves(records):
+    """
+    Extract the leaf crops of each image and the database features, then drop the masks.
+
+    Args:
+    - records: Iterable of per-image records with 'Image', 'Filtered_Masks' and 'Masks_b' keys.
+
+    Yields:
+    - record: The record with 'Test_Gen', 'bbox', 'Edited' and 'Treated' instead of the masks.
+    """
+    for record in records:
+        bboxes = [mask_info['bbox'] for mask_info in record['Masks_b']]
+        record['Test_Gen'] = get_masked_leaves(record.pop('Filtered_Masks'), record['Image'], bboxes)
+        record['bbox'], record['Edited'], record['Treated'] = add_features(record.pop('Masks_b'))
+        yield record
+
+
+def classify_leaves(records, classifier, max_pending_images=16):
+    """
+    Classify the leaf crops of the images, pooling the leaves of consecutive images into
+    the classifier's fixed-size batches.
+
+    Args:
+    - records: Iterable of per-image records with a 'Test_Gen' key.
+    - classifier: ClassificationEngine (or TFLiteClassifier) used to classify the leaves.
+    - max_pending_images: Maximum number of images held back while a batch is being filled.
+
+    Yields:
+    - record: The record with 'Confidence', 'Classification' and 'Image_Class' instead of 'Test_Gen'.
+    """
+    pending = []
+    pending_leaves = 0
+    for record in records:
+        pending.append(record)
+        pending_leaves += len(record['Test_Gen'])
+        if pending_leaves >= classifier.batch_size or len(pending) >= max_pending_images:
+            yield from _classify_pending(pending, classifier)
+            pending = []
+            pending_leaves = 0
+
+    if pending:
+        yield from _classify_pending(pending, classifier)
+
+
+def _classify_pending(pending, classifier):
+    results = classifier.classify_many([record.pop('Test_Gen') for record in pending])
+    for record, (confidences, predictions, detected_disease) in zip(pending, results):
+        record['Confidence'], record['Classification'], record['Image_Class'] = confidences, predictions, detected_disease
+        yield record
+
+
+def publish_thumbnails(records, service, Resized_folder_id, keep_image=False):
+    """
+    Upload a resized copy of each image to Google Drive, then drop the full image.
+
+    Without a service, the resized copy is only JPEG-encoded and kept in the record, to be
+    uploaded later through the outbox (see Outbox.py).
+
+    Args:
+    - records: Iterable of per-image records with an 'Image' key.
+    - service: Drive API service object, or None to defer the uploads.
+    - Resized_folder_id: ID of the folder in Google Drive to upload the resized images to.
+    - keep_image: Keep the full image in the record, for `publish_annotations`.
+
+    Yields:
+    - record: The record with 'Resized_Path' (and 'Resized_Jpeg' if the upload is deferred).
+    """
+    for index, record in enumerate(records):
+        image = record['Image'] if keep_image else record.pop('Image')
+        thumbnail = render_thumbnail(image)
+        if service is None:
+            record['Resized_Jpeg'] = thumbnail
+            record['Resized_Path'] = ''
+        else:
+            record['Resized_Path'] = upload_jpeg_to_drive(service, thumbnail, Resized_folder_id, f"resized_image_{index}.jpg")
+        record['Annotated_Path'] = ''
+        yield record
+
+
+def publish_annotations(records, service, Annotated_folder_id):
+    """
+    Draw the classified leaves on each image and upload it to Google Drive, then drop the full image.
+
+    Without a service, the annotated image is only JPEG-encoded and kept in the record, to be
+    uploaded later through the outbox.
+
+    Args:
+    - records: Iterable of classified per-image records with 'Image', 'bbox', 'Confidence' and 'Classification' keys.
+    - service: Drive API service object, or None to defer the uploads.
+    - Annotated_folder_id: ID of the folder in Google Drive to upload the annotated images to.
+
+    Yields:
+    - record: The record with 'Annotated_Path' (and 'Annotated_Jpeg' if the upload is deferred) instead of 'Image'.
+    """
+    for index, record in enumerate(records):
+        annotated = render_annotated(record.pop('Image'), record['bbox'], record['Confidence'], record['Classification'])
+        if service is None:
+            record['Annotated_Jpeg'] = annotated
+        else:
+            record['Annotated_Path'] = upload_jpeg_to_drive(service, annotated, Annotated_folder_id, f"annotated_image{index}.jpg")
+        yield record
+
+
+def run_pipeline(images, mask_engine, classifier, service, Resized_folder_id, Annotated_folder_id=None, report=None, deduplicate=True):
+    """
+    Run every stage on a stream of images, one image (or one classification batch) at a time.
+
+    Args:
+    - images: Iterable of per-image records, e.g. from `iterate_folder_images`. Records with a
+              'Scale' (image decoded at a reduced resolution) get their 'bbox' mapped back to
+              the original image.
+    - mask_engine: MaskEngine or SegmentationPool used to generate the masks.
+    - classifier: ClassificationEngine, TFLiteClassifier or trained Keras model used to classify the leaves.
+    - service: Drive API service object, or None to defer the thumbnail uploads to the outbox.
+    - Resized_folder_id: ID of the folder in Google Drive to upload the resized images to.
+    - Annotated_folder_id: ID of the folder in Google Drive to upload the annotated images to,
+                           or None to skip the annotated images. Annotating keeps the full
+                           images until their leaves are classified.
+    - report: Optional RunReport (see Instrumentation.py) in which each stage is timed.
+    - deduplicate: Drop the overlapping and nested masks of the same leaf before cropping, so
+                   each leaf is classified (and votes) once.
+
+    Returns:
+    - records: List of compact per-image records (no image or mask data).
+    - zone_votes: Running per-zone vote of the image classes, see `update_zone_votes`.
+    """
+    # A plain Keras model is wrapped; ClassificationEngine and TFLiteClassifier are used as is
+    if not hasattr(classifier, 'classify_many'):
+        classifier = ClassificationEngine(classifier)
+
+    if report is None:
+        instrument = lambda name, stream, counters=None: stream
+    else:
+        instrument = report.iterate
+
+    stream = instrument('download', images)
+    stream = instrument('generate_masks', segment_images(stream, mask_engine), {'masks': lambda record: len(record['Masks'])})
+    stream = instrument('filter_masks', filter_images(stream), {'leaves': lambda record: len(record['Masks_b'])})
+    if deduplicate:
+        stream = instrument('deduplicate_masks', deduplicate_leaves(stream), {'leaves': lambda record: len(record['Masks_b'])})
+    stream = instrument('crop_leaves', crop_leaves(stream), {'leaves': lambda record: len(record['Test_Gen'])})
+    # Thumbnails don't depend on the classification, so unless annotated images are uploaded,
+    # the full image is dropped before records are held back to fill a classification batch
+    annotate = Annotated_folder_id is not None
+    stream = instrument('thumbnails', publish_thumbnails(stream, service, Resized_folder_id, keep_image=annotate))
+    stream = instrument('classify', classify_leaves(stream, classifier), {'leaves': lambda record: len(record['Classification'])})
+    if annotate:
+        stream = instrument('annotate', publish_annotations(stream, service, Annotated_folder_id))
+
+    records = []
+    zone_votes = {}
+    for record in stream:
+        # Images decoded at a reduced resolution report their boxes in original-image pixels
+        record['bbox'] = scale_bboxes(record['bbox'], record.pop('Scale', 1.0))
+        update_zone_votes(zone_votes, record['Location'], record['Image_Class'])
+        records.append(record)
+
+    return records, zone_votes
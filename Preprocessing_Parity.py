@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+import tensorflow as tf
+from Masks_Generation import prepare_test_images
+
+"""
+Parity check of `prepare_test_images` against the original TensorFlow implementation.
+
+Run `python Preprocessing_Parity.py` to compare both on random leaf crops.
+"""
+
+
+def prepare_test_images_reference(masked_images, img_size=(224, 224)):
+    """
+    Original implementation of `prepare_test_images`: one black 224x224 image and one
+    `tf.image.resize` call per leaf, stacked with np.array at the end.
+
+    Args:
+    - masked_images: List of masked images (arrays).
+    - img_size: Tuple specifying the target size of the images (default is (224, 224)).
+
+    Returns:
+    - test_images_prepared: A numpy array containing the prepared test images.
+    """
+    test_images_prepared = []
+    for masked_image in masked_images:
+        resized_masked_image = cv2.resize(masked_image, (150, 150))
+        final_image = np.zeros((224, 224, 3), dtype=np.uint8)
+        final_image[37 : 187 , 37 : 187, :] = resized_masked_image
+        img_resized = tf.image.resize(final_image, img_size)
+        test_images_prepared.append(img_resized)
+    return np.array(test_images_prepared)
+
+
+def random_leaf_crops(count=16, seed=0):
+    """
+    Random masked leaf crops of varied sizes, including crops already 150x150 and 224x224.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = [(150, 150), (224, 224), (1, 1)] + [tuple(rng.integers(8, 600, size=2)) for _ in range(count - 3)]
+    crops = []
+    for height, width in sizes:
+        crop = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        crop[rng.random((height, width)) < 0.3] = 0
+        crops.append(crop)
+    return crops
+
+
+def check_preprocessing_parity(masked_images, atol=0.0):
+    """
+    Compare `prepare_test_images` with the original implementation.
+
+    Args:
+    - masked_images: List of masked images (arrays).
+    - atol: Maximum accepted absolute difference between pixel values.
+
+    Returns:
+    - matches: True if shapes and dtypes are equal and every pixel is within `atol`.
+    - max_difference: Largest absolute pixel difference.
+    """
+    expected = prepare_test_images_reference(masked_images)
+    actual = prepare_test_images(masked_images)
+    if expected.shape != actual.shape or expected.dtype != actual.dtype:
+        print(f"Shape/dtype mismatch: {expected.shape} {expected.dtype} vs {actual.shape} {actual.dtype}")
+        return False, float('inf')
+    max_difference = float(np.max(np.abs(expected - actual))) if expected.size else 0.0
+    return max_difference <= atol, max_difference
+
+
+if __name__ == '__main__':
+    matches, max_difference = check_preprocessing_parity(random_leaf_crops())
+    print(f"Preprocessing parity: {'OK' if matches else 'MISMATCH'} (max difference {max_difference})")
+    raise SystemExit(0 if matches else 1)
@@ -0,0 +1,433 @@
+import os
+import random
+import signal
+import threading
+import time
+import traceback
+from Paths import get_paths, get_cursor_path, get_cache_directory, get_sam_checkpoint_path, get_outbox_path
+from Drive_listing import ListingCursor, list_children
+from Drive_authentication import authenticate_with_google, extract_folder_id
+from Outbox import Outbox, OutboxFlusher
+from Instrumentation import RunReport
+
+# Columns of the records sent to the create_image endpoint
+Mongo_Cols = ['Image_Path', 'PeriodOfDiseaesId','Classification','Confidence','bbox','Image_Class','Resized_Path','Annotated_Path']
+
+
+class PipelineDaemon:
+    """
+    Long-running scheduler that keeps the credentials, the Drive service, the SAM engine and
+    the classifier resident, and processes the pending subfolders of the unchecked folder on
+    every cycle.
+
+    The processing modules (and TensorFlow / SAM with them) are only imported and loaded the
+    first time a folder has to be processed, unless `warm_start` is set.
+
+    The thumbnails, create_image calls and folder move of a processed folder go through the
+    outbox (see Outbox.py): they are retried until acknowledged, and the folder is only moved
+    to the checked folder once all the others are.
+
+    Every cycle is measured stage by stage (see Instrumentation.py) into `report`, which is
+    written at the end of the cycle if a report or metrics path is given.
+
+    Args:
+    - interval_seconds: Time between two polls of the unchecked folder.
+    - jitter_seconds: Maximum random deviation added to (or removed from) each interval.
+    - max_folders_per_cycle: Maximum number of subfolders processed per cycle (default is all of them).
+    - warm_start: Load SAM and the classifier when the daemon starts instead of on the first folder.
+    - classifier_backend: 'keras', or 'tflite' to use the TFLite export (see Model_Export.py).
+    - cascade_threshold: Optional first-stage Healthy probability above which a leaf skips the
+                         B3 model (see Classifier_Cascade.py); None runs B3 on every leaf.
+    - sam_workers: Number of SAM worker processes; 0 runs SAM in this process.
+    - sam_threads: torch intra-op threads per SAM worker (default splits the CPU cores between them).
+    - sam_profile: SAM speed profile, see `Masks_Generation.SAM_PROFILES` (default is 'accurate').
+    - sam_prompts: 'grid' to prompt SAM with its automatic point grid, or 'vegetation' to prompt it
+                   inside the vegetation only, with fewer decoder calls (see Vegetation_Prompts.py).
+    - deduplicate_masks: Drop the overlapping and nested masks of the same leaf before the leaves
+                         are cropped and classified (see `Masks_Generation.deduplicate_masks`).
+    - upload_annotated: Also upload the images annotated with their detected leaves.
+    - decode_max_side: Optional working resolution the images are decoded at (longest side of at
+                       least this many pixels, see `Image_Downloader.decode_reduced_image`);
+                       boxes are still reported in original-image pixels.
+    - report_path: Optional path of the JSON run report written after each cycle.
+    - metrics_path: Optional path of a Prometheus textfile with the same measurements.
+    - profile_dir: Optional directory where a cProfile dump of each cycle is written; also turns
+                   on the stage start/end markers.
+    """
+
+    def __init__(self, interval_seconds=12 * 3600, jitter_seconds=600, max_folders_per_cycle=None, warm_start=False, classifier_backend='keras',
+                 cascade_threshold=None, sam_workers=0, sam_threads=None, sam_profile='accurate', sam_prompts='grid', deduplicate_masks=True,
+                 upload_annotated=False, decode_max_side=None, report_path=None, metrics_path=None, profile_dir=None):
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+        self.max_folders_per_cycle = max_folders_per_cycle
+        self.warm_start = warm_start
+        self.classifier_backend = classifier_backend
+        self.cascade_threshold = cascade_threshold
+        self.sam_workers = sam_workers
+        self.sam_threads = sam_threads
+        self.sam_profile = sam_profile
+        self.sam_prompts = sam_prompts
+        self.deduplicate_masks = deduplicate_masks
+        self.upload_annotated = upload_annotated
+        self.decode_max_side = decode_max_side
+        self.report_path = report_path
+        self.metrics_path = metrics_path
+        self.profile_dir = profile_dir
+
+        self.CheckPointPath, Credentials_file, self.model_path, self.Unchecked_folder_link, self.Checked_folder_link, \
+        self.Resized_folder_id, self.Annotated_folder_id, self.connection_string, \
+        self.zone_periods_Endpoint, self.create_image_Endpoint = get_paths()
+
+        self.credentials = authenticate_with_google(Credentials_file)
+        self.cursor = ListingCursor(get_cursor_path())
+        self.stop_event = threading.Event()
+        self.outbox = Outbox(get_outbox_path())
+        self.flusher = None
+        self.report = RunReport('cycle', markers=profile_dir is not None)
+
+        self.service = None
+        self.publisher = None
+        self.downloader = None
+        self.mask_engine = None
+        self.classifier = None
+        self.backend = None
+
+        if warm_start:
+            self.load()
+
+    def get_service(self):
+        """
+        Returns the resident Drive service, building it on first use.
+        """
+        if self.service is None:
+            from googleapiclient.discovery import build
+            self.service = build('drive', 'v3', credentials=self.credentials)
+        return self.service
+
+    def get_publisher(self):
+        """
+        Returns the resident DrivePublisher of the outbox writes. Its threads have their own
+        Drive services, since the flusher thread runs concurrently with the main thread.
+        """
+        if self.publisher is None:
+            from Drive_publishing import DrivePublisher
+            self.publisher = DrivePublisher(self.credentials)
+        return self.publisher
+
+    def get_backend(self):
+        """
+        Returns the resident backend client, creating it on first use.
+        """
+        if self.backend is None:
+            from Backend_Client import BackendClient
+            self.backend = BackendClient()
+        return self.backend
+
+    def load(self):
+        """
+        Load everything the processing needs (cache, downloader, SAM, classifier), once.
+        """
+        if self.classifier is not None:
+            return
+
+        from Local_Cache import ContentCache
+        from Image_Downloader import ImageDownloader
+        from Masks_Generation import get_sam_profile, get_profile_engine
+        from Model import ClassificationEngine, load_classifier_model
+
+        cache = ContentCache(get_cache_directory())
+        self.downloader = ImageDownloader(self.credentials, cache=cache, max_side=self.decode_max_side)
+        model_type, max_side, generator_kwargs = get_sam_profile(self.sam_profile)
+        CheckPointPath = get_sam_checkpoint_path(model_type)
+        if self.sam_workers:
+            from Segmentation_Pool import SegmentationPool
+            self.mask_engine = SegmentationPool(CheckPointPath, model_type, workers=self.sam_workers, torch_threads=self.sam_threads,
+                                                cache=cache, max_side=max_side, compact=True, prompts=self.sam_prompts,
+                                                **generator_kwargs).load()
+        elif self.sam_prompts == 'vegetation':
+            from Vegetation_Prompts import get_prompted_engine
+            self.mask_engine = get_prompted_engine(self.sam_profile, CheckPointPath, cache=cache, compact=True).load()
+        else:
+            self.mask_engine = get_profile_engine(self.sam_profile, CheckPointPath, cache=cache, compact=True).load()
+        if self.classifier_backend == 'tflite':
+            from Model_Export import TFLiteClassifier, get_tflite_path
+            self.classifier = TFLiteClassifier(get_tflite_path(self.model_path))
+        else:
+            self.classifier = ClassificationEngine(load_classifier_model(self.model_path))
+        if self.cascade_threshold is not None:
+            from Classifier_Cascade import CascadeClassifier, LeafFeatureClassifier, get_first_stage_path
+            first_stage = LeafFeatureClassifier.load(get_first_stage_path(self.model_path))
+            self.classifier = CascadeClassifier(first_stage, self.classifier, self.cascade_threshold)
+
+    def pending_folders(self):
+        """
+        Lists the unchecked subfolders added since the last processed one, oldest first.
+        Folders whose results are already in the outbox, waiting to be moved, are skipped.
+
+        Returns:
+        - folders: List of folder metadata dictionaries (id, name, modifiedTime, webViewLink).
+        """
+        folder_id = extract_folder_id(self.Unchecked_folder_link)
+        folders = list_children(self.get_service(), folder_id, fields='id, name, modifiedTime, webViewLink',
+                                folders_only=True, order_by='modifiedTime', cursor=self.cursor)
+        folders = [folder for folder in folders if not self.outbox.has_folder(folder['id'])]
+        if self.max_folders_per_cycle is not None:
+            folders = folders[:self.max_folders_per_cycle]
+        return folders
+
+    def process_folder(self, folder):
+        """
+        Run the whole processing on one subfolder and store its writes in the outbox: the
+        thumbnails, the create_image calls and, last, the move to the checked folder.
+
+        Args:
+        - folder: Folder metadata dictionary (id, name, webViewLink).
+
+        Returns:
+        - success: True if the folder was processed and its writes stored.
+        """
+        from Drive_authentication import iterate_folder_images
+        from Endpoint_data import get_Endpoint_1_data_from_votes, get_Period_ID, add_period_ids_to_records
+        from Mask_Encoding import to_python_value
+        from Pipeline import run_pipeline
+
+        with self.report.stage('load_models'):
+            self.load()
+
+        folder_link = folder['webViewLink'] + "?usp=drive_link"
+        folder_date = folder['name']
+
+        # Stream the Drive images one at a time instead of holding the whole folder in a DataFrame
+        images = iterate_folder_images(folder_link, folder_date, self.credentials, self.downloader, self.get_service())
+
+        # Segment, filter, crop, encode the thumbnail and classify each image; only compact records are kept
+        Annotated_folder_id = self.Annotated_folder_id if self.upload_annotated else None
+        failures = self.downloader.failures
+        escalated = getattr(self.classifier, 'escalated', 0)
+        records, zone_votes = run_pipeline(images, self.mask_engine, self.classifier, None, self.Resized_folder_id, Annotated_folder_id, self.report,
+                                           self.deduplicate_masks)
+        self.report.get_stage('download').error(self.downloader.failures - failures)
+        if hasattr(self.classifier, 'escalated'):
+            # Leaves the cascade passed through to the B3 model, next to the 'leaves' classified
+            self.report.get_stage('classify').add('escalated', self.classifier.escalated - escalated)
+        if not records:
+            print(f"No leaves detected in folder {folder_date}.")
+
+        # Getting data for first endpoint
+        Endpoint_1_Data = get_Endpoint_1_data_from_votes(zone_votes)
+
+        # Endpoint1 Call
+        with self.report.stage('period_ids') as stats:
+            period_Ids = get_Period_ID(Endpoint_1_Data, self.zone_periods_Endpoint, self.get_backend())
+            stats.add('requests')
+
+        # Update records
+        records = add_period_ids_to_records(records, Endpoint_1_Data, period_Ids)
+
+        # Thumbnails (and annotated images, chained after them), then the create_image call of
+        # each record with its links, then the move of the checked data from the processing
+        # drive folder to the data_backup folder
+        uploads = []
+        create_images = []
+        for index, record in enumerate(records):
+            uploads.append(({'folder_id': self.Resized_folder_id, 'filename': f"resized_image_{index}.jpg", 'field': 'Resized_Path'},
+                            record.pop('Resized_Jpeg'), None))
+            if 'Annotated_Jpeg' in record:
+                uploads.append(({'folder_id': self.Annotated_folder_id, 'filename': f"annotated_image{index}.jpg", 'field': 'Annotated_Path'},
+                                record.pop('Annotated_Jpeg'), len(uploads) - 1))
+            create_images.append(({col: to_python_value(record[col]) for col in Mongo_Cols}, len(uploads) - 1))
+        move = {'folder_link': folder_link, 'target_link': self.Checked_folder_link}
+        with self.report.stage('enqueue') as stats:
+            stats.add('items', self.outbox.enqueue_folder(folder['id'], uploads, create_images, move))
+
+        if self.flusher is not None:
+            self.flusher.wake()
+        else:
+            self.flush_outbox()
+        return True
+
+    def outbox_handlers(self):
+        """
+        Functions delivering each kind of outbox item, see `Outbox.flush`. Each kind is timed
+        as a stage of the current report.
+        """
+        handlers = {
+            'drive_upload': self._send_uploads,
+            'create_image': self._send_create_images,
+            'move_folder': self._send_moves,
+        }
+        return {kind: self._instrumented_handler(kind, handler) for kind, handler in handlers.items()}
+
+    def _instrumented_handler(self, kind, handler):
+        # The report is looked up on each call, so the flusher thread reports into the current cycle
+        return lambda items: self.report.wrap_outcomes(kind, handler)(items)
+
+    def _send_uploads(self, items):
+        # The result of an upload holds its link and the links of the uploads it is chained after
+        uploads = ((item['data'], item['payload']['folder_id'], item['payload']['filename']) for item in items)
+        outcomes = []
+        for item, (ok, link, error) in zip(items, self.get_publisher().upload_many(uploads)):
+            links = dict(item['dependency_result'] or {})
+            links[item['payload']['field']] = link
+            outcomes.append((ok, links if ok else None, error))
+        return outcomes
+
+    def _send_create_images(self, items):
+        payloads = []
+        for item in items:
+            payload = item['payload']
+            payload.update(item['dependency_result'] or {})
+            payloads.append(payload)
+        results = self.get_backend().post_many(self.create_image_Endpoint, payloads)
+        return [(result['ok'], result['data'], result['error']) for result in results]
+
+    def _send_moves(self, items):
+        from Drive_authentication import move_folder
+        outcomes = []
+        for item in items:
+            moved = move_folder(self.credentials, item['payload']['folder_link'], item['payload']['target_link'], self.get_publisher().get_service())
+            outcomes.append((moved, None, None if moved else "move failed"))
+        return outcomes
+
+    def flush_outbox(self):
+        """
+        Deliver the outbox items that are due, in this thread.
+
+        Returns:
+        - delivered: Number of items acknowledged.
+        """
+        with self.report.stage('flush_outbox') as stage:
+            delivered = self.outbox.flush(self.outbox_handlers())
+            stage.add('items', delivered)
+        stats = self.outbox.stats()
+        if stats['failing']:
+            print(f"Outbox: {stats['failing']} items waiting for a retry.")
+        return delivered
+
+    def run_once(self):
+        """
+        Process every pending subfolder, back to back, measuring the cycle into a new report.
+
+        The listing cursor only moves past folders processed without error, and stops at the
+        first failure so the failed folder is listed again on the next cycle.
+
+        Returns:
+        - processed: Number of folders processed successfully.
+        """
+        self.report = RunReport('cycle', markers=self.profile_dir is not None)
+        profiler = None
+        if self.profile_dir is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        processed = 0
+        try:
+            processed = self._run_cycle()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, time.strftime("cycle-%Y%m%d-%H%M%S.prof")))
+            self.report.info['folders_processed'] = processed
+            self.write_report()
+        return processed
+
+    def _run_cycle(self):
+        if self.flusher is None:
+            self.flush_outbox()
+
+        try:
+            with self.report.stage('list_folders') as stats:
+                folders = self.pending_folders()
+                stats.add('folders', len(folders))
+        except Exception as e:
+            print("Error:", e)
+            return 0
+
+        if not folders:
+            print("No subfolders found in the specified folder.")
+            return 0
+
+        processed = 0
+        unchecked_folder_id = extract_folder_id(self.Unchecked_folder_link)
+        advance_cursor = True
+        for folder in folders:
+            if self.stop_event.is_set():
+                break
+            try:
+                success = self.process_folder(folder)
+            except Exception:
+                traceback.print_exc()
+                success = False
+
+            if success:
+                processed += 1
+                if advance_cursor:
+                    self.cursor.advance(unchecked_folder_id, folder['modifiedTime'])
+            else:
+                self.report.info['folders_failed'] = self.report.info.get('folders_failed', 0) + 1
+                advance_cursor = False
+        return processed
+
+    def write_report(self):
+        """
+        Write the report of the current cycle to the JSON and Prometheus textfile paths, if configured.
+        """
+        try:
+            if self.report_path:
+                self.report.write_json(self.report_path)
+            if self.metrics_path:
+                self.report.write_prometheus(self.metrics_path)
+        except Exception as e:
+            print("Error:", e)
+
+    def next_delay(self):
+        """
+        Seconds until the next cycle: the interval with a random jitter.
+        """
+        return max(0.0, self.interval_seconds + random.uniform(-self.jitter_seconds, self.jitter_seconds))
+
+    def run_forever(self):
+        """
+        Poll and process on the configured interval until `stop` is called, with the outbox
+        drained in the background.
+        """
+        self.get_backend()
+        self.flusher = OutboxFlusher(self.outbox, self.outbox_handlers()).start()
+        while not self.stop_event.is_set():
+            self.run_once()
+            self.stop_event.wait(self.next_delay())
+        self.close()
+
+    def stop(self, *args):
+        """
+        Ask the daemon to stop after the current folder; usable as a signal handler.
+        """
+        self.stop_event.set()
+
+    def install_signal_handlers(self):
+        """
+        Stop gracefully on SIGTERM and SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher = None
+        self.outbox.close()
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+        if self.downloader is not None:
+            self.downloader.close()
+            self.downloader = None
+        if self.backend is not None:
+            self.backend.close()
+            self.backend = None
+        if hasattr(self.mask_engine, 'close'):
+            self.mask_engine.close()
+        self.mask_engine = None
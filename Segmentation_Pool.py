@@ -0,0 +1,183 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from Masks_Generation import MaskEngine
+from Mask_Encoding import encode_masks, decode_masks
+
+# SAM engine of the current worker process, loaded once by `_init_worker`
+_worker_engine = None
+
+
+def _make_engine(CheckPointPath, model_type, max_side, compact, prompts, generator_kwargs):
+    if prompts == 'vegetation':
+        from Vegetation_Prompts import PromptedMaskEngine
+        return PromptedMaskEngine(CheckPointPath, model_type, max_side=max_side, compact=compact, **generator_kwargs)
+    return MaskEngine(CheckPointPath, model_type, max_side=max_side, compact=compact, **generator_kwargs)
+
+
+def _init_worker(CheckPointPath, model_type, max_side, generator_kwargs, torch_threads, prompts='grid'):
+    global _worker_engine
+    import torch
+    torch.set_num_threads(torch_threads)
+    # Compact masks are encoded as bbox windows, without a full-image mask in between
+    _worker_engine = _make_engine(CheckPointPath, model_type, max_side, True, prompts, generator_kwargs).load()
+
+
+def _segment_shared_image(shm_name, shape, dtype):
+    """
+    Generate the masks of an image held in a shared memory block (runs in a worker).
+
+    Returns:
+    - encoded_masks: SAM masks with run-length encoded segmentations, see `Mask_Encoding.encode_masks`.
+    """
+    shm = SharedMemory(name=shm_name)
+    try:
+        # Copy out of the block so no view into it outlives `shm.close()`
+        image = np.array(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    finally:
+        shm.close()
+    return encode_masks(_worker_engine.generate(image))
+
+
+class SegmentationPool:
+    """
+    Pool of worker processes, each running its own SAM model, loaded once at startup.
+
+    Images are handed to the workers through `multiprocessing.shared_memory` blocks instead of
+    being pickled, and the masks come back run-length encoded with their bbox / area metadata.
+    Several SAM instances with a few torch threads each use a many-core CPU better than one
+    instance with many threads.
+
+    It has the same `generate` / `generate_many` as MaskEngine, plus `submit` for running
+    several images at once.
+
+    Args:
+    - CheckPointPath: str, Path to the SAM Checkpoint file.
+    - model_type: str, SAM backbone (default is "vit_l").
+    - workers: Number of worker processes (default is one per 8 CPU cores).
+    - torch_threads: torch intra-op threads per worker (default splits the CPU cores between the workers).
+    - cache: Optional ContentCache, used as by MaskEngine.
+    - max_side: Optional longest image side fed to SAM, as for MaskEngine.
+    - compact: Return CompactMask objects instead of dense masks, as for MaskEngine.
+    - prompts: 'grid' to prompt SAM with its automatic point grid, or 'vegetation' to prompt it
+               inside the vegetation only (see Vegetation_Prompts.py).
+    - generator_kwargs: Extra keyword arguments forwarded to `SamAutomaticMaskGenerator`.
+    """
+
+    def __init__(self, CheckPointPath, model_type="vit_l", workers=None, torch_threads=None, cache=None, max_side=None, compact=False,
+                 prompts='grid', **generator_kwargs):
+        cpu_count = os.cpu_count() or 1
+        self.workers = workers or max(1, cpu_count // 8)
+        self.torch_threads = torch_threads or max(1, cpu_count // self.workers)
+        self.model_type = model_type
+        self.max_side = max_side
+        self.compact = compact
+        self.prompts = prompts
+        self.generator_kwargs = generator_kwargs
+        self.cache = cache
+        # Spawned workers don't inherit the parent's torch / TensorFlow thread pools
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker,
+                                            initargs=(CheckPointPath, model_type, max_side, generator_kwargs, self.torch_threads, prompts))
+
+    @property
+    def cache_tag(self):
+        # Same tag as the engine running in the workers, without loading it
+        return _make_engine(None, self.model_type, self.max_side, self.compact, self.prompts, self.generator_kwargs).cache_tag
+
+    def load(self):
+        """
+        Start every worker (each loads its SAM model), for a warm start.
+        """
+        for future in [self.executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+        return self
+
+    def submit(self, image):
+        """
+        Copy the image into shared memory and queue it for segmentation.
+
+        Args:
+        - image: Input image.
+
+        Returns:
+        - future: Future of the run-length encoded masks. The shared memory is released when it completes.
+        """
+        image = np.ascontiguousarray(image)
+        shm = SharedMemory(create=True, size=max(1, image.nbytes))
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[...] = image
+
+        future = self.executor.submit(_segment_shared_image, shm.name, image.shape, image.dtype.str)
+
+        def release(_):
+            shm.close()
+            shm.unlink()
+        future.add_done_callback(release)
+        return future
+
+    def generate(self, image, cache_key=None):
+        """
+        Generate masks for a single image in a worker process.
+
+        Args:
+        - image: Input image.
+        - cache_key: Optional cache key of the image (see `Local_Cache.file_cache_key`).
+
+        Returns:
+        - masks: List of masks.
+        """
+        return self.generate_many([image], [cache_key])[0]
+
+    def generate_many(self, images, cache_keys=None):
+        """
+        Generate masks for several images, spread over the worker processes.
+
+        Args:
+        - images: Iterable of input images.
+        - cache_keys: Optional iterable with the cache key of each image.
+
+        Returns:
+        - masks_list: List with the list of masks of each image, in order.
+        """
+        images = list(images)
+        cache_keys = list(cache_keys) if cache_keys is not None else [None] * len(images)
+        return [masks for masks in self.iterate(zip(images, cache_keys))]
+
+    def iterate(self, items):
+        """
+        Segment a stream of images, keeping every worker busy but at most two images per worker in flight.
+
+        Args:
+        - items: Iterable of (image, cache_key) pairs.
+
+        Yields:
+        - masks: List of masks of each image, in order.
+        """
+        pending = deque()
+        for image, cache_key in items:
+            pending.append((cache_key, self._submit_or_cached(image, cache_key)))
+            if len(pending) >= 2 * self.workers:
+                yield self._collect(*pending.popleft())
+        while pending:
+            yield self._collect(*pending.popleft())
+
+    def _submit_or_cached(self, image, cache_key):
+        if self.cache is not None and cache_key is not None:
+            masks = self.cache.get_masks(cache_key, self.cache_tag, self.compact)
+            if masks is not None:
+                return masks
+        return self.submit(image)
+
+    def _collect(self, cache_key, result):
+        if isinstance(result, list):
+            return result
+        masks = decode_masks(result.result(), self.compact)
+        if self.cache is not None and cache_key is not None:
+            self.cache.put_masks(cache_key, masks, self.cache_tag)
+        return masks
+
+    def close(self):
+        self.executor.shutdown(wait=True)
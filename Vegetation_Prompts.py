@@ -0,0 +1,291 @@
+import cv2
+import numpy as np
+from Mask_Encoding import CompactMask
+from Masks_Generation import downscale_image, upscale_masks, sam_cache_tag, get_sam_profile
+
+"""
+SAM prompted only where there is vegetation.
+
+Instead of decoding a dense point grid over the whole frame (most of it soil, sky or stakes,
+whose masks `filter_masks` throws away), a color index marks the green pixels, and only the
+grid points landing on them, plus the innermost point of every green connected component, are
+used as prompts. The image embedding is computed once per image by a reused SamPredictor and
+the prompts are decoded in batches, then filtered and deduplicated as SamAutomaticMaskGenerator
+does, so the masks have the same keys and can go straight to `filter_masks`.
+"""
+
+# Settings of the prompted engine, named and defaulting as in SamAutomaticMaskGenerator
+PROMPT_SETTINGS = {
+    'points_per_side': 32,
+    'points_per_batch': 64,
+    'pred_iou_thresh': 0.88,
+    'stability_score_thresh': 0.95,
+    'box_nms_thresh': 0.7,
+}
+
+
+def vegetation_mask(image, method='exg', exg_threshold=0.1, hue_range=(30, 90), min_saturation=40, min_value=40, opening=5):
+    """
+    Mark the green pixels of an image, all at once.
+
+    Args:
+    - image: RGB uint8 image.
+    - method: 'exg' for the excess green index 2g - r - b on chromatic coordinates, or 'hsv'
+              for a hue / saturation / value threshold.
+    - exg_threshold: Minimum excess green of a vegetation pixel ('exg').
+    - hue_range: OpenCV hue range (0-180) of vegetation ('hsv').
+    - min_saturation: Minimum saturation of a vegetation pixel ('hsv').
+    - min_value: Minimum value of a vegetation pixel ('hsv').
+    - opening: Size of the morphological opening removing isolated pixels, or 0.
+
+    Returns:
+    - mask: Boolean array, True on vegetation.
+    """
+    if method == 'exg':
+        rgb = image.astype(np.float32)
+        total = rgb.sum(axis=2)
+        total[total == 0] = 1
+        mask = (2 * rgb[..., 1] - rgb[..., 0] - rgb[..., 2]) / total > exg_threshold
+    elif method == 'hsv':
+        hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
+        mask = ((hsv[..., 0] >= hue_range[0]) & (hsv[..., 0] <= hue_range[1]) &
+                (hsv[..., 1] >= min_saturation) & (hsv[..., 2] >= min_value))
+    else:
+        raise ValueError(f"Unknown vegetation index '{method}', expected 'exg' or 'hsv'")
+
+    mask = mask.astype(np.uint8)
+    if opening:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (opening, opening))
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    return mask.astype(bool)
+
+
+def vegetation_prompts(mask, points_per_side=32, min_area_ratio=0.0005):
+    """
+    Prompts inside the vegetation: the points of a regular grid that land on it, plus the
+    innermost point of each connected component (so leaves smaller than the grid spacing
+    get one too), and the bounding box of each component.
+
+    Args:
+    - mask: Boolean vegetation mask, from `vegetation_mask`.
+    - points_per_side: Number of grid points along each side of the image, as for SAM.
+    - min_area_ratio: Components smaller than this fraction of the image are ignored.
+
+    Returns:
+    - points: Array (N, 2) of (x, y) prompt points, in pixels.
+    - boxes: Array (M, 4) of (x0, y0, x1, y1) component boxes, in pixels.
+    """
+    height, width = mask.shape
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), connectivity=8)
+    keep = np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] >= min_area_ratio * height * width) + 1
+    if keep.size == 0:
+        return np.zeros((0, 2)), np.zeros((0, 4))
+    valid = np.zeros(count, dtype=bool)
+    valid[keep] = True
+    vegetation = valid[labels]
+
+    # Cell centers of the grid, as SAM's build_point_grid
+    offset = 1 / (2 * points_per_side)
+    steps = np.linspace(offset, 1 - offset, points_per_side)
+    grid_x, grid_y = np.meshgrid(np.minimum((steps * width).astype(int), width - 1),
+                                 np.minimum((steps * height).astype(int), height - 1))
+    on_vegetation = vegetation[grid_y, grid_x]
+    grid_points = np.stack([grid_x[on_vegetation], grid_y[on_vegetation]], axis=1)
+
+    # Innermost pixel of each component: the farthest from the background
+    distance = cv2.distanceTransform(vegetation.astype(np.uint8), cv2.DIST_L2, 3).ravel()
+    flat_labels = labels.ravel()
+    inside = np.flatnonzero(vegetation.ravel())
+    order = inside[np.lexsort((distance[inside], flat_labels[inside]))]
+    last_of_component = np.r_[np.flatnonzero(np.diff(flat_labels[order])), order.size - 1]
+    centers = order[last_of_component]
+    center_points = np.stack([centers % width, centers // width], axis=1)
+
+    x, y, w, h = (stats[keep, index] for index in (cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT))
+    boxes = np.stack([x, y, x + w - 1, y + h - 1], axis=1).astype(np.float64)
+    return np.concatenate([grid_points, center_points]).astype(np.float64), boxes
+
+
+class PromptedMaskEngine:
+    """
+    Long-lived SAM mask generator prompted inside the vegetation only, with the same interface
+    as MaskEngine (`load`, `generate`, `generate_many`, `cache_tag`).
+
+    Args:
+    - CheckPointPath: str, Path to the SAM Checkpoint file.
+    - model_type: str, SAM backbone registered in `sam_model_registry` (default is "vit_l").
+    - cache: Optional ContentCache, used as by MaskEngine.
+    - max_side: Optional longest image side fed to SAM, as for MaskEngine.
+    - compact: Return CompactMask objects instead of dense masks, as for MaskEngine.
+    - method: Vegetation index, 'exg' or 'hsv' (see `vegetation_mask`).
+    - prompt: 'points' to prompt the vegetation points (3 masks each), or 'boxes' to prompt the
+              box of each vegetation component (1 mask each, fewer decoder calls, but touching
+              leaves come out as one mask).
+    - min_area_ratio: Smallest vegetation component prompted, as a fraction of the image.
+    - settings: Settings from PROMPT_SETTINGS; other SamAutomaticMaskGenerator arguments (e.g.
+                those of a SAM profile) are ignored.
+
+    `decoder_prompts` counts the prompts decoded so far.
+    """
+
+    def __init__(self, CheckPointPath, model_type="vit_l", cache=None, max_side=None, compact=False, method='exg', prompt='points',
+                 min_area_ratio=0.0005, **settings):
+        self.CheckPointPath = CheckPointPath
+        self.model_type = model_type
+        self.cache = cache
+        self.max_side = max_side
+        self.compact = compact
+        self.method = method
+        self.prompt = prompt
+        self.min_area_ratio = min_area_ratio
+        self.settings = dict(PROMPT_SETTINGS)
+        self.settings.update({key: value for key, value in settings.items() if key in PROMPT_SETTINGS})
+        self.predictor = None
+        self.decoder_prompts = 0
+
+    @property
+    def cache_tag(self):
+        settings = dict(self.settings, prompts=f"{self.method}-{self.prompt}", min_area_ratio=self.min_area_ratio)
+        return sam_cache_tag(self.model_type, settings, self.max_side)
+
+    @property
+    def loaded(self):
+        return self.predictor is not None
+
+    def load(self):
+        """
+        Load the SAM checkpoint and build the predictor if not done already (warm start).
+
+        Returns:
+        - self, so the call can be chained.
+        """
+        if self.predictor is None:
+            from segment_anything import SamPredictor, sam_model_registry
+            self.predictor = SamPredictor(sam_model_registry[self.model_type](checkpoint=self.CheckPointPath))
+        return self
+
+    def generate(self, image, cache_key=None):
+        """
+        Generate the masks of the vegetation of a single image.
+
+        Args:
+        - image: Input RGB image.
+        - cache_key: Optional cache key of the image (see `Local_Cache.file_cache_key`).
+
+        Returns:
+        - masks: List of masks, with the keys of SamAutomaticMaskGenerator masks.
+        """
+        if self.cache is not None and cache_key is not None:
+            masks = self.cache.get_masks(cache_key, self.cache_tag, self.compact)
+            if masks is not None:
+                return masks
+
+        self.load()
+        image = np.asarray(image)
+        small_image, scale = downscale_image(image, self.max_side)
+        masks = self._segment(np.ascontiguousarray(small_image))
+        if scale != 1.0:
+            masks = upscale_masks(masks, image.shape, scale)
+
+        if self.cache is not None and cache_key is not None:
+            self.cache.put_masks(cache_key, masks, self.cache_tag)
+        return masks
+
+    def generate_many(self, images, cache_keys=None):
+        """
+        Generate masks for several images, one after the other, with the same loaded model.
+        """
+        if cache_keys is None:
+            return [self.generate(image) for image in images]
+        return [self.generate(image, cache_key) for image, cache_key in zip(images, cache_keys)]
+
+    def _segment(self, image):
+        import torch
+        from torchvision.ops import batched_nms
+        from segment_anything.utils.amg import (area_from_rle, batched_mask_to_box, box_xyxy_to_xywh, calculate_stability_score,
+                                                 mask_to_rle_pytorch, rle_to_mask)
+
+        points, boxes = vegetation_prompts(vegetation_mask(image, self.method), self.settings['points_per_side'], self.min_area_ratio)
+        prompts = points if self.prompt == 'points' else boxes
+        if len(prompts) == 0:
+            return []
+
+        # One image embedding, reused by every batch of prompts
+        self.predictor.set_image(image)
+        height, width = image.shape[:2]
+        device = self.predictor.device
+        mask_threshold = self.predictor.model.mask_threshold
+        # Each batch is reduced to boxes and run-length encodings right away, as in
+        # SamAutomaticMaskGenerator, so no dense mask outlives its batch
+        kept_rles, kept_boxes, kept_iou, kept_stability, kept_points = [], [], [], [], []
+
+        with torch.no_grad():
+            for start in range(0, len(prompts), self.settings['points_per_batch']):
+                batch = prompts[start:start + self.settings['points_per_batch']]
+                if self.prompt == 'points':
+                    coords = torch.as_tensor(self.predictor.transform.apply_coords(batch, (height, width)), dtype=torch.float, device=device)
+                    labels = torch.ones(len(batch), 1, dtype=torch.int, device=device)
+                    logits, iou, _ = self.predictor.predict_torch(coords[:, None, :], labels, multimask_output=True, return_logits=True)
+                    batch_points = np.repeat(batch, logits.shape[1], axis=0)
+                else:
+                    box_prompts = torch.as_tensor(self.predictor.transform.apply_boxes(batch, (height, width)), dtype=torch.float, device=device)
+                    logits, iou, _ = self.predictor.predict_torch(None, None, boxes=box_prompts, multimask_output=False, return_logits=True)
+                    batch_points = (batch[:, :2] + batch[:, 2:]) / 2
+                self.decoder_prompts += len(batch)
+
+                logits, iou = logits.flatten(0, 1), iou.flatten(0, 1)
+                stability = calculate_stability_score(logits, mask_threshold, 1.0)
+                keep = (iou > self.settings['pred_iou_thresh']) & (stability > self.settings['stability_score_thresh'])
+                if keep.any():
+                    binary = logits[keep] > mask_threshold
+                    kept_boxes.append(batched_mask_to_box(binary).cpu())
+                    kept_rles.extend(mask_to_rle_pytorch(binary))
+                    kept_iou.append(iou[keep].cpu())
+                    kept_stability.append(stability[keep].cpu())
+                    kept_points.append(batch_points[keep.cpu().numpy()])
+                    del binary
+                del logits
+
+        if not kept_rles:
+            return []
+        mask_boxes = torch.cat(kept_boxes)
+        iou = torch.cat(kept_iou)
+        stability = torch.cat(kept_stability)
+        prompt_points = np.concatenate(kept_points)
+
+        # Several prompts on the same leaf give the same mask; keep the best one
+        keep = batched_nms(mask_boxes.float(), iou, torch.zeros_like(iou), iou_threshold=self.settings['box_nms_thresh'])
+
+        masks = []
+        for index in keep.tolist():
+            rle = kept_rles[index]
+            mask_info = {
+                'segmentation': rle if self.compact else rle_to_mask(rle),
+                'area': area_from_rle(rle),
+                'bbox': box_xyxy_to_xywh(mask_boxes[index]).tolist(),
+                'predicted_iou': float(iou[index]),
+                'point_coords': [prompt_points[index].tolist()],
+                'stability_score': float(stability[index]),
+                'crop_box': [0, 0, width, height],
+            }
+            masks.append(CompactMask.from_sam(mask_info) if self.compact else mask_info)
+        return masks
+
+
+def get_prompted_engine(profile, CheckPointPath, cache=None, compact=False, method='exg', prompt='points'):
+    """
+    PromptedMaskEngine with the backbone, input size and thresholds of a SAM speed profile.
+
+    Args:
+    - profile: str, Name of the profile in SAM_PROFILES.
+    - CheckPointPath: str, Path to the SAM Checkpoint file of the profile backbone.
+    - cache: Optional ContentCache to attach to the engine.
+    - compact: Return CompactMask objects instead of dense masks.
+    - method: Vegetation index, 'exg' or 'hsv'.
+    - prompt: 'points' or 'boxes'.
+
+    Returns:
+    - engine: PromptedMaskEngine instance (not loaded until first used or `load` is called).
+    """
+    model_type, max_side, generator_kwargs = get_sam_profile(profile)
+    return PromptedMaskEngine(CheckPointPath, model_type, cache, max_side, compact, method, prompt, **generator_kwargs)
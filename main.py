@@ -1,10 +1,5 @@
-from Libraries import *
-from Paths import get_paths
-from Drive_authentication import *
-from Masks_Generation import *
-from Model import *
-from Database_Data import *
-from Endpoint_data import *
+import argparse
+from Scheduler import PipelineDaemon
 
 """
 !pip install git+https://github.com/facebookresearch/segment-anything.git
@@ -13,75 +8,53 @@ from Endpoint_data import *
 !pip install schedule
 """
 
-# Directories paths:
-CheckPointPath, Credentials_file, model_path, Unchecked_folder_link, Checked_folder_link, \
-Resized_folder_id, Annotated_folder_id, connection_string, \
-zone_periods_Endpoint, create_image_Endpoint = get_paths()
-
-# Authenticate and get credentials with drive
-credentials = authenticate_with_google(Credentials_file)
-
-"""
-This part should be checked every 12 hours for example
 """
+Processes the subfolders added to the unchecked Drive folder since the last run.
 
-# Getting the recent added Folder drive data
-Recent_Folder_Data = get_recent_folder_link(Unchecked_folder_link, credentials) # [Folder_name, Folder Link, Last modification date]
-
-if Recent_Folder_Data != None: # There is unchecked data
-
-    recent_folder_download_link = Recent_Folder_Data[1]
-    recent_folder_date = Recent_Folder_Data[0]
-    
-    # Getting Drive data
-    df = Getting_Images_DataFrame(recent_folder_download_link, recent_folder_date, credentials) # ['Image_Path', 'Image','Location', 'Date', 'time']
-
-    # Generating masks using sam, filter them
-    df['Masks'] = df['Image'].apply(lambda x: generate_masks(x, CheckPointPath))
-
-    #Filteration parameters 
-    min_leaf_areas = filter_parameters(df)
-
-    # Apply the filtering function to each mask set in df['Masks']
-    df['Filtered_Masks'], df['Masks_b'] = zip(*[filter_masks(masks_l, min_leaf_area) for masks_l, min_leaf_area in zip(df['Masks'], min_leaf_areas)])
-
-    # Drop images with non-detected leaves
-    df = df[df['Masks_b'].apply(len) > 0]
-    # Reset index after filtering
-    df.reset_index(drop=True, inplace=True)
-
-    # prepare images for the model
-    df['Test_Gen'] = [get_masked_leaves(filtered_masks_set, image) for filtered_masks_set, image in zip(df['Filtered_Masks'], df['Image'])]
-    
-    # model prediction
-    model = load_model(model_path)
-    df[['Confidence', 'Classification','Image_Class']] = df['Test_Gen'].apply(lambda x: pd.Series(predict_labels(x, model)))
-
-    # Adding features: bbox, edited, treated (prepare data for the database)
-    df[['bbox', 'Edited', 'Treated']] = df['Masks_b'].apply(lambda annotations: pd.Series(add_features(annotations)))
-
-    # Resized Images Path
-    df = upload_resized_images_to_drive(df, credentials, Resized_folder_id, Annotated_folder_id)
-
-    
-    # Getting data for first endpoint
-    Endpoint_1_Data = get_Endpoint_1_data(df)
-
-    # Endpoint1 Call 
-    period_Ids = get_Period_ID(Endpoint_1_Data, zone_periods_Endpoint)
-
-    # Update df
-    df = add_period_ids(df, Endpoint_1_Data, period_Ids)
-
-    df['Annotated_Path'] = ''
-    # Send to mongo 
-    Mongo_Cols = ['Image_Path', 'PeriodOfDiseaesId','Classification','Confidence','bbox','Image_Class','Resized_Path','Annotated_Path']
-
-    # Upload Data
-    upload_data(df, Mongo_Cols,create_image_Endpoint)
-
-    # Moving the checked data from the processing drive folder to the data_backup folder
-    success = move_folder(credentials, recent_folder_download_link, Checked_folder_link)
-
+    python main.py              # One run, e.g. from cron every 12 hours
+    python main.py --daemon     # Keep the models loaded and poll every --interval seconds
+"""
 
-    
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon', action='store_true', help='Keep running and poll the unchecked folder on an interval')
+    parser.add_argument('--interval', type=float, default=12 * 3600, help='Seconds between two polls (default is 12 hours)')
+    parser.add_argument('--jitter', type=float, default=600, help='Maximum random deviation of each interval, in seconds')
+    parser.add_argument('--max-folders', type=int, help='Maximum number of subfolders processed per poll')
+    parser.add_argument('--classifier-backend', choices=['keras', 'tflite'], default='keras')
+    parser.add_argument('--cascade-threshold', type=float,
+                        help='Classify the leaves with the cheap first stage and only send those not found Healthy '
+                             'with this probability to the B3 model (see Classifier_Cascade.py)')
+    parser.add_argument('--sam-workers', type=int, default=0, help='Number of SAM worker processes (0 runs SAM in the main process)')
+    parser.add_argument('--sam-threads', type=int, help='torch threads per SAM worker')
+    parser.add_argument('--sam-profile', choices=['accurate', 'balanced', 'fast'], default='accurate',
+                        help='SAM speed profile (backbone, point grid, thresholds and input size)')
+    parser.add_argument('--sam-prompts', choices=['grid', 'vegetation'], default='grid',
+                        help='Prompt SAM with its point grid, or only inside the vegetation found by a color index')
+    parser.add_argument('--keep-duplicate-masks', action='store_true',
+                        help='Classify every leaf mask, even those overlapping or nested in a better mask of the same leaf')
+    parser.add_argument('--upload-annotated', action='store_true', help='Also upload the images annotated with their detected leaves')
+    parser.add_argument('--decode-max-side', type=int,
+                        help='Decode the images straight to this working resolution (longest side) instead of full resolution')
+    parser.add_argument('--report', help='Write a JSON report of the time, memory and throughput of each stage after every run')
+    parser.add_argument('--metrics-textfile', help='Write the same measurements as a Prometheus textfile (e.g. for node_exporter)')
+    parser.add_argument('--profile-dir', help='Dump a cProfile of every run in this directory, and print stage start/end markers')
+    args = parser.parse_args()
+
+    # In daemon mode SAM and the classifier are loaded up front and stay resident between polls;
+    # a single run only loads them if there is new data
+    daemon = PipelineDaemon(interval_seconds=args.interval, jitter_seconds=args.jitter,
+                            max_folders_per_cycle=args.max_folders, warm_start=args.daemon,
+                            classifier_backend=args.classifier_backend, cascade_threshold=args.cascade_threshold,
+                            sam_workers=args.sam_workers, sam_threads=args.sam_threads,
+                            sam_profile=args.sam_profile, sam_prompts=args.sam_prompts,
+                            deduplicate_masks=not args.keep_duplicate_masks, upload_annotated=args.upload_annotated,
+                            decode_max_side=args.decode_max_side,
+                            report_path=args.report, metrics_path=args.metrics_textfile, profile_dir=args.profile_dir)
+
+    if args.daemon:
+        daemon.install_signal_handlers()
+        daemon.run_forever()
+    else:
+        daemon.run_once()
+        daemon.close()